@@ -1,52 +1,62 @@
-from .mypython import (validate_text, PythonSyntaxValidator, prompt_style,
-    NoResult, smart_eval, normalize, execute_command, run_shell, myhelp,
-    getsource, Session)
+"""
+mypython
 
-__all__ = ['validate_text', 'PythonSyntaxValidator', 'prompt_style',
-    'NoResult', 'smart_eval', 'normalize', 'execute_command',
-    'run_shell', 'myhelp', 'getsource', 'Session']
+The names here are imported lazily, the first time they are used (see
+__getattr__ below), so that importing mypython (e.g., to run mypython.__main__)
+only imports the modules that are actually needed.
+"""
 
-from .ai import (DEFAULT_MODEL, MODELS, load_model, get_ai_models,
-                 set_current_model, get_ai_completion, OllamaSuggester)
+import importlib
 
-__all__ += ['DEFAULT_MODEL', 'MODELS', 'load_model', 'get_ai_models',
-            'set_current_model', 'get_ai_completion', 'OllamaSuggester']
+# name -> submodule that defines it
+_LAZY_NAMES = {}
 
-from .keys import get_key_bindings, custom_key_bindings, split_prompts
+def _lazy(module, names):
+    for name in names:
+        _LAZY_NAMES[name] = module
+    return names
 
-__all__ += ['get_key_bindings', 'custom_key_bindings', 'split_prompts']
+__all__ = _lazy('mypython', ['validate_text', 'PythonSyntaxValidator',
+    'prompt_style', 'NoResult', 'smart_eval', 'normalize', 'execute_command',
+    'run_shell', 'run_batch', 'myhelp', 'getsource', 'Session',
+    'BatchSession'])
 
-from .theme import OneAMStyle
+__all__ += _lazy('ai', ['DEFAULT_MODEL', 'MODELS', 'load_model',
+    'get_ai_models', 'set_current_model', 'get_ai_completion',
+    'OllamaSuggester'])
 
-__all__ += ['OneAMStyle']
+__all__ += _lazy('keys', ['get_key_bindings', 'custom_key_bindings',
+    'split_prompts'])
 
-from .multiline import (document_is_multiline_python, auto_newline,
-    tab_should_insert_whitespace)
+__all__ += _lazy('theme', ['OneAMStyle'])
 
-__all__ += ['document_is_multiline_python',
-    'auto_newline', 'tab_should_insert_whitespace']
+__all__ += _lazy('multiline', ['document_is_multiline_python',
+    'auto_newline', 'tab_should_insert_whitespace'])
 
-from .completion import get_jedi_script_from_document, PythonCompleter
+__all__ += _lazy('completion', ['get_jedi_script_from_document',
+    'PythonCompleter', 'SessionDocument'])
 
-__all__ += ['get_jedi_script_from_document', 'PythonCompleter']
+# Note that mypython.magic is the submodule, not the magic() function, if
+# the submodule has already been imported
+__all__ += _lazy('magic', ['magic', 'MAGICS'])
 
-from .magic import magic, MAGICS
+__all__ += _lazy('printing', ['can_print_sympy', 'mypython_displayhook'])
 
-__all__ += ['magic', 'MAGICS']
+__all__ += _lazy('processors', ['get_pyflakes_warnings'])
 
-from .printing import can_print_sympy, mypython_displayhook
+__all__ += _lazy('tokenize', ['tokenize_string', 'braces',
+    'matching_parens', 'inside_string', 'is_multiline_python'])
 
-__all__ += ['can_print_sympy', 'mypython_displayhook']
+__all__ += _lazy('timeit', ['autorange', 'timeit_format', 'format_time'])
 
-from .processors import get_pyflakes_warnings
+del _lazy
 
-__all__ += ['get_pyflakes_warnings']
+def __getattr__(name):
+    if name in _LAZY_NAMES:
+        module = importlib.import_module('.' + _LAZY_NAMES[name], __name__)
+        value = globals()[name] = getattr(module, name)
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-from .tokenize import (tokenize_string, braces, matching_parens,
-    inside_string, is_multiline_python)
-
-__all__ += ['tokenize_string', 'braces', 'matching_parens', 'inside_string', 'is_multiline_python']
-
-from .timeit import (autorange, timeit_format, format_time)
-
-__all__ += ['autorange', 'timeit_format', 'format_time']
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -7,10 +7,11 @@ A Python REPL the way I like it.
 import argparse
 import sys
 
-from .mypython import default_history_filename, run_shell
+from .mypython import default_history_filename, run_shell, run_batch
 from . import mypython, ai
 
 def main():
+    models = sorted(ai.get_ai_models(include_aliases=True))
     parser = argparse.ArgumentParser(__doc__)
     parser.add_argument("--cmd", "-c", metavar="CMD", default=[],
         action="append", help="""Execute the given command at startup.""")
@@ -20,6 +21,9 @@ def main():
         print the startup messages.""")
     parser.add_argument("--doctest-mode", "-d", action="store_true",
         help="""Enable doctest mode. Mimics the default Python prompt.""")
+    parser.add_argument("--autocomplete", action="store_true",
+        help="""Complete as you type. Equivalent to -c '%%autocomplete',
+        except with --kernel.""")
     parser.add_argument("--history-file", metavar="HISTORY_FILE", default=None,
         action="store", help=f"""Use the given file for the command history.
         For this terminal, this defaults to {default_history_filename()}""")
@@ -30,10 +34,21 @@ def main():
                         Use the given model for the ollama AI
                         completion engine. The default model is
                         {ai.DEFAULT_MODEL}. The model must already be pulled
-                        and the ollama server must be running. Supported models are: {', '.join(sorted(ai.get_ai_models(include_aliases=False)))}
-                        """, choices=sorted(ai.get_ai_models(include_aliases=True)))
+                        and the ollama server must be running. Supported models are: {', '.join(sorted(ai.MODELS))}
+                        """, choices=models)
     parser.add_argument('--exit', action='store_true', help="""Exit immediately, after
         running any --cmd commands.""")
+    parser.add_argument('--batch', metavar='FILE', default=None, help="""Run
+        the commands in FILE (or stdin if FILE is -) without a prompt, and
+        exit. FILE may be a Python script or text copied from a mypython,
+        Python, or IPython session.""")
+    parser.add_argument('--server', action='store_true', help="""Start a
+        server that preloads mypython and the modules it uses, so that
+        bin/mypython starts faster. Sessions are forked from the server. The
+        server exits when the mypython sources change.""")
+    parser.add_argument('--kernel', action='store_true', help="""Run the
+        commands in a separate process, so that a crash or a hang doesn't
+        take down the prompt. The kernel is restarted if it dies.""")
 
     try:
         import argcomplete
@@ -49,14 +64,24 @@ def main():
     if args.doctest_mode:
         mypython.doctest_mode()
 
+    if args.autocomplete:
+        mypython.AUTOCOMPLETE_MODE = True
+
     if args.isympy:
         args.cmd.append('%sympy')
 
     if args.model:
         ai.set_current_model(args.model)
 
+    if args.server:
+        from .server import serve
+        return serve()
+
+    if args.batch:
+        return run_batch(args.batch, quiet=True, cmd=args.cmd)
+
     return run_shell(quiet=args.quiet, cmd=args.cmd, _exit=args.exit,
-                     history_file=args.history_file)
+                     history_file=args.history_file, kernel=args.kernel)
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -32,18 +32,151 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 from prompt_toolkit.completion import Completer, Completion
 from prompt_toolkit.patch_stdout import patch_stdout
 
+import os
+import re
+import time
+import asyncio
+import threading
 import traceback
+import types
+from collections import deque
 
 from .dircompletion import DirCompleter
 from .magic import MAGICS, MAGIC_COMPLETIONS
 
-def get_jedi_script_from_document(document, _locals, _globals, session):
+# Where Jedi caches the modules it parses, so that they aren't parsed again
+# in every session
+JEDI_CACHE_DIR = "~/.mypython/jedi"
+
+# Jedi is not thread-safe. This is held while Jedi is used by the completer
+# or by warm_up_jedi().
+JEDI_LOCK = threading.RLock()
+
+# The completions that warm_up_jedi() has already done in this process
+_warmed_up = set()
+
+# When completing as you type (%autocomplete), how long to wait after a
+# keystroke before completing, in seconds. Typing faster than this doesn't
+# start any completions.
+AUTOCOMPLETE_DELAY = 0.1
+
+# When completing as you type, how long the completions can take, in seconds
+# (after AUTOCOMPLETE_DELAY). Completions that aren't ready by then (usually
+# the ones from Jedi) are left out for that keystroke, but are still cached
+# when they finish. TAB always waits for all the completions.
+AUTOCOMPLETE_BUDGET = 0.3
+
+# The maximum number of lines of the session history (In) that are given to
+# Jedi, so that completion doesn't get slower as the session gets longer.
+# None means no limit.
+JEDI_HISTORY_LINES = 1000
+
+def import_jedi():
     import jedi  # We keep this import in-line, to improve start-up time.
                  # Importing Jedi is 'slow'.
 
-    full_document = '\n'.join(i for _, i in sorted(session.builtins['In'].items()))
-    if not full_document.endswith('\n'):
-        full_document += '\n'
+    cache_directory = os.path.expanduser(JEDI_CACHE_DIR)
+    if jedi.settings.cache_directory != cache_directory:
+        jedi.settings.cache_directory = cache_directory
+    return jedi
+
+def warm_up_jedi(namespace):
+    """
+    Import Jedi and complete on the modules in namespace, so that the first
+    completion doesn't have to wait for it.
+
+    This is run in a background thread after the first prompt is shown (see
+    Session.start_warm_up()).
+    """
+    jedi = import_jedi()
+    modules = [name for name, value in list(namespace.items())
+               if isinstance(value, types.ModuleType)]
+    # str. loads the builtins stubs, which every completion uses
+    for text in ['str.'] + [name + '.' for name in modules]:
+        if text in _warmed_up:
+            continue
+        _warmed_up.add(text)
+        # Release the lock between modules, so that a completion doesn't
+        # have to wait for all of them
+        with JEDI_LOCK:
+            try:
+                jedi.Interpreter(text, namespaces=[namespace]).complete()
+            except Exception:
+                pass
+
+class SessionDocument:
+    """
+    The session history (In) as one document, which is put before the current
+    text for Jedi, so that it can infer things that were defined
+    interactively
+
+    add() is called for each new In entry (by post_command()), so that the
+    document isn't rebuilt from In on every completion. It only keeps the
+    last JEDI_HISTORY_LINES lines. When it gets longer than that, the oldest
+    entries are dropped until it is half that, so that the start of the
+    document only changes every JEDI_HISTORY_LINES/2 lines. Jedi caches the
+    parsed document (by path), and only reparses the parts that changed, so
+    a new entry at the end is cheap to parse, but a change at the start
+    isn't.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # (prompt number, command, number of lines)
+        self._entries = deque()
+        self.text = ''
+        self.lines = 0
+        # The number of In entries that have been added, and the last one
+        self.count = 0
+        self.last = None
+
+    def add(self, number, command):
+        if number == self.last:
+            # In[number] was replaced (e.g., by an empty command)
+            if self._entries and self._entries[-1][0] == number:
+                self.lines -= self._entries.pop()[2]
+            self._entries.append((number, command, command.count('\n') + 1))
+            self._rebuild()
+            return
+
+        self.count += 1
+        self.last = number
+        n = command.count('\n') + 1
+        self._entries.append((number, command, n))
+        self.text += command + '\n'
+        self.lines += n
+        if JEDI_HISTORY_LINES is not None and self.lines > JEDI_HISTORY_LINES:
+            while len(self._entries) > 1 and self.lines > JEDI_HISTORY_LINES//2:
+                self.lines -= self._entries.popleft()[2]
+            self._rebuild()
+
+    def _rebuild(self):
+        self.text = ''.join(command + '\n' for _, command, _ in self._entries)
+        self.lines = sum(n for _, _, n in self._entries)
+
+    def sync(self, In):
+        """
+        Make sure the document is up to date with In
+
+        This only rebuilds the document if In was changed by something other
+        than add() (like loading a snapshot).
+        """
+        if len(In) != self.count or (In and self.last not in In):
+            self.clear()
+            for number, command in sorted(In.items()):
+                self.add(number, command)
+        return self
+
+def get_jedi_script_from_document(document, _locals, _globals, session):
+    jedi = import_jedi()
+
+    In = session.builtins['In']
+    session_document = getattr(session, 'jedi_document', None)
+    if session_document is None:
+        session_document = session.jedi_document = SessionDocument()
+    session_document.sync(In)
+    full_document = session_document.text
 
     text = document.text
     for magic in MAGICS:
@@ -51,7 +184,7 @@ def get_jedi_script_from_document(document, _locals, _globals, session):
             text = ' '*len(magic) + text[len(magic):]
             break
 
-    line = document.cursor_position_row + 2 + len(full_document.splitlines())
+    line = document.cursor_position_row + 2 + session_document.lines
     column = document.cursor_position_col
 
     try:
@@ -63,9 +196,18 @@ def get_jedi_script_from_document(document, _locals, _globals, session):
         # Workaround for many issues (see original code)
         return None
 
+# The name being completed at the end of the text before the cursor
+WORD = re.compile(r'\w*$')
+
 class PythonCompleter(Completer):
     """
     Completer for Python code.
+
+    The Python completions (from dir() and Jedi) are cached with the text
+    before the cursor and the namespace version of the session (which is
+    incremented after each command). Completing the same text again uses
+    the cache, and so does typing more of the name that was completed: the
+    completions for the longer name are the cached ones that still match.
     """
     def __init__(self, get_globals, get_locals, session):
         super(PythonCompleter, self).__init__()
@@ -73,15 +215,20 @@ class PythonCompleter(Completer):
         self.get_globals = get_globals
         self.get_locals = get_locals
         self.session = session
+        # (text before the cursor, namespace version, completions)
+        self._cache = None
 
     def _complete_python_while_typing(self, document):
         char_before_cursor = document.char_before_cursor
         return document.text and (
             char_before_cursor.isalnum() or char_before_cursor in '_.')
 
-    def get_completions(self, document, complete_event):
+    def get_completions(self, document, complete_event, should_stop=None):
         """
         Get Python completions.
+
+        If should_stop is given, Jedi isn't used if should_stop() returns
+        True by the time the dir() completions are done.
         """
         if ' ' not in document.text_before_cursor:
             for magic in MAGICS:
@@ -108,66 +255,208 @@ class PythonCompleter(Completer):
                 break
 
         if complete_event.completion_requested or self._complete_python_while_typing(document):
+            yield from self._cached_python_completions(document,
+                text_before_cursor, should_stop)
 
-            # First do the dir completions (should be faster, and more
-            # accurate)
-            completer = DirCompleter(namespace=self.get_locals())
-            state = 0
-            dir_completions = set()
-            while True:
-                completion = completer.complete(text_before_cursor, state)
-                if completion:
-                    name = completer.NAME.match(text_before_cursor[::-1]).group(0)[::-1]
-                    dir_completions.add(completion)
-                    if len(completion) < len(text_before_cursor):
-                        state += 1
-                        continue
-                    yield Completion(completion,
-                        -len(name),
-                        display_meta='from dir()')
+    def _narrow(self, cached_text, text, completions):
+        """
+        Return the cached completions for cached_text that match text, or
+        None if they might not include every completion for text
+        """
+        extra = text[len(cached_text):]
+        word = WORD.search(cached_text).group()
+        # dir() completion leaves out _ names after "x." and __ names after
+        # "x._", so it is only narrowed after at least one other character.
+        if not (text.startswith(cached_text) and extra and word.strip('_')
+                and (word + extra).isidentifier()):
+            return None
+        narrowed = []
+        for c in completions:
+            start_position = c.start_position - len(extra)
+            typed = text[len(text) + start_position:].lower()
+            if c.text.lower().startswith(typed):
+                narrowed.append(Completion(c.text, start_position,
+                    display=c.display, display_meta=c.display_meta,
+                    style=c.style, selected_style=c.selected_style))
+        return narrowed
+
+    def _cached_python_completions(self, document, text_before_cursor,
+                                   should_stop=None):
+        text = document.text_before_cursor
+        version = getattr(self.session, 'namespace_version', None)
+        if self._cache and version is not None and self._cache[1] == version:
+            cached_text, _, completions = self._cache
+            if text != cached_text:
+                completions = self._narrow(cached_text, text, completions)
+            if completions is not None:
+                self._cache = (text, version, completions)
+                yield from completions
+                return
+
+        stopped = False
+        def stop():
+            nonlocal stopped
+            stopped = should_stop()
+            return stopped
+
+        completions = []
+        for completion in self._python_completions(document,
+                text_before_cursor, stop if should_stop else None):
+            completions.append(completion)
+            yield completion
+        # Only cache the completions if they were all computed (the
+        # generator isn't closed early, and Jedi wasn't skipped)
+        if not stopped:
+            self._cache = (text, version, completions)
+
+    def _python_completions(self, document, text_before_cursor, should_stop=None):
+        # First do the dir completions (should be faster, and more
+        # accurate)
+        completer = DirCompleter(namespace=self.get_locals(),
+            name_index=getattr(self.session, 'name_index', None))
+        state = 0
+        dir_completions = set()
+        while True:
+            completion = completer.complete(text_before_cursor, state)
+            if completion:
+                name = completer.NAME.match(text_before_cursor[::-1]).group(0)[::-1]
+                dir_completions.add(completion)
+                if len(completion) < len(text_before_cursor):
                     state += 1
-                else:
-                    break
+                    continue
+                yield Completion(completion,
+                    -len(name),
+                    display_meta='from dir()')
+                state += 1
+            else:
+                break
 
+        with JEDI_LOCK:
+            # Checked after getting the lock, since an older completion
+            # might have been using Jedi
+            if should_stop and should_stop():
+                return
             script, line, column = get_jedi_script_from_document(document,
                 self.get_locals(), self.get_globals(), self.session)
 
-            if script:
-                try:
+        if script:
+            try:
+                with JEDI_LOCK:
                     completions = script.complete(line=line, column=column)
-                except Exception:
-                    with patch_stdout():
-                        print("Error with Jedi completion:\n")
-                        traceback.print_exc()
-                except TypeError:
-                    # Issue #9: bad syntax causes completions() to fail in jedi.
-                    # https://github.com/jonathanslenders/python-prompt-toolkit/issues/9
-                    pass
-                except UnicodeDecodeError:
-                    # Issue #43: UnicodeDecodeError on OpenBSD
-                    # https://github.com/jonathanslenders/python-prompt-toolkit/issues/43
-                    pass
-                except AttributeError:
-                    # Jedi issue #513: https://github.com/davidhalter/jedi/issues/513
-                    pass
-                except ValueError:
-                    # Jedi issue: "ValueError: invalid \x escape"
-                    pass
-                except KeyError:
-                    # Jedi issue: "KeyError: u'a_lambda'."
-                    # https://github.com/jonathanslenders/ptpython/issues/89
-                    pass
-                except IOError:
-                    # Jedi issue: "IOError: No such file or directory."
-                    # https://github.com/jonathanslenders/ptpython/issues/71
-                    pass
-                except NotImplementedError:
-                    pass
+            except Exception:
+                with patch_stdout():
+                    print("Error with Jedi completion:\n")
+                    traceback.print_exc()
+            except TypeError:
+                # Issue #9: bad syntax causes completions() to fail in jedi.
+                # https://github.com/jonathanslenders/python-prompt-toolkit/issues/9
+                pass
+            except UnicodeDecodeError:
+                # Issue #43: UnicodeDecodeError on OpenBSD
+                # https://github.com/jonathanslenders/python-prompt-toolkit/issues/43
+                pass
+            except AttributeError:
+                # Jedi issue #513: https://github.com/davidhalter/jedi/issues/513
+                pass
+            except ValueError:
+                # Jedi issue: "ValueError: invalid \x escape"
+                pass
+            except KeyError:
+                # Jedi issue: "KeyError: u'a_lambda'."
+                # https://github.com/jonathanslenders/ptpython/issues/89
+                pass
+            except IOError:
+                # Jedi issue: "IOError: No such file or directory."
+                # https://github.com/jonathanslenders/ptpython/issues/71
+                pass
+            except NotImplementedError:
+                pass
+            else:
+                for c in completions:
+                    if c.name_with_symbols in dir_completions:
+                        continue
+                    yield Completion(c.name_with_symbols,
+                        len(c.complete) - len(c.name_with_symbols),
+                        display=c.name_with_symbols,
+                        display_meta=c.description)
+
+class AsYouTypeCompleter(Completer):
+    """
+    Runs completer (a PythonCompleter) in a thread, for completing as you
+    type (%autocomplete)
+
+    The completion for a keystroke waits AUTOCOMPLETE_DELAY first, and does
+    nothing if the text changes in the meantime (prompt_toolkit then starts
+    it again for the new text). Each completion is a new generation, and a
+    completion from an older generation that is still running in its thread
+    stops before it gets to Jedi. The dir() completions are shown as soon as
+    they are ready, and the Jedi completions are added when they arrive,
+    unless they take longer than AUTOCOMPLETE_BUDGET. In that case, the
+    thread still finishes them, so that they are cached for the next
+    keystroke, but nothing waits for it.
+
+    Completions requested with TAB are done like with ThreadedCompleter.
+    """
+    def __init__(self, completer, buffer):
+        self.completer = completer
+        self.buffer = buffer
+        self.generation = 0
+
+    def get_completions(self, document, complete_event):
+        return self.completer.get_completions(document, complete_event)
+
+    async def get_completions_async(self, document, complete_event):
+        self.generation += 1
+        generation = self.generation
+        deadline = None
+        if not complete_event.completion_requested:
+            await asyncio.sleep(AUTOCOMPLETE_DELAY)
+            if generation != self.generation or self.buffer.document != document:
+                return
+            deadline = time.monotonic() + AUTOCOMPLETE_BUDGET
+
+        def should_stop():
+            return generation != self.generation
+
+        # prompt_toolkit's generator_to_async_generator() waits for the thread
+        # when it is closed, so use a queue that the thread stops sending to
+        # instead.
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        closed = False
+
+        def send(item):
+            nonlocal closed
+            if closed:
+                return
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # The event loop is closed (the prompt exited)
+                closed = True
+
+        def run():
+            try:
+                for completion in self.completer.get_completions(document,
+                        complete_event, should_stop=should_stop):
+                    send(completion)
+            finally:
+                send(None)
+
+        threading.Thread(target=run, name='mypython-autocomplete',
+                         daemon=True).start()
+        try:
+            while True:
+                if deadline is None:
+                    completion = await queue.get()
                 else:
-                    for c in completions:
-                        if c.name_with_symbols in dir_completions:
-                            continue
-                        yield Completion(c.name_with_symbols,
-                            len(c.complete) - len(c.name_with_symbols),
-                            display=c.name_with_symbols,
-                            display_meta=c.description)
+                    try:
+                        completion = await asyncio.wait_for(queue.get(),
+                            deadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        return
+                if completion is None:
+                    return
+                yield completion
+        finally:
+            closed = True
@@ -90,13 +90,30 @@ Notes:
 
 """
 import re
+import types
+import bisect
+import itertools
+import weakref
 import builtins
 import __main__
+from collections import OrderedDict
 
 __all__ = ["DirCompleter"]
 
+# Instance __dict__s with at least this many names (like modules) get an
+# AttributeIndex. The indexes of the last DICT_INDEX_CACHE_SIZE of them are
+# kept, for objects that can be weakly referenced.
+DICT_INDEX_MIN = 64
+DICT_INDEX_CACHE_SIZE = 32
+
+# type -> (the sizes of the __dict__s of its mro, AttributeIndex)
+_type_indexes = weakref.WeakKeyDictionary()
+# id(obj) -> (weakref to obj, id(obj.__dict__), _dict_state(obj.__dict__),
+# AttributeIndex)
+_dict_indexes = OrderedDict()
+
 class DirCompleter:
-    def __init__(self, namespace = None):
+    def __init__(self, namespace = None, name_index = None):
         """Create a new completer for the command line.
 
         Completer([namespace]) -> completer instance.
@@ -122,6 +139,9 @@ class DirCompleter:
         else:
             self.use_main_ns = 0
             self.namespace = namespace
+        # A NameIndex of namespace, which is kept by the session, so that
+        # it doesn't have to be rebuilt for every completion
+        self.name_index = name_index
 
     NAME = re.compile(r'[a-zA-Z0-9_\.]*[a-zA-Z_]')
     def complete(self, text, state):
@@ -178,12 +198,21 @@ class DirCompleter:
                                   'else'}:
                     word = word + ' '
                 matches.append(word)
-        for nspace in [self.namespace, builtins.__dict__]:
-            for word, val in nspace.items():
+        if self.name_index is None or self.use_main_ns:
+            for word in self.namespace:
                 lower_word = word.lower()
                 if lower_word[:n] == lower_text and word not in seen:
                     seen.add(word)
                     matches.append(word)
+        else:
+            for word in self.name_index.sync(self.namespace).matches(text):
+                if word not in seen and word in self.namespace:
+                    seen.add(word)
+                    matches.append(word)
+        for word in _builtins_index.sync(builtins.__dict__).matches(text):
+            if word not in seen:
+                seen.add(word)
+                matches.append(word)
         return matches
 
     ATTRIBUTE = re.compile(r"(\w+(\.\w+)*)\.(\w*)")
@@ -217,12 +246,9 @@ class DirCompleter:
                 return []
 
         # get the content of the object, except __builtins__
-        words = set(dir(thisobject))
+        words = attribute_matches(thisobject, lower_attr)
         words.discard("__builtins__")
 
-        if hasattr(thisobject, '__class__'):
-            words.add('__class__')
-            words.update(get_class_members(thisobject.__class__))
         matches = []
         n = len(attr)
         if attr == '':
@@ -247,6 +273,198 @@ class DirCompleter:
         matches.sort()
         return matches
 
+class AttributeIndex:
+    """
+    Names sorted case insensitively, so that the ones that start with a
+    prefix can be found with a bisection
+
+    >>> index = AttributeIndex(['b', 'Ab', 'aa', 'c', 'A'])
+    >>> index.matches('a')
+    ['A', 'aa', 'Ab']
+    >>> index.matches('AB')
+    ['Ab']
+    >>> index.matches('')
+    ['A', 'aa', 'Ab', 'b', 'c']
+    """
+    def __init__(self, words):
+        pairs = sorted((word.lower(), word) for word in set(words)
+                       if isinstance(word, str))
+        self.keys = [key for key, word in pairs]
+        self.words = [word for key, word in pairs]
+
+    def matches(self, prefix):
+        """
+        The names that start with prefix (case insensitive)
+        """
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.keys, prefix)
+        stop = bisect.bisect_right(self.keys, prefix + '\U0010ffff', start)
+        return self.words[start:stop]
+
+class NameIndex(AttributeIndex):
+    """
+    AttributeIndex of the names in a namespace, which is updated as the
+    namespace changes
+
+    update() adds and removes the names that were added to and removed from
+    the namespace. It is called after every command (see post_command()), so
+    it only looks at the whole namespace if names were removed. Otherwise,
+    the new names are the last ones in the namespace (dicts keep the order
+    that keys are added in).
+
+    >>> namespace = {'a': 1, 'B': 2}
+    >>> index = NameIndex(namespace)
+    >>> del namespace['a']
+    >>> namespace['Ab'] = namespace['ac'] = 3
+    >>> index.update(namespace).matches('a')
+    ['Ab', 'ac']
+    """
+    def __init__(self, namespace=()):
+        super().__init__(namespace)
+        self.names = set(self.words)
+        # The number of keys in the namespace at the last update
+        self.size = len(namespace)
+
+    def update(self, namespace):
+        added = len(namespace) - self.size
+        if added >= 0:
+            keys = reversed(namespace)
+            new = list(itertools.islice(keys, added))
+            # If any names were removed, the key before the ones that were
+            # added is also new
+            before = next(keys, None)
+            if before is None or before in self.names:
+                for name in new:
+                    if isinstance(name, str) and name not in self.names:
+                        self._add(name)
+                self.size = len(namespace)
+                return self
+        names = {name for name in namespace if isinstance(name, str)}
+        for name in self.names - names:
+            self._remove(name)
+        for name in names - self.names:
+            self._add(name)
+        self.size = len(namespace)
+        return self
+
+    def _add(self, name):
+        key = name.lower()
+        i = bisect.bisect_left(self.keys, key)
+        j = bisect.bisect_right(self.keys, key, i)
+        i = bisect.bisect_left(self.words, name, i, j)
+        self.keys.insert(i, key)
+        self.words.insert(i, name)
+        self.names.add(name)
+
+    def _remove(self, name):
+        key = name.lower()
+        i = bisect.bisect_left(self.keys, key)
+        j = bisect.bisect_right(self.keys, key, i)
+        i = self.words.index(name, i, j)
+        del self.keys[i], self.words[i]
+        self.names.remove(name)
+
+    def sync(self, namespace):
+        """
+        update() if names were added to or removed from namespace since the
+        last update (only the number of names is checked)
+        """
+        if self.size != len(namespace):
+            self.update(namespace)
+        return self
+
+_builtins_index = NameIndex()
+
+def type_index(klass):
+    """
+    Return an AttributeIndex of dir(klass)
+
+    The index is cached, and rebuilt when the number of names in the
+    __dict__ of any class in the mro changes.
+    """
+    try:
+        sizes = tuple(len(vars(c)) for c in klass.__mro__)
+    except (AttributeError, TypeError):
+        return AttributeIndex(dir(klass))
+    cached = _type_indexes.get(klass)
+    if cached is not None and cached[0] == sizes:
+        return cached[1]
+    index = AttributeIndex(dir(klass))
+    try:
+        _type_indexes[klass] = (sizes, index)
+    except TypeError:
+        pass
+    return index
+
+def _dict_state(d):
+    """
+    A cheap signal that the keys of d have changed
+
+    Keys are added at the end, so adding keys changes the last one, unless
+    it is deleted and added again.
+    """
+    return len(d), next(reversed(d), None)
+
+def dict_matches(obj, d, prefix):
+    """
+    Return the keys of d, the __dict__ of obj, that start with prefix (case
+    insensitive)
+
+    Large dicts are indexed, and the indexes of the ones that were used last
+    are cached, until _dict_state(d) changes. Keys that were deleted since
+    the index was made are left out.
+    """
+    if len(d) < DICT_INDEX_MIN:
+        prefix = prefix.lower()
+        return [word for word in d if isinstance(word, str) and
+                word.lower().startswith(prefix)]
+    key = id(obj)
+    state = _dict_state(d)
+    cached = _dict_indexes.get(key)
+    if (cached is not None and cached[0]() is obj and cached[1] == id(d) and
+        cached[2] == state):
+        _dict_indexes.move_to_end(key)
+        index = cached[3]
+    else:
+        index = AttributeIndex(list(d))
+        try:
+            ref = weakref.ref(obj)
+        except TypeError:
+            return index.matches(prefix)
+        _dict_indexes[key] = (ref, id(d), state, index)
+        if len(_dict_indexes) > DICT_INDEX_CACHE_SIZE:
+            _dict_indexes.popitem(last=False)
+    return [word for word in index.matches(prefix) if word in d]
+
+def attribute_matches(obj, prefix):
+    """
+    Return the set of attributes of obj that start with prefix (case
+    insensitive)
+
+    This is the names from dir(obj), and the members of its class. The names
+    from classes come from a cached index (type_index()), and the names in
+    the __dict__ of an instance are added separately, so that only objects
+    with a custom __dir__ have to call dir() every time.
+    """
+    klass = type(obj)
+    words = set(type_index(klass).matches(prefix))
+    if '__class__'.startswith(prefix.lower()):
+        words.add('__class__')
+    if isinstance(obj, type):
+        words.update(type_index(obj).matches(prefix))
+        return words
+
+    standard_dir = klass.__dir__ is object.__dir__ or (
+        isinstance(obj, types.ModuleType) and klass.__dir__ is types.ModuleType.__dir__
+        and '__dir__' not in vars(obj))
+    d = getattr(obj, '__dict__', None) if standard_dir else None
+    if isinstance(d, dict):
+        words.update(dict_matches(obj, d, prefix))
+    elif not standard_dir:
+        prefix = prefix.lower()
+        words.update(word for word in dir(obj) if word.lower().startswith(prefix))
+    return words
+
 def get_class_members(klass):
     ret = dir(klass)
     if hasattr(klass,'__bases__'):
@@ -0,0 +1,323 @@
+"""
+Fuzzy history search (C-x C-r and %hfind)
+
+FuzzyHistoryIndex has the distinct entries of the whole history (including
+the entries that IndexedFileHistory hasn't loaded), with the last time each
+was used and how many times. An entry matches a query if the characters of
+the query appear in it in order (case insensitive). The entries are joined
+into a few large strings (separated by NUL), so that finding the matches is
+done by a few regular expression searches, and only the matches are scored.
+
+Matches are ranked by a mix of how well they match (how close together the
+matched characters are, and if the match starts at the start of a word),
+how recently they were used, and how often (see FUZZY_WEIGHTS).
+
+C-x C-r shows the best matches for the current line in the completion menu,
+and updates them as you type. The scoring runs in the completion thread.
+Every change to the text starts a new generation, and a search that is
+superseded stops at the next check (see FuzzyHistoryIndex.search()).
+"""
+
+import re
+import math
+import heapq
+import bisect
+import textwrap
+import threading
+
+from prompt_toolkit.completion import Completer, Completion
+
+from .history import history_chunks
+
+# The number of matches that are shown
+FUZZY_LIMIT = 100
+
+# The weights of the match score, the recency, and the frequency, each of
+# which is between 0 and 1
+FUZZY_WEIGHTS = (1.0, 0.5, 0.25)
+
+# How many entries ago an entry has to have been used for its recency to be
+# 1/2
+FUZZY_RECENCY_SCALE = 100
+
+# The number of entries in each chunk that is searched (see
+# FuzzyHistoryIndex)
+FUZZY_CHUNK = 2000
+
+# How often a search of the matches of a shorter query checks if it has been
+# superseded, in entries
+FUZZY_CHECK_INTERVAL = 1000
+
+WORD_START = re.compile(r'(?<![\w.])\w')
+
+class Cancelled(Exception):
+    pass
+
+def fuzzy_pattern(query):
+    r"""
+    Return a regular expression that matches the characters of query in
+    order, in a single entry
+
+    The pattern is lowercase, so it should be matched against lowercased
+    text. Each character matches the first occurrence after the previous
+    one, which doesn't need any backtracking. Group 1 is the match. The rest
+    of the entry is also matched, so that finditer() gives at most one match
+    per entry.
+
+    >>> fuzzy_pattern('aB.').pattern
+    '(a[^b\\x00]*b[^\\.\\x00]*\\.)[^\\x00]*'
+    """
+    query = query.lower()
+    parts = [re.escape(query[0])]
+    for c in query[1:]:
+        parts.append('[^%s\\x00]*%s' % (re.escape(c), re.escape(c)))
+    return re.compile('(%s)[^\\x00]*' % ''.join(parts))
+
+def match_score(query, text, start, end):
+    """
+    Return the score (between 0 and 1) of a match of query in text from
+    start to end
+
+    A contiguous match scores the highest, and a match that starts at the
+    start of a word scores higher than one that doesn't.
+
+    >>> match_score('abc', 'abc', 0, 3)
+    1.0
+    >>> match_score('abc', 'xabc', 1, 4) < match_score('abc', 'x abc', 2, 5) == 1
+    True
+    >>> match_score('abc', 'a_b_c', 0, 5) < match_score('abc', 'abc', 0, 3)
+    True
+    """
+    score = len(query)/(end - start)
+    if not WORD_START.match(text, start):
+        score *= 0.8
+    return score
+
+class FuzzyHistoryIndex:
+    """
+    The distinct entries of a history, for fuzzy searching
+
+    Entries are added with add(), newest last. search() can run in another
+    thread. It only holds the lock while it takes the entries, so add()
+    doesn't wait for it.
+
+    For searching, the entries are sorted by their rank without the match
+    score (how recently and how often they were used), and split into chunks
+    of FUZZY_CHUNK entries. The chunks are searched in order, and the search
+    stops when no entry in the remaining chunks could rank higher than the
+    matches that were already found even if it matched perfectly. So a query
+    that matches a lot of entries only needs to look at the first chunks.
+    """
+    def __init__(self):
+        self.entries = []
+        self.last_used = []
+        self.counts = []
+        self._positions = {}
+        self.newest = -1
+        self.generation = 0
+        self._lock = threading.RLock()
+        # Incremented by add()
+        self._version = 0
+        self._chunks = None
+        # (query, indices of the entries that match it) for the last search
+        # that looked at every entry, so that a longer query only looks at
+        # those
+        self._last_matches = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, string):
+        with self._lock:
+            self.newest += 1
+            i = self._positions.get(string)
+            if i is None:
+                self._positions[string] = len(self.entries)
+                self.entries.append(string)
+                self.last_used.append(self.newest)
+                self.counts.append(1)
+                self._last_matches = None
+            else:
+                self.last_used[i] = self.newest
+                self.counts[i] += 1
+            self._version += 1
+            self._chunks = None
+
+    def cancel(self):
+        """
+        Stop any search that is running
+        """
+        self.generation += 1
+
+    @staticmethod
+    def prior(age, count):
+        """
+        The rank of an entry that was last used age entries ago, and used
+        count times, without the match score
+        """
+        w_match, w_recency, w_frequency = FUZZY_WEIGHTS
+        recency = FUZZY_RECENCY_SCALE/(FUZZY_RECENCY_SCALE + age)
+        count = math.log1p(count)
+        frequency = count/(1 + count)
+        return w_recency*recency + w_frequency*frequency
+
+    def chunks(self):
+        """
+        Return the chunks of entries (see the class docstring), and the
+        priors of the entries
+        """
+        with self._lock:
+            if self._chunks is not None:
+                return self._chunks
+            version = self._version
+            entries = self.entries[:]
+            newest = self.newest
+            last_used = self.last_used[:]
+            counts = self.counts[:]
+
+        priors = [self.prior(newest - used, count)
+                  for used, count in zip(last_used, counts)]
+        order = sorted(range(len(entries)), key=priors.__getitem__, reverse=True)
+        chunks = []
+        for start in range(0, len(order), FUZZY_CHUNK):
+            indices = order[start:start + FUZZY_CHUNK]
+            offsets = []
+            pos = 0
+            for i in indices:
+                offsets.append(pos)
+                pos += len(entries[i]) + 1
+            text = '\0'.join([entries[i] for i in indices]).lower()
+            chunks.append((text, offsets, indices))
+
+        with self._lock:
+            if self._version == version:
+                self._chunks = chunks, priors
+        return chunks, priors
+
+    def search(self, query, limit=FUZZY_LIMIT, generation=None):
+        """
+        Return the best limit entries for query, best first
+
+        If generation is given and cancel() is called (from another thread)
+        before the search finishes, Cancelled is raised.
+        """
+        with self._lock:
+            if generation is None:
+                generation = self.generation
+            version = self._version
+            # add() only appends to entries, so the indices in the chunks
+            # stay valid
+            entries = self.entries
+            last = self._last_matches
+        chunks, priors = self.chunks()
+        if not query:
+            return [entries[i] for text, offsets, indices in chunks
+                    for i in indices][:limit]
+
+        w_match = FUZZY_WEIGHTS[0]
+        pattern = fuzzy_pattern(query)
+        best = []
+        matched = []
+        complete = True
+
+        def found(i, text, start, end):
+            matched.append(i)
+            score = w_match*match_score(query, text, start, end) + priors[i]
+            if len(best) < limit:
+                heapq.heappush(best, (score, i))
+            elif score > best[0][0]:
+                heapq.heapreplace(best, (score, i))
+
+        if last and query.lower().startswith(last[0]):
+            # Only the entries that matched a prefix of the query can match
+            for n, i in enumerate(last[1]):
+                if n % FUZZY_CHECK_INTERVAL == 0 and generation != self.generation:
+                    raise Cancelled
+                text = entries[i].lower()
+                m = pattern.search(text)
+                if m:
+                    found(i, text, *m.span(1))
+        else:
+            for text, offsets, indices in chunks:
+                if len(best) == limit and best[0][0] >= w_match + priors[indices[0]]:
+                    # Nothing in the remaining chunks can rank higher
+                    complete = False
+                    break
+                if generation != self.generation:
+                    raise Cancelled
+                for m in pattern.finditer(text):
+                    start, end = m.span(1)
+                    j = bisect.bisect_right(offsets, start) - 1
+                    found(indices[j], text, start, end)
+
+        if complete:
+            with self._lock:
+                # Entries added during the search aren't in matched
+                if self._version == version:
+                    self._last_matches = query.lower(), matched
+        return [entries[i] for score, i in sorted(best, reverse=True)]
+
+def build_fuzzy_index(history):
+    """
+    Return a FuzzyHistoryIndex of all the entries in history, including the
+    ones that haven't been loaded
+    """
+    index = FuzzyHistoryIndex()
+    total, chunks = history_chunks(history)
+    for chunk in chunks:
+        for string in chunk:
+            index.add(string)
+    return index
+
+class FuzzyHistoryCompleter(Completer):
+    """
+    Completer for C-x C-r
+
+    The completions replace the current line (after its indentation) with
+    the history entries that match it, indented like the current line.
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def get_completions(self, document, complete_event):
+        index = self.buffer.fuzzy_index()
+        generation = index.generation
+        line = document.current_line_before_cursor
+        query = line.lstrip()
+        indent = line[:len(line) - len(query)]
+        try:
+            entries = index.search(query, generation=generation)
+        except Cancelled:
+            return
+        for entry in entries:
+            text = textwrap.indent(entry, indent)[len(indent):]
+            if text == query:
+                continue
+            first_line, *rest = entry.split('\n')
+            yield Completion(text, -len(query), display=first_line,
+                             display_meta='(%d more lines)' % len(rest) if rest else '')
+
+def print_hfind(session, query, limit=20, file=None):
+    """
+    Print the best fuzzy matches for query from the history of this terminal
+    (for %hfind), best last
+    """
+    import sys
+    from .mypython import blue
+
+    file = file or sys.stdout
+    buffer = getattr(session, 'default_buffer', None)
+    if buffer is not None and hasattr(buffer, 'fuzzy_index'):
+        index = buffer.fuzzy_index()
+    else:
+        index = build_fuzzy_index(session.history)
+    # Don't show the %hfind itself
+    entries = [entry for entry in index.search(query, limit=limit + 1)
+               if not entry.startswith('%hfind')][:limit]
+    if not entries:
+        print("No history entries match %r" % query, file=sys.stderr)
+        return
+    for n, entry in reversed(list(enumerate(entries, 1))):
+        print(blue('# %d' % n), file=file)
+        print(entry, file=file)
+
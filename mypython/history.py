@@ -0,0 +1,1056 @@
+"""
+History stored in a file with an index (IndexedFileHistory)
+
+prompt_toolkit's FileHistory reads the whole history file into memory when the
+first prompt is shown, so startup time and memory grow with the size of the
+history. IndexedFileHistory uses the same file format, but keeps a sidecar
+index file (<history file>.idx) with the offset of every entry, so that only
+the most recent HISTORY_WINDOW entries are read at startup. Older entries are
+read when history navigation reaches them (see MyBuffer._load_older_history()
+and IndexedFileHistory.load_older()).
+
+The index is brought up to date with anything that was appended to the
+history file by something else (like an older mypython, or another mypython
+process that shares the file) whenever it is opened or written to. If the
+history file is replaced or truncated, the index is rebuilt.
+
+Duplicate entries are removed from the part of the history that isn't loaded
+by compact(), which runs in a background thread when the history has grown
+enough since it was last compacted. Compaction changes the indices of the
+entries, so it is only done when no other mypython process has loaded the
+history file. Each one holds a shared lock on <history file>.lock for that.
+
+New entries are written by a HistoryWriter in a background thread, so that a
+slow file system (like a network home directory) doesn't slow down the
+prompt. Entries that are queued at the same time are written together, and
+the file is fsynced at most every HISTORY_FSYNC_INTERVAL seconds. Everything
+that is queued is written at exit, including when mypython is killed with
+SIGTERM. Writes (and every update of the index) are done with the index file
+locked (flock), so mypython processes that share a history file don't
+interleave their entries.
+
+The index file format is HEADER (the magic bytes, the size of the history
+file that is indexed, and the number of entries after the last compaction)
+followed by the offset of the first line of each entry as an unsigned 64-bit
+integer.
+
+HistoryIndex is a full-text index (SQLite FTS5) of the history files of every
+terminal, which is used by %hgrep and M-r to search all of them at once.
+"""
+
+import os
+import sys
+import glob
+import time
+import atexit
+import signal
+import weakref
+import bisect
+import struct
+import hashlib
+import functools
+import datetime
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    # Windows
+    fcntl = None
+
+from prompt_toolkit.history import FileHistory
+
+# Number of entries that are loaded at startup
+HISTORY_WINDOW = 1000
+
+# Only compact the history when it has at least this many entries, and it has
+# grown by COMPACT_GROWTH since it was last compacted.
+COMPACT_MIN_ENTRIES = 10000
+COMPACT_GROWTH = 1.5
+
+# The default search index file, in the directory with the history files
+HISTORY_INDEX_FILE = 'index.sqlite'
+
+# The maximum number of results shown by %hgrep
+HGREP_LIMIT = 50
+
+# The cache of highlighted entries for %history, in the directory with the
+# history files
+HIGHLIGHT_CACHE_FILE = 'highlight.sqlite'
+
+# Change this when the highlighting changes, to invalidate the cache
+HIGHLIGHT_VERSION = '1'
+
+# The pager for %history, and the number of entries that are written to it at
+# a time
+HISTORY_PAGER = 'less -R +G'
+HISTORY_PAGER_CHUNK = 500
+
+# The number of most recent entries that %history highlights if they aren't
+# cached
+HISTORY_PAGER_HIGHLIGHT = 1000
+
+# fsync the history file at most every this many seconds after new entries
+# are written. 0 fsyncs after every write, and None never fsyncs (entries are
+# still written at exit).
+HISTORY_FSYNC_INTERVAL = 1.0
+
+# How long to wait at exit for queued entries to be written, in seconds
+HISTORY_FLUSH_TIMEOUT = 5
+
+# The number of characters of each entry that are indexed by PrefixIndex
+PREFIX_INDEX_DEPTH = 10
+
+INDEX_MAGIC = b'mypyidx1'
+HEADER = struct.Struct('<8sQQ')
+OFFSET = struct.Struct('<Q')
+
+def index_lines(data, start=0):
+    """
+    Return the offsets of the entries in the FileHistory formatted bytes data
+
+    The offsets are relative to the start of data, plus start. data should
+    start at the beginning of a line that isn't in the middle of an entry.
+
+    >>> data = b'\\n# 2024-01-01\\n+a\\n\\n# 2024-01-01\\n+b\\n+c\\n'
+    >>> index_lines(data)
+    [14, 31]
+    >>> data[14:16], data[31:33]
+    (b'+a', b'+b')
+    """
+    offsets = []
+    in_entry = False
+    pos = 0
+    for line in data.splitlines(keepends=True):
+        if line.startswith(b'+'):
+            if not in_entry:
+                offsets.append(start + pos)
+                in_entry = True
+        else:
+            in_entry = False
+        pos += len(line)
+    return offsets
+
+def _parse_entry(data):
+    """
+    Return the history string for the entry at the start of data, and the
+    length of the lines of data that belong to it
+
+    >>> _parse_entry(b'+a\\n+  b\\n\\n# 2024-01-01\\n+c\\n')
+    ('a\\n  b', 8)
+    """
+    lines = []
+    end = 0
+    for line in data.splitlines(keepends=True):
+        if not line.startswith(b'+'):
+            break
+        lines.append(line[1:])
+        end += len(line)
+    string = b''.join(lines).decode('utf-8', errors='replace')
+    # Remove the trailing newline, like FileHistory
+    return string[:-1], end
+
+def parse_history(data):
+    """
+    Generate (time, string) for each entry in the FileHistory formatted bytes
+    data
+
+    time is the timestamp from the comment before the entry, or '' if there
+    isn't one.
+
+    >>> list(parse_history(b'\\n# 2024-01-01\\n+a\\n+b\\n+c\\n'))
+    [('2024-01-01', 'a\\nb\\nc')]
+    """
+    time = ''
+    lines = []
+    for line in data.splitlines():
+        if line.startswith(b'+'):
+            lines.append(line[1:])
+            continue
+        if lines:
+            yield time, b'\n'.join(lines).decode('utf-8', errors='replace')
+            lines = []
+        if line.startswith(b'# '):
+            time = line[2:].decode('utf-8', errors='replace')
+    if lines:
+        yield time, b'\n'.join(lines).decode('utf-8', errors='replace')
+
+def _format_entry(string):
+    """
+    Return the header and the lines for string in the FileHistory format
+    """
+    header = '\n# %s\n' % datetime.datetime.now()
+    lines = ''.join('+%s\n' % line for line in string.split('\n'))
+    return header.encode('utf-8'), lines.encode('utf-8')
+
+class IndexedFileHistory(FileHistory):
+    """
+    FileHistory that only loads the most recent entries
+
+    See the module docstring.
+    """
+    def __init__(self, filename, window=HISTORY_WINDOW, compact=True,
+                 fsync_interval=HISTORY_FSYNC_INTERVAL):
+        super().__init__(filename)
+        self.index_filename = os.fspath(filename) + '.idx'
+        self.window = window
+        self.writer = HistoryWriter(self.write_entries, fsync_interval)
+        self._lock = threading.RLock()
+        # Absolute index of the oldest entry in _loaded_strings that was read
+        # from the file
+        self._oldest_loaded = None
+        self._compact = compact
+        self._compact_thread = None
+        # Holds a shared lock on the .lock file once the history is loaded
+        # (see _only_session())
+        self._session_fd = None
+
+    @contextmanager
+    def locked(self):
+        """
+        Lock the index against other threads and processes
+        """
+        with self._lock:
+            fd = os.open(self.index_filename, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                yield fd
+            finally:
+                os.close(fd)
+
+    def _open_session_lock(self):
+        return os.open(os.fspath(self.filename) + '.lock',
+                       os.O_RDWR | os.O_CREAT, 0o600)
+
+    @contextmanager
+    def _only_session(self):
+        """
+        Yield True if no other IndexedFileHistory (in any process) has loaded
+        the history file, and keep any from loading it until the end of the
+        block. Otherwise, yield False.
+        """
+        if not fcntl:
+            yield True
+            return
+        fd = self._session_fd
+        if fd is None:
+            fd = self._open_session_lock()
+        try:
+            try:
+                # Upgrade our shared lock
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # A failed upgrade can drop the shared lock
+                if fd == self._session_fd:
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_SH if fd == self._session_fd
+                            else fcntl.LOCK_UN)
+        finally:
+            if fd != self._session_fd:
+                os.close(fd)
+
+    def _read_header(self, fd):
+        data = os.pread(fd, HEADER.size, 0)
+        if len(data) < HEADER.size:
+            return None
+        magic, size, compacted = HEADER.unpack(data)
+        if magic != INDEX_MAGIC:
+            return None
+        return size, compacted
+
+    def _update(self, fd):
+        """
+        Index everything that was added to the history file since the index
+        was last updated. Must be called with the lock held.
+
+        Returns the number of entries.
+        """
+        try:
+            data_size = os.stat(self.filename).st_size
+        except FileNotFoundError:
+            data_size = 0
+        header = self._read_header(fd)
+        if header is None or header[0] > data_size:
+            # There is no index, or the history file was replaced by
+            # something smaller. Start over.
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, HEADER.pack(INDEX_MAGIC, 0, 0), 0)
+            size, compacted = 0, 0
+        else:
+            size, compacted = header
+
+        index_size = os.fstat(fd).st_size
+        # Drop a partial offset left by a process that was killed
+        index_size -= (index_size - HEADER.size) % OFFSET.size
+        if size < data_size:
+            with open(self.filename, 'rb') as f:
+                f.seek(size)
+                data = f.read(data_size - size)
+            # Don't index a partially written entry
+            data = data[:data.rfind(b'\n') + 1]
+            offsets = index_lines(data, start=size)
+            if offsets:
+                os.pwrite(fd, b''.join(OFFSET.pack(i) for i in offsets), index_size)
+                index_size += OFFSET.size*len(offsets)
+            os.ftruncate(fd, index_size)
+            os.pwrite(fd, HEADER.pack(INDEX_MAGIC, size + len(data), compacted), 0)
+        return (index_size - HEADER.size)//OFFSET.size
+
+    def _offsets(self, fd, start, stop):
+        data = os.pread(fd, OFFSET.size*(stop - start), HEADER.size + OFFSET.size*start)
+        return [i for i, in OFFSET.iter_unpack(data)]
+
+    def _read_entries(self, fd, start, stop):
+        """
+        Read the entries with indices start to stop (oldest first)
+        """
+        if start >= stop:
+            return []
+        offsets = self._offsets(fd, start, stop)
+        size = self._read_header(fd)[0]
+        end = self._offsets(fd, stop, stop + 1) if stop < self.num_entries() else [size]
+        entries = []
+        with open(self.filename, 'rb') as f:
+            f.seek(offsets[0])
+            data = f.read(end[0] - offsets[0])
+        bounds = [i - offsets[0] for i in offsets + end]
+        for start, stop in zip(bounds, bounds[1:]):
+            entries.append(_parse_entry(data[start:stop])[0])
+        return entries
+
+    def num_entries(self):
+        """
+        The number of entries in the history file that have been indexed
+
+        This isn't __len__, because prompt_toolkit tests if the history is
+        empty with bool(history).
+        """
+        try:
+            index_size = os.stat(self.index_filename).st_size
+        except FileNotFoundError:
+            return 0
+        return max(index_size - HEADER.size, 0)//OFFSET.size
+
+    def get_entries(self, start=0, stop=None):
+        """
+        Return the entries of the history file from start to stop, oldest
+        first
+        """
+        self.flush()
+        with self.locked() as fd:
+            total = self._update(fd)
+            start, stop, _ = slice(start, stop).indices(total)
+            return self._read_entries(fd, start, stop)
+
+    def load_history_strings(self):
+        if fcntl and self._session_fd is None:
+            self._session_fd = self._open_session_lock()
+            fcntl.flock(self._session_fd, fcntl.LOCK_SH)
+        with self.locked() as fd:
+            total = self._update(fd)
+            start = max(total - self.window, 0)
+            self._oldest_loaded = start
+            entries = self._read_entries(fd, start, total)
+            compacted = self._read_header(fd)[1]
+
+        if (self._compact and total >= COMPACT_MIN_ENTRIES and total >=
+            COMPACT_GROWTH*compacted):
+            self.start_compact()
+
+        yield from reversed(entries)
+
+    def has_older(self):
+        """
+        Return True if there are entries that haven't been loaded yet
+        """
+        return bool(self._oldest_loaded)
+
+    def load_older(self, count=HISTORY_WINDOW):
+        """
+        Load up to count entries that are older than the loaded ones
+
+        The entries are added to the end of _loaded_strings, and are returned
+        newest first. Returns [] if everything has been loaded.
+        """
+        if not self.has_older():
+            return []
+        with self.locked() as fd:
+            self._update(fd)
+            start = max(self._oldest_loaded - count, 0)
+            entries = self._read_entries(fd, start, self._oldest_loaded)
+            self._oldest_loaded = start
+        entries.reverse()
+        self._loaded_strings.extend(entries)
+        return entries
+
+    def store_string(self, string):
+        # The entry is formatted now so that it has the time it was entered
+        self.writer.put(_format_entry(string))
+
+    def after_write(self, callback):
+        """
+        Call callback() (in the writer thread) once everything that has been
+        stored so far is written
+        """
+        self.writer.put(callback=callback)
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything that has been stored is written (and fsynced,
+        unless the fsync interval is None)
+
+        Returns False if it timed out.
+        """
+        return self.writer.flush(timeout)
+
+    def write_entries(self, entries, fsync=False):
+        """
+        Append entries (formatted with _format_entry()) to the history file,
+        and fsync the history and index files if fsync is True
+
+        This is called by the writer thread.
+        """
+        with self.locked() as fd:
+            total = self._update(fd)
+            if entries:
+                data = b''.join(header + lines for header, lines in entries)
+                with open(self.filename, 'ab') as f:
+                    size = f.tell()
+                    offsets = []
+                    for header, lines in entries:
+                        offsets.append(size + len(header))
+                        size += len(header) + len(lines)
+                    f.write(data)
+                    f.flush()
+                    if fsync:
+                        os.fsync(f.fileno())
+                compacted = self._read_header(fd)[1]
+                os.pwrite(fd, b''.join(OFFSET.pack(i) for i in offsets),
+                          HEADER.size + OFFSET.size*total)
+                os.pwrite(fd, HEADER.pack(INDEX_MAGIC, size, compacted), 0)
+            elif fsync and os.path.exists(self.filename):
+                with open(self.filename, 'ab') as f:
+                    os.fsync(f.fileno())
+            if fsync:
+                os.fsync(fd)
+
+    def start_compact(self):
+        """
+        Start compact() in a background thread
+        """
+        if self._compact_thread and self._compact_thread.is_alive():
+            return self._compact_thread
+        self._compact_thread = threading.Thread(target=self.compact,
+            name='mypython-history-compact', daemon=True)
+        self._compact_thread.start()
+        return self._compact_thread
+
+    def compact(self):
+        """
+        Remove duplicate entries from the history file
+
+        Only entries older than the loaded ones are removed, when the same
+        string appears again later in the history, so that nothing that is
+        loaded changes. The history file and the index are replaced
+        atomically. Nothing is done if another IndexedFileHistory has loaded
+        the history file, since the indices of its loaded entries would
+        change.
+
+        Returns the number of entries that were removed.
+        """
+        with self._only_session() as only_session, self.locked() as fd:
+            if not only_session:
+                return 0
+            total = self._update(fd)
+            boundary = total if self._oldest_loaded is None else min(self._oldest_loaded, total)
+            offsets = self._offsets(fd, 0, total)
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+            # Anything after the indexed part (a partially written entry) is
+            # kept as is
+            unindexed = len(data) - self._read_header(fd)[0]
+
+            # The end of the lines of each entry. Everything between the end
+            # of one entry and the start of the next (the timestamp) is kept
+            # with the next one.
+            entries = []
+            ends = []
+            for offset, next_offset in zip(offsets, offsets[1:] + [len(data)]):
+                string, length = _parse_entry(data[offset:next_offset])
+                entries.append(string)
+                ends.append(offset + length)
+
+            seen = set(entries[boundary:])
+            keep = []
+            for i in range(boundary - 1, -1, -1):
+                if entries[i] in seen:
+                    continue
+                seen.add(entries[i])
+                keep.append(i)
+            removed = boundary - len(keep)
+            keep.reverse()
+            keep.extend(range(boundary, total))
+
+            if removed:
+                new_data = []
+                new_offsets = []
+                pos = 0
+                for i in keep:
+                    start = ends[i - 1] if i else 0
+                    new_offsets.append(pos + offsets[i] - start)
+                    new_data.append(data[start:ends[i]])
+                    pos += ends[i] - start
+                new_data.append(data[ends[-1]:])
+                new_data = b''.join(new_data)
+
+                tmp = self.filename + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(new_data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.filename)
+            else:
+                new_data = data
+                new_offsets = offsets
+
+            # The index is rewritten in place, since the lock is on it
+            index = HEADER.pack(INDEX_MAGIC, len(new_data) - unindexed, len(keep))
+            index += b''.join(OFFSET.pack(i) for i in new_offsets)
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, index, 0)
+
+            if self._oldest_loaded is not None:
+                self._oldest_loaded -= removed
+        return removed
+
+# Every HistoryWriter, so that they can be flushed at exit
+_writers = weakref.WeakSet()
+
+def flush_history_writers(timeout=HISTORY_FLUSH_TIMEOUT):
+    """
+    Write everything that is queued by any HistoryWriter
+    """
+    deadline = time.monotonic() + timeout
+    for writer in list(_writers):
+        writer.flush(max(deadline - time.monotonic(), 0))
+
+atexit.register(flush_history_writers)
+
+def _sigterm_handler(signum, frame):
+    flush_history_writers()
+    # Die from the signal like we would have without the handler
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+def setup_sigterm_handler():
+    """
+    Flush the history writers on SIGTERM (atexit handlers don't run when a
+    process is killed by a signal)
+
+    Does nothing if SIGTERM already has a handler, or if this isn't the main
+    thread.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _sigterm_handler)
+
+class HistoryWriter:
+    """
+    Write history entries in a background thread
+
+    put() queues an entry. The thread calls write(entries, fsync) with
+    everything that has been queued since the last write. fsync is True at
+    most every fsync_interval seconds (see HISTORY_FSYNC_INTERVAL), and when
+    flush() is called. An error is printed if write() fails, and the entries
+    are dropped.
+
+    The thread is started by the first put(). Any writer that has a thread
+    is flushed at exit and on SIGTERM.
+    """
+    def __init__(self, write, fsync_interval=HISTORY_FSYNC_INTERVAL):
+        self.write = write
+        self.fsync_interval = fsync_interval
+        self._cond = threading.Condition()
+        self._pending = []
+        self._callbacks = []
+        # Number of flush() calls, and the number that have been done
+        self._flush_requested = 0
+        self._flushed = 0
+        self._unsynced = False
+        self._last_fsync = time.monotonic()
+        self._thread = None
+
+    def put(self, entry=None, callback=None):
+        """
+        Queue entry to be written, and callback() to be called (in the
+        writer thread) after it is written
+        """
+        with self._cond:
+            if entry is not None:
+                self._pending.append(entry)
+            if callback is not None:
+                self._callbacks.append(callback)
+            self._start()
+            self._cond.notify()
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything that has been queued is written and fsynced
+
+        Returns False if it timed out.
+        """
+        with self._cond:
+            if self._thread is None:
+                return True
+            self._flush_requested += 1
+            request = self._flush_requested
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._flushed >= request
+                                       or not self._thread.is_alive(), timeout)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                name='mypython-history-writer', daemon=True)
+            self._thread.start()
+            _writers.add(self)
+            setup_sigterm_handler()
+
+    def _fsync_due(self):
+        if not self._unsynced or self.fsync_interval is None:
+            return None
+        return self._last_fsync + self.fsync_interval - time.monotonic()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    flush = self._flush_requested > self._flushed
+                    due = self._fsync_due()
+                    if self._pending or self._callbacks or flush or (
+                            due is not None and due <= 0):
+                        break
+                    self._cond.wait(due)
+                entries, self._pending = self._pending, []
+                callbacks, self._callbacks = self._callbacks, []
+                request = self._flush_requested
+                fsync = (self.fsync_interval is not None
+                         and (entries or self._unsynced)
+                         and (flush or time.monotonic() - self._last_fsync
+                              >= self.fsync_interval))
+
+            try:
+                if entries or fsync:
+                    self.write(entries, fsync=fsync)
+            except Exception as e:
+                print("Error writing the history: %s: %s" % (type(e).__name__,
+                    e), file=sys.stderr)
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    print("Error after writing the history: %s: %s" %
+                          (type(e).__name__, e), file=sys.stderr)
+
+            with self._cond:
+                if fsync:
+                    self._unsynced = False
+                    self._last_fsync = time.monotonic()
+                elif entries:
+                    self._unsynced = True
+                self._flushed = request
+                self._cond.notify_all()
+
+class HistoryIndex:
+    """
+    Full-text index of all the history files in history_dir
+
+    The index is an SQLite database with an FTS5 table of the entries, using
+    the trigram tokenizer, so that searching for any substring is fast. The
+    size of each history file that has been indexed is saved, so update()
+    only reads what has been added since. If a history file is replaced
+    (e.g., by IndexedFileHistory.compact()), it is indexed again.
+    """
+    def __init__(self, history_dir, filename=HISTORY_INDEX_FILE, pattern='*_history'):
+        self.history_dir = os.path.expanduser(history_dir)
+        self.filename = os.path.join(self.history_dir, filename)
+        self.pattern = pattern
+        self._lock = threading.Lock()
+        self._update_thread = None
+
+    def connect(self):
+        import sqlite3
+
+        os.makedirs(self.history_dir, exist_ok=True)
+        conn = sqlite3.connect(self.filename, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS files
+            (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER)""")
+        try:
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS entries USING
+                fts5(text, file UNINDEXED, time UNINDEXED, tokenize='trigram')""")
+        except sqlite3.OperationalError: # pragma: no cover
+            # SQLite older than 3.34 doesn't have the trigram tokenizer.
+            # Searches will still work, but they won't use the index.
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS entries USING
+                fts5(text, file UNINDEXED, time UNINDEXED)""")
+        return conn
+
+    def history_files(self):
+        return sorted(glob.glob(os.path.join(glob.escape(self.history_dir), self.pattern)))
+
+    def update(self, files=None):
+        """
+        Index everything that was added to files (the default is all history
+        files) since the last update
+
+        Returns the number of entries that were added.
+        """
+        if files is None:
+            files = self.history_files()
+        added = 0
+        with self._lock, self.connect() as conn:
+            for path in files:
+                path = os.path.abspath(path)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                row = conn.execute("SELECT inode, size FROM files WHERE path = ?",
+                                   (path,)).fetchone()
+                size = 0
+                if row:
+                    inode, size = row
+                    if inode != st.st_ino or size > st.st_size:
+                        conn.execute("DELETE FROM entries WHERE file = ?", (path,))
+                        size = 0
+                if size == st.st_size:
+                    continue
+                with open(path, 'rb') as f:
+                    f.seek(size)
+                    data = f.read(st.st_size - size)
+                # Don't index a partially written entry. The entry might not
+                # be finished even if the last line is, but new entries are
+                # written all at once.
+                data = data[:data.rfind(b'\n') + 1]
+                rows = [(text, path, time) for time, text in parse_history(data)]
+                conn.executemany("INSERT INTO entries (text, file, time) VALUES (?, ?, ?)", rows)
+                conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                             (path, st.st_ino, size + len(data)))
+                added += len(rows)
+        conn.close()
+        return added
+
+    def update_async(self, files=None):
+        """
+        Run update() in a background thread
+        """
+        self._update_thread = threading.Thread(target=self.update,
+            args=(files,), name='mypython-history-index', daemon=True)
+        self._update_thread.start()
+        return self._update_thread
+
+    def search(self, text, limit=HGREP_LIMIT):
+        """
+        Return a list of (file, time, string) for the most recent distinct
+        entries that contain text, most recent first
+
+        The search is case insensitive.
+        """
+        escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        with self.connect() as conn:
+            rows = conn.execute("""SELECT file, max(time), text FROM entries
+                WHERE text LIKE ? ESCAPE '\\' GROUP BY text
+                ORDER BY max(time) DESC LIMIT ?""",
+                ('%' + escaped + '%', limit)).fetchall()
+        conn.close()
+        return rows
+
+def get_history_index(session):
+    """
+    Return the HistoryIndex for session, updated with everything in the
+    history files
+    """
+    from .mypython import default_history_filename
+
+    index = getattr(session, 'history_index', None)
+    if index is None:
+        index = HistoryIndex(os.path.dirname(default_history_filename()))
+    if hasattr(session.history, 'flush'):
+        session.history.flush()
+    index.update()
+    return index
+
+def print_hgrep(session, text, limit=HGREP_LIMIT, file=None):
+    """
+    Print the most recent entries from the history of every terminal that
+    contain text (for %hgrep)
+    """
+    from .mypython import blue
+
+    file = file or sys.stdout
+    index = get_history_index(session)
+    results = index.search(text, limit=limit)
+    if not results:
+        print("No history entries contain %r" % text, file=sys.stderr)
+        return
+    # Print the most recent match last, right above the prompt
+    for path, entry_time, string in reversed(results):
+        tty = os.path.basename(path)
+        if tty.endswith('_history'):
+            tty = tty[:-len('_history')]
+        print(blue("# %s %s" % (tty, entry_time)), file=file)
+        print(string, file=file)
+
+class PrefixIndex:
+    """
+    Index of history entries by prefix, for history search (M-Up/M-Down)
+
+    Each entry has an integer id, which is larger for newer entries. Newer
+    entries are added with append() and older ones with prepend(). For each
+    prefix of the first `depth` characters of each entry, the index has the
+    sorted list of the ids of the entries that start with it, so the nearest
+    entry that starts with a prefix is found with a bisection. Entries that
+    start with a prefix longer than `depth` are a subset of what is found
+    for its first `depth` characters, so the caller should check them.
+
+    >>> index = PrefixIndex(depth=3)
+    >>> index.append('abcd')
+    0
+    >>> index.append('b')
+    1
+    >>> index.append('abce')
+    2
+    >>> index.previous('ab', 3), index.previous('ab', 2), index.previous('ab', 0)
+    (2, 0, None)
+    >>> index.next('abc', 0), index.next('abc', 2)
+    (2, None)
+    >>> index.prepend(['abx'])
+    [-1]
+    >>> index.previous('ab', 0)
+    -1
+    """
+    def __init__(self, depth=PREFIX_INDEX_DEPTH):
+        self.depth = depth
+        self.oldest = 0
+        self.newest = -1
+        self._ids = {}
+
+    def __len__(self):
+        return self.newest - self.oldest + 1
+
+    def _prefixes(self, string):
+        return [string[:i] for i in range(min(len(string), self.depth) + 1)]
+
+    def append(self, string):
+        """
+        Add string as the newest entry. Returns its id.
+        """
+        self.newest += 1
+        for prefix in self._prefixes(string):
+            self._ids.setdefault(prefix, []).append(self.newest)
+        return self.newest
+
+    def prepend(self, strings):
+        """
+        Add strings (newest first) as the oldest entries. Returns their ids.
+        """
+        new = {}
+        ids = []
+        for string in strings:
+            self.oldest -= 1
+            ids.append(self.oldest)
+            for prefix in self._prefixes(string):
+                new.setdefault(prefix, []).append(self.oldest)
+        for prefix, prefix_ids in new.items():
+            prefix_ids.reverse()
+            self._ids[prefix] = prefix_ids + self._ids.get(prefix, [])
+        return ids
+
+    def previous(self, prefix, before):
+        """
+        Return the newest id smaller than before of an entry that might
+        start with prefix, or None
+        """
+        ids = self._ids.get(prefix[:self.depth], [])
+        i = bisect.bisect_left(ids, before)
+        return ids[i - 1] if i else None
+
+    def next(self, prefix, after):
+        """
+        Return the oldest id larger than after of an entry that might start
+        with prefix, or None
+        """
+        ids = self._ids.get(prefix[:self.depth], [])
+        i = bisect.bisect_right(ids, after)
+        return ids[i] if i < len(ids) else None
+
+def history_chunks(history, chunk_size=HISTORY_PAGER_CHUNK):
+    """
+    Return the number of strings in history, including the ones that haven't
+    been loaded, and an iterator of lists of them of size chunk_size, oldest
+    first
+
+    An IndexedFileHistory is read one chunk at a time.
+    """
+    if not isinstance(history, IndexedFileHistory):
+        if getattr(history, '_loaded', False):
+            strings = history.get_strings()
+        else:
+            # Nothing has been loaded yet. load_history_strings() is newest
+            # first.
+            strings = list(history.load_history_strings())[::-1]
+        return len(strings), (strings[start:start + chunk_size] for start in
+                              range(0, len(strings), chunk_size))
+
+    with history.locked() as fd:
+        total = history._update(fd)
+    return total, (history.get_entries(start, min(start + chunk_size, total))
+                   for start in range(0, total, chunk_size))
+
+@functools.lru_cache()
+def _highlighter():
+    from pygments.formatters import TerminalTrueColorFormatter
+    from .theme import OneAMStyle, MyPython3Lexer
+
+    return MyPython3Lexer(), TerminalTrueColorFormatter(style=OneAMStyle)
+
+def highlight(string):
+    """
+    Return string highlighted with ANSI color codes, like the prompt
+    """
+    import pygments
+
+    return pygments.highlight(string, *_highlighter())
+
+class HighlightCache:
+    """
+    Persistent cache of highlight() for history entries
+
+    The cache is an SQLite database, keyed by the hash of the entry (and
+    HIGHLIGHT_VERSION).
+    """
+    def __init__(self, history_dir, filename=HIGHLIGHT_CACHE_FILE):
+        self.history_dir = os.path.expanduser(history_dir)
+        self.filename = os.path.join(self.history_dir, filename)
+
+    def connect(self):
+        import sqlite3
+
+        os.makedirs(self.history_dir, exist_ok=True)
+        conn = sqlite3.connect(self.filename, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS highlighted
+            (hash TEXT PRIMARY KEY, text TEXT)""")
+        return conn
+
+    @staticmethod
+    def key(string):
+        return hashlib.sha1((HIGHLIGHT_VERSION + '\0' + string).encode('utf-8',
+            errors='surrogatepass')).hexdigest()
+
+    def highlight(self, strings, highlight_missing=True):
+        """
+        Return the highlighted strings, highlighting and caching the ones
+        that aren't cached
+
+        If highlight_missing is False, None is returned for the strings that
+        aren't cached.
+        """
+        keys = [self.key(string) for string in strings]
+        with self.connect() as conn:
+            cached = dict(conn.execute("SELECT hash, text FROM highlighted WHERE hash IN (%s)"
+                % ', '.join('?'*len(keys)), keys))
+            new = {}
+            if highlight_missing:
+                for key, string in zip(keys, strings):
+                    if key not in cached and key not in new:
+                        new[key] = highlight(string)
+                conn.executemany("INSERT OR REPLACE INTO highlighted VALUES (?, ?)", new.items())
+        conn.close()
+        cached.update(new)
+        return [cached.get(key) for key in keys]
+
+    def fill(self, strings, chunk_size=HISTORY_PAGER_CHUNK):
+        """
+        Highlight and cache strings, chunk_size at a time
+        """
+        for start in range(0, len(strings), chunk_size):
+            self.highlight(strings[start:start + chunk_size])
+
+    def fill_async(self, strings):
+        """
+        Run fill() in a background thread
+        """
+        thread = threading.Thread(target=self.fill, args=(strings,),
+            name='mypython-highlight-cache', daemon=True)
+        thread.start()
+        return thread
+
+def page_history(session, pager=HISTORY_PAGER, colors=True):
+    """
+    Show the history in a pager (for %history)
+
+    The entries are written to the pager as they are read, so the pager
+    starts right away, and memory doesn't grow with the size of the
+    history.
+
+    Highlighted entries are cached (see HighlightCache). Only the last
+    HISTORY_PAGER_HIGHLIGHT entries are highlighted if they aren't cached, so
+    that the pager doesn't have to wait for them. The other entries are
+    shown without colors, and are highlighted in the background for the
+    next time.
+    """
+    import subprocess
+    from .mypython import blue, underline, default_history_filename
+
+    separator = underline(blue(' '*80))
+    history_dir = os.path.dirname(session.history_file or default_history_filename())
+    cache = HighlightCache(history_dir) if colors else None
+    total, chunks = history_chunks(session.history, HISTORY_PAGER_CHUNK)
+    missing = []
+
+    proc = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE,
+                            errors='backslashreplace')
+    try:
+        with proc.stdin as pipe:
+            start = 0
+            for chunk in chunks:
+                start += len(chunk)
+                if cache:
+                    rendered = cache.highlight(chunk, highlight_missing=start >
+                                               total - HISTORY_PAGER_HIGHLIGHT)
+                else:
+                    rendered = [None]*len(chunk)
+                for string, text in zip(chunk, rendered):
+                    if text is None:
+                        text = string + '\n'
+                        if cache:
+                            missing.append(string)
+                    pipe.write(text + separator + '\n')
+                pipe.flush()
+    except KeyboardInterrupt:
+        # The pager is still in control of the terminal
+        pass
+    except OSError:
+        # The pager was quit before everything was written
+        pass
+
+    if missing:
+        cache.fill_async(missing)
+
+    while True:
+        try:
+            proc.wait()
+            break
+        except KeyboardInterrupt:
+            # Ignore Ctrl-C like the pager does, so it isn't left running
+            pass
@@ -0,0 +1,257 @@
+"""
+Background jobs
+
+%bg runs code in a worker thread, so that the prompt can still be used while
+it runs. See the %bg, %jobs, %wait, and %kill magics.
+
+Each job is identified by the prompt number where it was started. When the
+job finishes, the result is saved to Out[n] and _n for that prompt number
+before the next command is run (the job thread only queues it, so that Out and
+the namespace are only modified from the main thread).
+Anything the job prints to stdout or stderr is saved on the job, rather than
+being printed on top of the prompt. Use %wait to print it.
+"""
+
+import sys
+import time
+import ctypes
+import threading
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError
+
+from prompt_toolkit.application.current import set_app
+from prompt_toolkit.application.run_in_terminal import run_in_terminal
+
+# The maximum number of jobs that are run at once. Any other jobs wait until
+# one of these finishes.
+MAX_JOBS = 4
+
+_current = threading.local()
+
+class KilledJob(BaseException):
+    """
+    Raised inside of a job thread by %kill
+    """
+    pass
+
+class JobStream:
+    """
+    Wrapper around sys.stdout or sys.stderr that writes to the job's own
+    buffer when it is written to from a job thread.
+    """
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def _target(self):
+        job = getattr(_current, 'job', None)
+        if job is None:
+            return self.stream
+        return getattr(job, self.name)
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._target(), attr)
+
+def _install_streams():
+    if not isinstance(sys.stdout, JobStream):
+        sys.stdout = JobStream(sys.stdout, 'stdout')
+    if not isinstance(sys.stderr, JobStream):
+        sys.stderr = JobStream(sys.stderr, 'stderr')
+
+class Job:
+    def __init__(self, job_id, command):
+        self.id = job_id
+        self.command = command
+        self.status = 'pending'
+        self.result = None
+        self.exc_info = None
+        self.stdout = StringIO()
+        self.stderr = StringIO()
+        self.thread_id = None
+        self.start_time = None
+        self.end_time = None
+        self.future = None
+
+    @property
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    def done(self):
+        return self.status in ('done', 'error', 'killed')
+
+    def __repr__(self):
+        return "<Job %s %s: %r>" % (self.id, self.status, self.command)
+
+class JobManager:
+    def __init__(self, max_jobs=MAX_JOBS):
+        self.jobs = {}
+        self.max_jobs = max_jobs
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, job_id):
+        return self.jobs[job_id]
+
+    def __iter__(self):
+        return iter(self.jobs.values())
+
+    def submit(self, command, _globals, _locals, prompt):
+        """
+        Run command in the background
+
+        The job id is the current prompt number, which is returned.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_jobs,
+                thread_name_prefix='mypython-job')
+        _install_streams()
+
+        job = Job(prompt.prompt_number, command)
+        self.jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job, _globals, _locals, prompt)
+        print("Started job %s" % job.id)
+        return job.id
+
+    def _run(self, job, _globals, _locals, prompt):
+        from .mypython import smart_eval, NoResult
+
+        _current.job = job
+        try:
+            with self._lock:
+                if job.status == 'killed':
+                    return
+                job.status = 'running'
+                job.thread_id = threading.get_ident()
+            job.start_time = time.perf_counter()
+            try:
+                res = smart_eval(job.command, _globals, _locals,
+                    filename='<mypython-bg-%s>' % job.id)
+            finally:
+                with self._lock:
+                    # Clear any %kill that was not delivered yet
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                        ctypes.c_ulong(job.thread_id), None)
+                    job.thread_id = None
+                job.end_time = time.perf_counter()
+        except KilledJob:
+            job.status = 'killed'
+        except BaseException:
+            job.exc_info = sys.exc_info()
+            job.status = 'error'
+        else:
+            if res is not NoResult:
+                job.result = res
+                # Applied in the main thread by apply_job_results()
+                prompt.job_results.append((job.id, res, _locals))
+            job.status = 'done'
+        finally:
+            _current.job = None
+
+        self._notify(job, prompt)
+
+    def _notify(self, job, prompt):
+        """
+        Print that job finished
+
+        This is called from the job thread. If the prompt is being shown,
+        the message is printed above it from the event loop of the prompt.
+        Otherwise, the main thread is running a command, and the message is
+        printed right away.
+        """
+        from .timeit import format_time
+
+        message = "[%s] %s (%s): %s" % (job.id, job.status.capitalize(),
+            format_time(job.elapsed), job.command)
+        if job.status == 'error':
+            message += "\n%s: %s" % (job.exc_info[0].__name__, job.exc_info[1])
+        if job.stdout.tell() or job.stderr.tell():
+            message += "\nUse %%wait %s to see the output" % job.id
+        def show():
+            if app.is_running:
+                with set_app(app):
+                    run_in_terminal(lambda: print(message))
+            else:
+                print(message)
+
+        app = getattr(prompt, 'app', None)
+        loop = app.loop if app is not None else None
+        if app is not None and app.is_running and loop is not None:
+            try:
+                loop.call_soon_threadsafe(show)
+                return
+            except RuntimeError:
+                # The prompt exited and its loop was closed
+                pass
+        print(message)
+
+    def wait(self, job_id=None, timeout=None):
+        """
+        Wait for the given job (or all jobs) to finish, and print the output
+        """
+        if job_id is not None and job_id not in self.jobs:
+            print("No job %s" % job_id, file=sys.stderr)
+            return
+        jobs = list(self) if job_id is None else [self[job_id]]
+        for job in jobs:
+            if job.future is not None:
+                try:
+                    job.future.result(timeout=timeout)
+                except CancelledError:
+                    # Killed by %kill before it started
+                    pass
+                except TimeoutError:
+                    print("Job %s is still running" % job.id, file=sys.stderr)
+                    continue
+            self.print_output(job)
+
+    def print_output(self, job):
+        sys.stdout.write(job.stdout.getvalue())
+        sys.stderr.write(job.stderr.getvalue())
+        if job.status == 'error':
+            sys.excepthook(*job.exc_info)
+        elif job.status == 'killed':
+            print("Job %s was killed" % job.id, file=sys.stderr)
+
+    def kill(self, job_id):
+        """
+        Kill the given job by raising KilledJob in its thread
+
+        Note that this only takes effect once the job thread runs Python
+        code again, so a job that is blocked in a long running C function will
+        not stop until that function returns.
+        """
+        if job_id not in self.jobs:
+            print("No job %s" % job_id, file=sys.stderr)
+            return
+        job = self[job_id]
+        with self._lock:
+            if job.status == 'pending':
+                job.status = 'killed'
+                job.future.cancel()
+                return
+            if job.thread_id is None:
+                print("Job %s is not running" % job_id, file=sys.stderr)
+                return
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                ctypes.c_ulong(job.thread_id), ctypes.py_object(KilledJob))
+
+    def print_jobs(self):
+        from .timeit import format_time
+
+        if not self.jobs:
+            print("No jobs")
+            return
+        for job in self:
+            print("%3s  %-8s %10s  %s" % (job.id, job.status,
+                format_time(job.elapsed), job.command))
+
+JOBS = JobManager()
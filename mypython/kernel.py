@@ -0,0 +1,387 @@
+"""
+Out-of-process execution (mypython --kernel)
+
+In kernel mode, the prompt runs in the front process, and the commands are
+executed by a child Python process (the kernel), so that a command that
+crashes the interpreter or hangs doesn't take the editor (and the unsaved
+input) down with it.
+
+The kernel is started with ``python -m mypython.kernel FD``, where FD is one
+end of a Unix socket pair. The front sends each command over the socket. The
+kernel runs it with execute_command(), and writes stdout and stderr directly
+to the terminal, which it shares with the front. The repr of the result is
+sent back to the front, which prints it. Reprs larger than
+SHARED_MEMORY_THRESHOLD are passed through shared memory instead of the
+socket.
+
+Ctrl-C while a command is running interrupts it in the kernel (the terminal
+sends SIGINT to both processes). Pressing it a second time, or the kernel
+dying, restarts the kernel. The namespace of the old kernel is lost.
+
+The names in the kernel namespace are copied to the front after each command,
+so that completion and pyflakes know about them. The values are not copied.
+The names are requested from the kernel in a background thread, but the front
+namespace is only changed by the main thread (see Kernel.apply_pending()),
+since completion reads it.
+"""
+
+import os
+import sys
+import signal
+import socket
+import threading
+import subprocess
+from collections import deque
+from io import StringIO
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Connection
+
+# 1 MiB
+SHARED_MEMORY_THRESHOLD = 2**20
+
+class KernelDied(Exception):
+    """
+    Raised when the kernel exits while running a command
+    """
+    def __init__(self, returncode):
+        super().__init__(returncode)
+        self.returncode = returncode
+
+    def __str__(self):
+        if self.returncode is not None and self.returncode < 0:
+            try:
+                return "Kernel died (%s)" % signal.Signals(-self.returncode).name
+            except ValueError:
+                pass
+        return "Kernel died (exit code %s)" % self.returncode
+
+class KernelName:
+    """
+    Placeholder for a name in the kernel namespace
+
+    The value only lives in the kernel, so there is nothing to complete on.
+    """
+    def __dir__(self):
+        return []
+
+    def __repr__(self):
+        return '<kernel name>'
+
+KERNEL_NAME = KernelName()
+
+def encode_text(text):
+    """
+    Return a message for text, using shared memory if it is large
+    """
+    data = text.encode('utf-8', 'surrogateescape')
+    if len(data) <= SHARED_MEMORY_THRESHOLD:
+        return ('text', text)
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    # The front unlinks it after reading it. Don't let the resource tracker
+    # of this process unlink it (or warn about it) when the kernel exits.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+    return ('shm', shm.name, len(data))
+
+def decode_text(message):
+    """
+    Return the text for a message from encode_text()
+
+    Shared memory is freed after it is read.
+    """
+    if message[0] == 'text':
+        return message[1]
+    _, name, size = message
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size]).decode('utf-8', 'surrogateescape')
+    finally:
+        shm.close()
+        shm.unlink()
+
+class CaptureDisplayhook:
+    """
+    displayhook that captures everything that is printed from the time it is
+    called until stop() is called, instead of printing it
+
+    This is the repr of the result, and anything execute_command() prints
+    after it.
+    """
+    def __init__(self, displayhook):
+        self.displayhook = displayhook
+        self.stdout = None
+        self.out = None
+
+    def __call__(self, value):
+        if self.out is None:
+            self.stdout = sys.stdout
+            sys.stdout = self.out = StringIO()
+        self.displayhook(value)
+
+    def stop(self):
+        """
+        Stop capturing, and return the captured text
+        """
+        if self.out is None:
+            return ''
+        if sys.stdout is self.out:
+            sys.stdout = self.stdout
+        text = self.out.getvalue()
+        self.stdout = self.out = None
+        return text
+
+def kernel_main(fd, prompt_number=1, IN_OUT=None):
+    """
+    Run the kernel, reading commands from the socket fd
+    """
+    from . import mypython
+    from .mypython import (BatchSession, execute_command, _default_globals,
+                           _default_locals, setup_keyboard_interrupt_handler)
+
+    conn = Connection(fd)
+    session = BatchSession(_globals=_default_globals, _locals=_default_locals,
+                           IN_OUT=IN_OUT, quiet=True)
+    session.prompt_number = session.builtins['PROMPT_NUMBER'] = prompt_number
+    _default_locals['PROMPT_NUMBER'] = prompt_number
+    displayhook = sys.displayhook = CaptureDisplayhook(sys.displayhook)
+
+    while True:
+        # Ctrl-C at the front prompt is sent to the kernel too. Only let it
+        # interrupt commands.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            message = conn.recv()
+        except EOFError:
+            return 0
+        kind = message[0]
+        if kind == 'execute':
+            _, command, doctest_mode = message
+            if doctest_mode != mypython.DOCTEST_MODE:
+                mypython.doctest_mode(doctest_mode)
+            setup_keyboard_interrupt_handler()
+            try:
+                status = execute_command(command, session,
+                    _globals=_default_globals, _locals=_default_locals)
+            except SystemExit as e:
+                displayhook.stop()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                conn.send(('exit', e.code))
+                return 0
+            except KeyboardInterrupt:
+                # Interrupted outside of the command itself
+                status = False
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            text = displayhook.stop()
+            # Make sure everything the command printed is shown before the
+            # front prints the result.
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.send(('result', status, session.prompt_number,
+                       encode_text(text)))
+        elif kind == 'names':
+            conn.send(('names', list(_default_locals)))
+        else:
+            raise ValueError("Unknown kernel message: %r" % (message,))
+
+class Kernel:
+    """
+    The front process end of a kernel
+
+    execute() runs a command in the kernel. names is a dict with the names
+    in the kernel namespace (with KERNEL_NAME as the values). It is updated
+    after each command by refresh_names_async().
+    """
+    def __init__(self, names=None, IN_OUT=None):
+        self.names = names if names is not None else {}
+        self.IN_OUT = IN_OUT
+        self.process = None
+        self.conn = None
+        # Held while waiting for a reply from the kernel
+        self.lock = threading.Lock()
+        self._kernel_names = set()
+        # Functions to run in the main thread (see apply_pending())
+        self.pending = deque()
+
+    def start(self, prompt_number=1):
+        front, back = socket.socketpair()
+        # Make sure the kernel can import mypython, even if it isn't installed
+        top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        path = os.environ.get('PYTHONPATH')
+        env = dict(os.environ, PYTHONPATH=top + (os.pathsep + path if path else ''))
+        args = [sys.executable, '-m', 'mypython.kernel', str(back.fileno()),
+                str(prompt_number)]
+        if self.IN_OUT:
+            args.extend(self.IN_OUT)
+        with back:
+            self.process = subprocess.Popen(args, pass_fds=[back.fileno()], env=env)
+        self.conn = Connection(front.detach())
+        self._kernel_names = set()
+
+    def stop(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def restart(self, prompt_number=1):
+        if self.process is not None:
+            self.process.kill()
+        self.stop()
+        self.start(prompt_number=prompt_number)
+
+    def _recv(self):
+        try:
+            return self.conn.recv()
+        except (EOFError, OSError):
+            raise KernelDied(self.process.wait())
+
+    def execute(self, command, doctest_mode=False):
+        """
+        Run command in the kernel.
+
+        Returns (status, prompt_number, text), where status is the return
+        value of execute_command(), prompt_number is the kernel's prompt
+        number after the command, and text is what the kernel printed
+        starting with the displayhook (i.e., the repr of the result).
+
+        The first KeyboardInterrupt while waiting interrupts the command in
+        the kernel. The second one kills the kernel. Raises KernelDied if the
+        kernel dies, and SystemExit if the command exits.
+        """
+        with self.lock:
+            try:
+                self.conn.send(('execute', command, doctest_mode))
+            except OSError:
+                raise KernelDied(self.process.wait())
+            interrupted = False
+            while True:
+                try:
+                    message = self._recv()
+                    break
+                except KeyboardInterrupt:
+                    # The kernel got the SIGINT as well
+                    if interrupted:
+                        self.process.kill()
+                        raise KernelDied(self.process.wait())
+                    interrupted = True
+
+        if message[0] == 'exit':
+            raise SystemExit(message[1])
+        _, status, prompt_number, text = message
+        return status, prompt_number, decode_text(text)
+
+    def get_names(self):
+        """
+        Return the set of names in the kernel namespace, or None if the
+        kernel isn't running
+        """
+        with self.lock:
+            try:
+                self.conn.send(('names',))
+                _, names = self.conn.recv()
+            except (EOFError, OSError, AttributeError):
+                # The kernel was restarted or stopped
+                return None
+        return set(names)
+
+    def refresh_names(self):
+        """
+        Update self.names with the names in the kernel namespace
+        """
+        self._update_names(self.get_names())
+
+    def _update_names(self, names):
+        if names is None:
+            return
+        for name in self._kernel_names - names:
+            self.names.pop(name, None)
+        for name in names - self._kernel_names:
+            self.names.setdefault(name, KERNEL_NAME)
+        self._kernel_names = names
+
+    def refresh_names_async(self, callback=None, wakeup=None):
+        """
+        Get the names in the kernel namespace in a background thread
+
+        self.names is then updated, and callback() called, the next time
+        apply_pending() is called. wakeup(), if given, is called from the
+        thread once the names are ready, to get the main thread to do that.
+        """
+        def refresh():
+            names = self.get_names()
+            def update():
+                self._update_names(names)
+                if callback:
+                    callback()
+            self.pending.append(update)
+            if wakeup:
+                wakeup()
+        thread = threading.Thread(target=refresh, daemon=True)
+        thread.start()
+        return thread
+
+    def apply_pending(self):
+        """
+        Apply the names from refresh_names_async(). Must be called from the
+        main thread.
+        """
+        while self.pending:
+            self.pending.popleft()()
+
+def execute_in_kernel(command, prompt, kernel):
+    """
+    Run command in the kernel, and print the result, like execute_command()
+    """
+    from . import mypython
+
+    if not command.strip():
+        if not mypython.DOCTEST_MODE:
+            print()
+        return True
+
+    kernel.apply_pending()
+    prompt.In[prompt.prompt_number] = command
+    prompt.jedi_document.add(prompt.prompt_number, command)
+    try:
+        status, prompt_number, text = kernel.execute(command,
+            doctest_mode=mypython.DOCTEST_MODE)
+    except KernelDied as e:
+        print("%s. Restarting the kernel. The namespace was lost.\n" % e,
+              file=sys.stderr)
+        prompt.prompt_number += 1
+        kernel.restart(prompt_number=prompt.prompt_number)
+        return False
+    print(text, end='', flush=True)
+    prompt.prompt_number = prompt.builtins['PROMPT_NUMBER'] = prompt_number
+    prompt.namespace_version += 1
+
+    def names_refreshed():
+        prompt.name_index.update(prompt._locals)
+        prompt.namespace_version += 1
+
+    def wakeup():
+        # If the prompt is showing, apply the names from its event loop
+        # (which runs in the main thread). Otherwise, they are applied
+        # before the next prompt (see run_shell()).
+        app = prompt.app
+        loop = app.loop
+        if app.is_running and loop is not None:
+            try:
+                loop.call_soon_threadsafe(kernel.apply_pending)
+            except RuntimeError:
+                # The loop was closed
+                pass
+    kernel.refresh_names_async(callback=names_refreshed, wakeup=wakeup)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(kernel_main(int(sys.argv[1]), int(sys.argv[2]),
+                         IN_OUT=sys.argv[3:5] or None))
@@ -15,6 +15,7 @@ from prompt_toolkit.clipboard import ClipboardData
 from prompt_toolkit.input.vt100_parser import ANSI_SEQUENCES
 from prompt_toolkit.application.current import get_app
 from prompt_toolkit.application import run_in_terminal
+from prompt_toolkit.completion import CompleteEvent
 
 from prompt_toolkit import __version__ as prompt_toolkit_version
 
@@ -117,6 +118,13 @@ def forward_history_search(event):
     buffer = event.current_buffer
     buffer.history_forward(count=event.arg, history_search=True)
 
+@r.add_binding(Keys.Escape, 'r')
+def search_all_history(event):
+    """
+    Search the history of every terminal for the current text
+    """
+    event.current_buffer.search_all_history()
+
 @r.add_binding(Keys.Escape, '<')
 def beginning(event):
     """
@@ -405,6 +413,42 @@ def accept_after_history_backward(event):
 def insert_newline(event):
     auto_newline(event.current_buffer)
 
+is_fuzzy_history_search = Condition(
+    lambda: getattr(get_app().current_buffer, 'fuzzy_history_search', False))
+
+@r.add_binding(Keys.ControlX, Keys.ControlR)
+def fuzzy_history_search(event):
+    """
+    Fuzzy search the history for the current line
+    """
+    event.current_buffer.start_fuzzy_history_search()
+
+# This has to be after the other Enter bindings so that it takes priority
+@r.add_binding(Keys.Enter, filter=is_fuzzy_history_search)
+def accept_fuzzy_history_search(event):
+    """
+    Use the selected (or the best) entry from the fuzzy history search
+    """
+    buffer = event.current_buffer
+    state = buffer.complete_state
+    if state and state.completions:
+        completion = state.current_completion or state.completions[0]
+    else:
+        # The search hasn't finished in the completion thread yet
+        completion = next(buffer.fuzzy_completer.get_completions(
+            buffer.document, CompleteEvent()), None)
+    if completion:
+        buffer.apply_completion(completion)
+    else:
+        buffer.cancel_completion()
+        buffer.stop_fuzzy_history_search()
+
+@r.add_binding(Keys.ControlG, filter=is_fuzzy_history_search)
+def cancel_fuzzy_history_search(event):
+    buffer = event.current_buffer
+    buffer.cancel_completion()
+    buffer.stop_fuzzy_history_search()
+
 @r.add_binding(Keys.ControlO)
 def open_line(event):
     event.current_buffer.newline(copy_margin=False)
@@ -19,6 +19,7 @@ import platform
 import os
 import re
 import sys
+import threading
 from functools import wraps
 
 from prompt_toolkit.history import FileHistory
@@ -112,7 +113,7 @@ from time import perf_counter as _perf_counter
 from mypython import smart_eval as _smart_eval, format_time as _format_time
 import sys as _sys
 _time = _perf_counter()
-res = _smart_eval({rest!r}, globals(), locals())
+res = _smart_eval({rest!r}, globals(), locals(), loop=_PROMPT.event_loop)
 _time = _perf_counter() - _time
 print("Total time:", _format_time(_time))
 del _time, _format_time, _perf_counter, _smart_eval, _sys
@@ -164,6 +165,28 @@ del _mypython
 
 prompt_magic = noprompt_magic
 
+def autocomplete_magic(rest):
+    """
+    Enable/disable completing as you type
+
+    The completions are shown after a short pause in typing. Completions
+    from Jedi that are slow are left out (press TAB to get all the
+    completions).
+    """
+    if rest:
+        return error("%autocomplete takes no arguments")
+
+    return """\
+from mypython import mypython as _mypython
+_mypython.AUTOCOMPLETE_MODE ^= True
+
+if _mypython.AUTOCOMPLETE_MODE:
+    print("autocomplete enabled")
+else:
+    print("autocomplete disabled")
+del _mypython
+"""
+
 def debug_magic(rest):
     """
     Enable/disable debug mode
@@ -209,6 +232,61 @@ print(%r)
 
 isympy_magic = sympy_magic
 
+# Preload SymPy if %sympy is used this many times in the end of the history
+SYMPY_PRELOAD_USES = 3
+
+# How much of the end of the history file to look at, in bytes
+SYMPY_PRELOAD_HISTORY_BYTES = 2**16
+
+_sympy_preload_thread = None
+
+def _import_sympy():
+    try:
+        import sympy
+        sympy
+    except ImportError:
+        pass
+
+def preload_sympy():
+    """
+    Start importing SymPy in a background thread
+
+    The import in %sympy then only waits for the background import to finish
+    (if it hasn't already), and binds the names. Returns the thread, or None
+    if SymPy is already imported.
+    """
+    global _sympy_preload_thread
+    if 'sympy' in sys.modules and _sympy_preload_thread is None:
+        return None
+    if _sympy_preload_thread is None:
+        _sympy_preload_thread = threading.Thread(target=_import_sympy,
+            name='mypython-sympy-preload', daemon=True)
+        _sympy_preload_thread.start()
+    return _sympy_preload_thread
+
+def history_uses_sympy(history_file, uses=SYMPY_PRELOAD_USES):
+    """
+    Return True if %sympy or %isympy is used at least uses times in the most
+    recent entries of history_file
+
+    Only the last SYMPY_PRELOAD_HISTORY_BYTES of the file are read.
+    """
+    try:
+        with open(history_file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - SYMPY_PRELOAD_HISTORY_BYTES, 0))
+            tail = f.read()
+    except OSError:
+        return False
+    count = 0
+    for line in tail.splitlines():
+        # FileHistory entries are prefixed with +
+        if line.strip() in (b'+%sympy', b'+%isympy'):
+            count += 1
+            if count >= uses:
+                return True
+    return False
+
 def get_history(file=None, this_history=None):
     """
     Return the list of history strings corresponding to a given history
@@ -248,16 +326,53 @@ def get_history(file=None, this_history=None):
         raise RuntimeError("Could not find history from %s" % file)
     return list(history.load_history_strings())
 
+@nonpython
 def history_magic(rest):
-    return """\
-import pydoc as _pydoc
-import pygments as _pygments
-from mypython.theme import OneAMStyle as _OneAMStyle, MyPython3Lexer as _MyPython3Lexer
-from mypython.mypython import blue as _blue, underline as _underline
-_pydoc.pipepager('\\n'.join(i+'\\n'+_underline(_blue(' '*80)) for i in _PROMPT.history.get_strings()), 'less +G')
-# Disable colors as they slow things down too much
-# _pydoc.pipepager('\\n'.join(_pygments.highlight(i, _MyPython3Lexer(), _pygments.formatters.TerminalTrueColorFormatter(style=_OneAMStyle))+_underline(_blue(' '*80)) for i in _PROMPT.history.get_strings()), 'less +G')
-del _pydoc, _pygments, _OneAMStyle, _MyPython3Lexer, _blue, _underline
+    """
+    Show the history in a pager.
+
+    %history              Show the history, with syntax highlighting
+    %history --no-color   Show the history without syntax highlighting
+    """
+    if rest.strip() not in ['', '--no-color']:
+        return error("unknown argument %r" % rest.strip())
+    return f"""\
+from mypython.history import page_history as _page_history
+_page_history(_PROMPT, colors={rest.strip() != '--no-color'})
+del _page_history
+"""
+
+@nonpython
+def hgrep_magic(rest):
+    """
+    Search the history of every terminal.
+
+    %hgrep text shows the most recent history entries that contain text
+    (case insensitive), from any terminal. M-r does the same search at the
+    prompt.
+    """
+    if not rest.strip():
+        return error("nothing to search for")
+
+    return f"""\
+from mypython.history import print_hgrep as _print_hgrep
+_print_hgrep(_PROMPT, {rest.strip()!r})
+del _print_hgrep
+"""
+
+@nonpython
+def hfind_magic(rest):
+    """
+    Fuzzy search the history.
+
+    %hfind text shows the history entries that contain the characters of
+    text in order, ranked by how well they match, how recently they were
+    used, and how often. C-x C-r does the same search at the prompt.
+    """
+    return f"""\
+from mypython.fuzzy import print_hfind as _print_hfind
+_print_hfind(_PROMPT, {rest.strip()!r})
+del _print_hfind
 """
 
 def pprint_magic(rest):
@@ -396,12 +511,89 @@ def echo_magic(rest):
     """
     return "print(%r)" % rest
 
+@nonpython
 def timings_magic(rest):
     """
-    Show timings for the code.
+    Show the time and other resources used by each command.
+
+    %timings                    Show a table of all the commands
+    %timings n                  Show the resources used by the command n
+    %timings --sort column      Sort the table by column (largest first)
+    %timings --tracemalloc on   Trace memory allocations (the alloc column).
+                                This slows down allocations. Use off to
+                                disable it.
+
+    The columns are wall time, CPU time, the increase in the peak RSS, the
+    peak memory allocated, the number of garbage collections and the time
+    spent in them, and the amount written to stdout.
 
     Note that the prompt itself has an overhead of about 90 microseconds.
 
+    """
+    from .resources import Resources
+
+    args = rest.split()
+    n = sort = None
+    while args:
+        arg = args.pop(0)
+        if arg in ['--sort', '-s']:
+            if not args:
+                return error("--sort requires a column")
+            sort = args.pop(0).replace('-', '_')
+            if sort not in Resources._fields:
+                return error("invalid column %r (must be one of %s)" % (sort,
+                    ', '.join(Resources._fields)))
+        elif arg == '--tracemalloc':
+            if not args or args[0] not in ['on', 'off']:
+                return error("--tracemalloc must be on or off")
+            return f"""\
+_PROMPT.resource_monitor.trace_allocations = {args[0] == 'on'}
+"""
+        else:
+            try:
+                n = int(arg)
+            except ValueError:
+                return error("argument must be an integer")
+
+    return f"""\
+from mypython.resources import print_timings as _print_timings
+_print_timings(_PROMPT, n={n!r}, sort={sort!r})
+del _print_timings
+"""
+
+def bg_magic(rest):
+    """
+    Run the code in the background.
+
+    The prompt can be used while the code runs. The result is saved to Out[n]
+    and _n, where n is the current prompt number, when it finishes. Use %jobs
+    to see the running jobs, %wait to wait for a job and see its output, and
+    %kill to stop it.
+    """
+    if not rest:
+        return error('nothing to run')
+
+    return f"""\
+from mypython.jobs import JOBS as _JOBS
+_JOBS.submit({rest!r}, globals(), locals(), _PROMPT)
+del _JOBS
+"""
+
+def jobs_magic(rest):
+    """
+    List the background jobs started with %bg.
+    """
+    return """\
+from mypython.jobs import JOBS as _JOBS
+_JOBS.print_jobs()
+del _JOBS
+"""
+
+def wait_magic(rest):
+    """
+    Wait for a background job to finish and show its output.
+
+    With no arguments, waits for all jobs.
     """
     rest = rest.strip()
     if rest:
@@ -409,14 +601,114 @@ def timings_magic(rest):
             rest = int(rest)
         except ValueError:
             return error("argument must be an integer")
+    else:
+        rest = None
 
     return f"""\
-from mypython.timeit import format_time as _format_time
-if {rest!r}:
-    print(_format_time(TIMINGS[int({rest})]))
-else:
-    for _i in range(1, PROMPT_NUMBER):
-        print(f'{{_i:2d}} {{_format_time(TIMINGS[_i])}}')
+from mypython.jobs import JOBS as _JOBS
+try:
+    _JOBS.wait({rest!r})
+finally:
+    del _JOBS
+"""
+
+def kill_magic(rest):
+    """
+    Stop a background job.
+    """
+    try:
+        rest = int(rest.strip())
+    except ValueError:
+        return error("argument must be an integer")
+
+    return f"""\
+from mypython.jobs import JOBS as _JOBS
+try:
+    _JOBS.kill({rest!r})
+finally:
+    del _JOBS
+"""
+
+@nonpython
+def outcache_magic(rest):
+    """
+    Show the memory usage of the output cache (Out), or configure it.
+
+    %outcache               Show the memory usage and the largest outputs
+    %outcache pin n ...     Never evict Out[n]
+    %outcache unpin n ...   Allow Out[n] to be evicted again
+    %outcache budget size   Set the memory budget, e.g., 2GB
+    """
+    args = rest.split()
+    if not args:
+        return """\
+_Out = _PROMPT.Out
+_Out.print_usage()
+del _Out
+"""
+
+    command, args = args[0], args[1:]
+    if command in ['pin', 'unpin']:
+        try:
+            args = [int(i) for i in args]
+        except ValueError:
+            return error("arguments must be integers")
+        if not args:
+            return error("no outputs to %s" % command)
+        return f"""\
+for _n in {args!r}:
+    _PROMPT.Out.{command}(_n)
+del _n
+"""
+    elif command == 'budget':
+        from .outcache import parse_size
+        try:
+            budget = parse_size(' '.join(args))
+        except ValueError as e:
+            return error(str(e))
+        return f"""\
+_Out = _PROMPT.Out
+_Out.set_budget({budget!r})
+_Out.print_usage()
+del _Out
+"""
+    return error("unknown %%outcache command %r (use pin, unpin, or budget)" % command)
+
+@nonpython
+def save_session_magic(rest):
+    """
+    Save the namespace, In, Out, and TIMINGS to disk.
+
+    %save_session [name]
+
+    name may be a filename, or a name for a file in ~/.mypython/sessions/.
+    The default is 'default'. Modules are saved by name. Objects that cannot
+    be pickled are skipped. Use %load_session to restore the session.
+    """
+    return f"""\
+from mypython.snapshot import save_session_command as _save_session_command
+try:
+    _save_session_command(_PROMPT, locals(), {rest.strip() or None!r})
+finally:
+    del _save_session_command
+"""
+
+@nonpython
+def load_session_magic(rest):
+    """
+    Load a session saved with %save_session.
+
+    %load_session [name]
+
+    Large arrays are memory mapped from the file rather than read into
+    memory.
+    """
+    return f"""\
+from mypython.snapshot import load_session_command as _load_session_command
+try:
+    _load_session_command(_PROMPT, locals(), {rest.strip() or None!r})
+finally:
+    del _load_session_command
 """
 
 @completions(ai.get_ai_models)
@@ -15,19 +15,23 @@ del _default_globals['annotations']
 _default_locals = _default_globals
 
 import os
+import re
 import sys
 import inspect
 import linecache
 import random
 import ast
+import asyncio
+import atexit
+import threading
 import traceback
 import time
 import textwrap
 import warnings
+import types
 from io import StringIO
 from textwrap import dedent
-from pydoc import pager, Helper
-from collections import deque
+from collections import deque, OrderedDict, namedtuple
 from contextlib import contextmanager
 
 try:
@@ -50,7 +54,7 @@ from prompt_toolkit.layout.processors import ConditionalProcessor
 from prompt_toolkit.styles import (style_from_pygments_cls,
     style_from_pygments_dict, merge_styles)
 from prompt_toolkit.styles.pygments import pygments_token_to_classname
-from prompt_toolkit.history import FileHistory
+from prompt_toolkit.history import FileHistory, InMemoryHistory
 from prompt_toolkit.validation import Validator, ValidationError
 from prompt_toolkit.filters import Condition, IsDone
 from prompt_toolkit.formatted_text import PygmentsTokens
@@ -83,17 +87,27 @@ except ImportError:
     iterm2_tools = None
 
 from .multiline import document_is_multiline_python
-from .completion import PythonCompleter
+from .completion import (PythonCompleter, AsYouTypeCompleter, SessionDocument,
+                         warm_up_jedi)
+from .dircompletion import NameIndex
 from .ai import OllamaSuggester
+from .history import (IndexedFileHistory, HistoryIndex, PrefixIndex,
+    get_history_index)
+from .fuzzy import FuzzyHistoryCompleter, build_fuzzy_index
 from .theme import (OneAMStyle, MyPython3Lexer, emoji,
     TRACEBACK_HIGHLIGHT_STYLE, TRACEBACK_HIGHLIGHT_STYLES)
-from .keys import get_key_bindings, LEADING_WHITESPACE
+from .keys import (get_key_bindings, split_prompts, LEADING_WHITESPACE,
+    PS1_PROMPTS_RE)
 from .processors import (MyHighlightMatchingBracketProcessor,
                          HighlightPyflakesErrorsProcessor,
                          AppendAIAutoSuggestion,
                          get_pyflakes_warnings, SyntaxErrorMessage)
-from .magic import magic, MAGICS, NON_PYTHON_MAGICS
+from .magic import (magic, MAGICS, NON_PYTHON_MAGICS, preload_sympy,
+    history_uses_sympy)
 from .printing import mypython_displayhook
+from .outcache import OutCache, output_numbers
+from .spill import SpillDirectory
+from .resources import ResourceMonitor
 
 def print_formatted_text(*args, style=None, **kwargs):
     from prompt_toolkit import print_formatted_text as _print_formatted_text
@@ -126,11 +140,19 @@ class MyBuffer(Buffer):
     Subclass of buffer that fixes some broken behavior of Buffer
     """
     def __init__(self, *args, session=None, ai_auto_suggest=None, **kwargs):
+        # Buffer.__init__ calls reset()
+        self.fuzzy_history_search = False
         super().__init__(*args, **kwargs)
         self._multiline_history_search_index = None
         self.session = session
         self._show_syntax_warning = False
         self._append_history = True
+        self._prefix_index = PrefixIndex()
+        self._fuzzy_index = None
+        self._fuzzy_index_lock = threading.Lock()
+        self.fuzzy_completer = FuzzyHistoryCompleter(self)
+        # [text, remaining matches] for search_all_history()
+        self._search_all_history = None
 
         self.ai_suggestions = []
         self.ai_suggestion_index = 0
@@ -173,7 +195,58 @@ class MyBuffer(Buffer):
 
     def delete_before_cursor(self, count=1):
         self.multiline_history_search_index = None
-        return super().delete_before_cursor(count)
+        deleted = super().delete_before_cursor(count)
+        if self.fuzzy_history_search:
+            self.start_completion(select_first=False)
+        return deleted
+
+    def insert_text(self, data, *args, **kwargs):
+        if (self.fuzzy_history_search and self.complete_state and
+            self.complete_state.complete_index is not None):
+            # Typing after selecting an entry keeps it
+            self.stop_fuzzy_history_search()
+        return super().insert_text(data, *args, **kwargs)
+
+    def reset(self, *args, **kwargs):
+        self.stop_fuzzy_history_search()
+        return super().reset(*args, **kwargs)
+
+    def apply_completion(self, completion):
+        super().apply_completion(completion)
+        self.stop_fuzzy_history_search()
+
+    def fuzzy_index(self):
+        """
+        Return the FuzzyHistoryIndex of the history, creating it the first
+        time (from the whole history, including what hasn't been loaded)
+        """
+        with self._fuzzy_index_lock:
+            if self._fuzzy_index is None:
+                self._fuzzy_index = build_fuzzy_index(self.history)
+            return self._fuzzy_index
+
+    def start_fuzzy_history_search(self):
+        """
+        Show the history entries that fuzzy match the current line in the
+        completion menu, updating them as the line is typed (C-x C-r)
+        """
+        if self.fuzzy_history_search:
+            return
+        self.fuzzy_history_search = True
+        if self.session is not None:
+            self._complete_style = self.session.complete_style
+            # One entry per line
+            self.session.complete_style = CompleteStyle.COLUMN
+        self.start_completion(select_first=False)
+
+    def stop_fuzzy_history_search(self):
+        if not self.fuzzy_history_search:
+            return
+        self.fuzzy_history_search = False
+        if self._fuzzy_index is not None:
+            self._fuzzy_index.cancel()
+        if self.session is not None:
+            self.session.complete_style = self._complete_style
 
     @property
     def multiline_history_search_index(self):
@@ -201,7 +274,12 @@ class MyBuffer(Buffer):
 
         index = self.multiline_history_search_index if history_search else self.working_index
 
-        r = range(index - 1, -1, -1) if direction == 'backward' else range(index + 1, len(self._working_lines))
+        if history_search and self._sync_prefix_index():
+            r = self._history_search_indices(index, direction)
+        elif direction == 'backward':
+            r = self._backward_indices(index)
+        else:
+            r = range(index + 1, len(self._working_lines))
         for i in r:
             if self._history_matches(i):
                 if history_search:
@@ -239,6 +317,100 @@ class MyBuffer(Buffer):
                 self.cursor_position = len(self.text)
 
 
+    def _load_older_history(self):
+        """
+        Add history entries that haven't been loaded yet (see
+        IndexedFileHistory) to the start of the working lines
+
+        Returns the number of entries that were added.
+        """
+        load_older = getattr(self.history, 'load_older', None)
+        # Don't insert anything while the history is still being loaded into
+        # the working lines.
+        if (load_older is None or self._load_history_task is None or not
+            self._load_history_task.done()):
+            return 0
+        in_sync = self._sync_prefix_index()
+        older = load_older()
+        # older is newest first
+        self._working_lines.extendleft(older)
+        if in_sync:
+            self._prefix_index.prepend(older)
+        # The text is the same, it just has a new index. Setting
+        # working_index resets the cursor.
+        cursor_position = self.cursor_position
+        self.working_index += len(older)
+        self.cursor_position = cursor_position
+        if self._multiline_history_search_index is not None:
+            self._multiline_history_search_index += len(older)
+        return len(older)
+
+    def _backward_indices(self, index):
+        """
+        Iterate the working lines backwards from index, loading older history
+        when the start is reached
+
+        Loading older history shifts the indices, so the indices that are
+        yielded are always the current ones.
+        """
+        i = index - 1
+        while True:
+            if i < 0:
+                n = self._load_older_history()
+                if not n:
+                    return
+                i += n
+            yield i
+            i -= 1
+
+    def _sync_prefix_index(self):
+        """
+        Add the history entries that were added since the last time to the
+        prefix index
+
+        Returns True if the prefix index corresponds to the working lines
+        (the history entries followed by the current text), i.e., the
+        working line with index i is the entry with id
+        self._prefix_index.oldest + i.
+        """
+        if self._load_history_task is None or not self._load_history_task.done():
+            return False
+        strings = self.history._loaded_strings
+        new = len(strings) - len(self._prefix_index)
+        if new < 0:
+            # The history was replaced
+            self._prefix_index = PrefixIndex()
+            new = len(strings)
+        # New entries are inserted at the start of _loaded_strings
+        for string in reversed(strings[:new]):
+            self._prefix_index.append(string)
+        return len(self._working_lines) == len(self._prefix_index) + 1
+
+    def _history_search_indices(self, index, direction):
+        """
+        Iterate the indices of the working lines that might start with the
+        history search text, from index in direction, using the prefix index
+
+        Like _backward_indices(), older history is loaded when the start is
+        reached.
+        """
+        prefix_index = self._prefix_index
+        id = prefix_index.oldest + index
+        while True:
+            if direction == 'backward':
+                previous = prefix_index.previous(self.history_search_text, id)
+                if previous is None:
+                    # The ids don't change when older history is loaded
+                    if not self._load_older_history():
+                        return
+                    continue
+                id = previous
+            else:
+                id = prefix_index.next(self.history_search_text, id)
+                if id is None:
+                    return
+            yield id - prefix_index.oldest
+
     def history_backward(self, count=1, history_search=False):
         """
         Move backwards through history.
@@ -262,6 +434,39 @@ class MyBuffer(Buffer):
     def append_to_history(self):
         if self._append_history:
             super().append_to_history()
+            index = getattr(self.session, 'history_index', None)
+            if index and isinstance(self.history, IndexedFileHistory):
+                # The entry is written in the background
+                filename = self.history.filename
+                self.history.after_write(lambda: index.update([filename]))
+            elif index and isinstance(self.history, FileHistory):
+                index.update_async([self.history.filename])
+            if self._fuzzy_index is not None and self.text:
+                self._fuzzy_index.add(self.text)
+
+    def search_all_history(self):
+        """
+        Replace the text with the most recent entry from the history of any
+        terminal that contains it
+
+        Repeating this goes to older entries.
+        """
+        search = self._search_all_history
+        if search is None or search[0] != self.text:
+            query = self.text.strip()
+            if not query:
+                return
+            matches = [m[2] for m in get_history_index(self.session).search(query)]
+            search = [self.text, [m for m in matches if m != self.text]]
+        if not search[1]:
+            # Can't access app.output.bell()
+            print("\a", end='')
+            sys.stdout.flush()
+            self._search_all_history = None
+            return
+        self.text = search[0] = search[1].pop(0)
+        self.cursor_position = len(self.text)
+        self._search_all_history = search
 
     @contextmanager
     def disable_history(self):
@@ -274,6 +479,9 @@ class MyBuffer(Buffer):
 
 def on_text_changed(buffer):
     buffer.multiline_history_search_index = None
+    if buffer.fuzzy_history_search and buffer._fuzzy_index is not None:
+        # Stop searching for the old text
+        buffer._fuzzy_index.cancel()
     buffer._show_syntax_warning = False
     buffer.ai_suggestion_index = 0
     buffer.ai_suggestions.clear()
@@ -296,7 +504,7 @@ def validate_text(text):
             magic, text = text.split(' ', 1)
             text = text.lstrip()
 
-    compile(text, "<None>", 'exec')
+    compile(text, "<None>", 'exec', flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
 
 class PythonSyntaxValidator(Validator):
     def validate(self, document):
@@ -346,6 +554,7 @@ def default_history_filename():
 
 NO_PROMPT_MODE = False
 DOCTEST_MODE = False
+AUTOCOMPLETE_MODE = False
 DEBUG = False
 
 _sysargv0 = sys.argv[0]
@@ -419,6 +628,8 @@ def underline(text):
     return '\033[4m%s\033[0m' % text
 
 def myhelp(item):
+    from pydoc import pager, Helper
+
     help_io = StringIO()
     helper = Helper(output=help_io)
 
@@ -555,6 +766,7 @@ def getsource(command, _globals, _locals, ret=False, include_info=True):
             source = info + source
         if ret:
             return source
+        from pydoc import pager
         pager(highlight(source, Python3Lexer(),
             TerminalTrueColorFormatter(style=OneAMStyle)))
     finally:
@@ -611,9 +823,150 @@ class NoResult:
     pass
 
 mypython_dir = os.path.dirname(__file__)
+asyncio_dir = os.path.dirname(asyncio.__file__)
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+def _replace_filename(code, filename):
+    """
+    Return a copy of the code object code with co_filename set to filename,
+    including any nested code objects (functions, classes, comprehensions).
+    """
+    if code.co_filename == filename:
+        return code
+    consts = tuple(_replace_filename(c, filename) if isinstance(c, types.CodeType)
+                   else c for c in code.co_consts)
+    return code.replace(co_filename=filename, co_consts=consts)
+
+class CodeCache:
+    """
+    LRU cache of the code objects compiled by smart_eval()
+
+    The cache is keyed on (source, flags, ast_transformer). The filename is
+    not part of the key, since it is different for every prompt. Instead,
+    cached code objects are rebound to the new filename on a hit.
+    """
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        # Background jobs (%bg) compile in their own threads
+        self._lock = threading.Lock()
+
+    def compile(self, stmt, filename, flags, ast_transformer=None):
+        """
+        Return (code, expr_code) for stmt
+
+        code is compiled in 'exec' mode. expr_code is the final expression in
+        stmt compiled in 'eval' mode, or None if stmt does not end in an
+        expression.
+        """
+        key = (stmt, flags, ast_transformer)
+        with self._lock:
+            try:
+                code, expr_code = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                hit = False
+            except TypeError:
+                # Unhashable ast_transformer
+                self.misses += 1
+                key = None
+                hit = False
+            else:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                hit = True
+        if key is None:
+            return self._compile(stmt, filename, flags, ast_transformer)
+        if hit:
+            code = _replace_filename(code, filename)
+            if expr_code is not None:
+                expr_code = _replace_filename(expr_code, filename)
+            return code, expr_code
+
+        code, expr_code = self._compile(stmt, filename, flags, ast_transformer)
+        if self.maxsize:
+            with self._lock:
+                self._cache[key] = code, expr_code
+                if len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        return code, expr_code
+
+    def _compile(self, stmt, filename, flags, ast_transformer):
+        p = ast.parse(stmt)
+        if ast_transformer:
+            p = ast_transformer(p)
+        expr = expr_code = None
+        if p.body and isinstance(p.body[-1], ast.Expr):
+            expr = p.body.pop()
+        code = compile(p, filename, 'exec', flags=flags)
+        if expr:
+            expr_code = compile(ast.Expression(expr.value), filename, 'eval', flags=flags)
+        return code, expr_code
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+CODE_CACHE = CodeCache()
+
+def run_coroutine(coro, loop=None):
+    """
+    Run the coroutine coro on the event loop loop and return the result.
+
+    If loop is None, coro is run in a new event loop with asyncio.run().
+
+    If running coro is interrupted (e.g., by a KeyboardInterrupt), the task is
+    cancelled, so that it doesn't resume the next time the loop runs.
+    """
+    if loop is None:
+        return asyncio.run(coro)
+
+    task = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(task)
+    except BaseException:
+        if not task.done():
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except BaseException:
+                pass
+        raise
+
+def is_async(code):
+    """
+    Return True if the code object code uses top-level await
+    """
+    return bool(code and code.co_flags & inspect.CO_COROUTINE)
+
+async def _async_eval(code, expr_code, _globals, _locals):
+    """
+    The same as the exec/eval in smart_eval(), but run inside of the event
+    loop, so that the code can use top-level await.
+    """
+    res = NoResult
+    # eval() of code compiled with top-level await returns a coroutine
+    # instead of running it.
+    if is_async(code):
+        await eval(code, _globals, _locals)
+    else:
+        exec(code, _globals, _locals)
+    if expr_code:
+        res = eval(expr_code, _globals, _locals)
+        if is_async(expr_code):
+            res = await res
+    return res
 
 def smart_eval(stmt, _globals, _locals, filename=None, *,
-               flags=annotations.compiler_flag, ast_transformer=None):
+               flags=annotations.compiler_flag | ast.PyCF_ALLOW_TOP_LEVEL_AWAIT,
+               ast_transformer=None, loop=None):
     """
     Automatically exec/eval stmt.
 
@@ -629,7 +982,11 @@ def smart_eval(stmt, _globals, _locals, filename=None, *,
     with >, and be unique for each stmt.
 
     flags is a set of flags to be passed to compile(). The default is to use
-    from __future__ import annotations.
+    from __future__ import annotations and to allow top-level await.
+
+    If stmt uses top-level await (or async for or async with), it is run on
+    the asyncio event loop loop. If loop is None, a new event loop is created
+    for it (see run_coroutine()).
 
     Note that classes defined with this will have their module set to
     '__main__'.  To change this, set _globals['__name__'] to the desired
@@ -638,6 +995,10 @@ def smart_eval(stmt, _globals, _locals, filename=None, *,
     To transform the ast before compiling it, pass in an ast_transformer
     function. It should take in an ast and return a new ast.
 
+    The compiled code is cached in CODE_CACHE, so running the same stmt again
+    (with the same flags and ast_transformer) does not parse or compile it
+    again. Use CODE_CACHE.cache_info() to see the hits and misses.
+
     Examples:
 
         >>> g = l = {}
@@ -658,23 +1019,45 @@ def smart_eval(stmt, _globals, _locals, filename=None, *,
     else:
         filename = mypython_file()
 
-    p = ast.parse(stmt)
-    if ast_transformer:
-        p = ast_transformer(p)
-    expr = None
     res = NoResult
-    if p.body and isinstance(p.body[-1], ast.Expr):
-        expr = p.body.pop()
-    code = compile(p, filename, 'exec', flags=flags)
+    code, expr_code = CODE_CACHE.compile(stmt, filename, flags, ast_transformer)
+    if is_async(code) or is_async(expr_code):
+        return run_coroutine(_async_eval(code, expr_code, _globals, _locals), loop)
+
     exec(code, _globals, _locals)
-    if expr:
-        code = compile(ast.Expression(expr.value), filename, 'eval', flags=flags)
-        res = eval(code, _globals, _locals)
+    if expr_code:
+        res = eval(expr_code, _globals, _locals)
 
     return res
 
+# Builtin names that are reset after every command, even if they were
+# redefined. Immutable names cannot be exempt because we cannot detect if they
+# are redefined.
+RESET_BUILTINS = ['_', '__', '___', 'PROMPT_NUMBER', '_PROMPT']
+
+def apply_job_results(prompt):
+    """
+    Save the results of the background jobs that have finished to Out[n] and _n
+    """
+    while prompt.job_results:
+        n, res, _locals = prompt.job_results.popleft()
+        prompt.Out[n] = res
+        prompt.builtins['_%s' % n] = res
+        _locals['_%s' % n] = res
+
 def pre_command(*, command, _globals, _locals, prompt):
+    apply_job_results(prompt)
+    prompt.resource_monitor.start()
     prompt.timings[prompt.prompt_number] = time.perf_counter()
+    prompt.Out.touch_source(command)
+
+    # Restore any _n names used by the command that were del-ed. This is done
+    # here rather than in post_command so that post_command doesn't need to
+    # loop over every output.
+    for n in output_numbers(command):
+        name = '_%s' % n
+        if name in prompt.builtins:
+            _locals.setdefault(name, prompt.builtins[name])
 
 def post_command(*, command, res, _globals, _locals, prompt):
     PROMPT_NUMBER = prompt.prompt_number
@@ -682,7 +1065,11 @@ def post_command(*, command, res, _globals, _locals, prompt):
         prompt.timings[PROMPT_NUMBER] = float('nan')
     else:
         prompt.timings[PROMPT_NUMBER] = time.perf_counter() - prompt.timings[PROMPT_NUMBER]
+    prompt.resources[PROMPT_NUMBER] = prompt.resource_monitor.stop()._replace(
+        wall=prompt.timings[PROMPT_NUMBER])
     prompt.In[PROMPT_NUMBER] = command
+    prompt.jedi_document.add(PROMPT_NUMBER, command)
+    prompt.namespace_version += 1
     builtins = prompt.builtins
 
     if res is not NoResult:
@@ -701,17 +1088,140 @@ def post_command(*, command, res, _globals, _locals, prompt):
 
     # Allow the mutable builtin names to be redefined without mypython resetting them. If
     # they are del-ed, they will be restored to the builtin versions.
-    # Immutable names exempt from this because we cannot detect if they are
-    # redefined.
-    # TODO: Handle this better?
-    for name in prompt.builtins:
-        if name in ['_', '__', '___', 'PROMPT_NUMBER', '_PROMPT']:
-            _locals[name] = prompt.builtins[name]
-        else:
-            _locals.setdefault(name, builtins[name])
+    # Only the names that can change are synced here, not every _n, so that
+    # the overhead of each command doesn't grow with the number of outputs.
+    for name in RESET_BUILTINS:
+        if name in builtins:
+            _locals[name] = builtins[name]
+    for name in prompt.builtin_names:
+        _locals.setdefault(name, builtins[name])
+    if res is not NoResult:
+        _locals.setdefault('_%s' % PROMPT_NUMBER, res)
+    apply_job_results(prompt)
+    prompt.name_index.update(_locals)
+
+
+class BaseSession:
+    """
+    The parts of a mypython session that are needed to execute commands
+
+    This is everything that execute_command() uses, i.e., the builtin names
+    (In, Out, PROMPT_NUMBER, ...), and the displayhook and excepthook. It does
+    not depend on a prompt_toolkit Application. See Session and BatchSession.
+    """
+    def startup(self, builtins=None):
+        exec("""
+import sys
+sys.path.insert(0, '.')
+del sys
+    """, self._globals, self._locals)
+
+        builtins = builtins or {}
+
+        self.In = builtins['In'] = {}
+        self.jedi_document = SessionDocument()
+        # Incremented after every command, for the completion cache
+        self.namespace_version = 0
+        # The names in _locals, for DirCompleter. Updated after every command.
+        self.name_index = NameIndex()
+        self.Out = builtins['Out'] = OutCache(on_evict=self._output_evicted,
+            on_load=self._output_loaded, spill_dir=SpillDirectory())
+        self.timings = builtins['TIMINGS'] = {}
+        self.resources = {}
+        self.resource_monitor = ResourceMonitor()
+        self.prompt_number = builtins['PROMPT_NUMBER'] = 1
+        # (n, result, _locals) for the %bg jobs that have finished. See
+        # apply_job_results().
+        self.job_results = deque()
+        builtins['_PROMPT'] = self
+        self._event_loop = None
+        # The builtin names other than _n and RESET_BUILTINS
+        self.builtin_names = [name for name in builtins if name not in RESET_BUILTINS]
 
+        self._locals.update(builtins)
 
-class Session(PromptSession):
+        if not self.quiet:
+            if sys.version_info[3] == 'final':
+                python_version = '.'.join(map(str, sys.version_info[:3]))
+            else:
+                python_version = '.'.join(map(str, sys.version_info))
+            info = "%s (Python %s, prompt_toolkit %s)" % (sys.executable,
+                python_version, prompt_toolkit_version)
+            if self.history_file:
+                info += " History file: %s" % self.history_file
+            print_formatted_text(MyPygmentsTokens([
+                (Token.Welcome, "Welcome to mypython.\n"),
+                (Token.WelcomeInfo, info + "\n"),
+            ]))
+
+        sys.displayhook = mypython_displayhook
+        sys.excepthook = mypython_excepthook
+
+        # This doesn't work, and the postimport stuff leaks through on things
+        # like import errors.
+
+        # from .postimport import when_imported
+
+        # @when_imported('matplotlib')
+        # def matplotlib_interactive(matplotlib):
+        #     print("Calling matplotlib.interactive(True)")
+        #     matplotlib.interactive(True)
+
+        self.builtins = builtins
+
+        try:
+            from setproctitle import setproctitle
+
+            setproctitle('mypython')
+        except ImportError:
+            print("Warning: Could not set the terminal title. setproctitle not installed.",
+                  file=sys.stderr)
+
+        setup_keyboard_interrupt_handler()
+
+    def _output_evicted(self, n):
+        """
+        Delete _n when Out[n] is evicted from the output cache
+        """
+        name = '_%s' % n
+        value = self.builtins.pop(name, None)
+        if name in self._locals and self._locals[name] is value:
+            del self._locals[name]
+
+    def _output_loaded(self, n, value):
+        """
+        Restore _n when Out[n] is loaded from the spill directory
+        """
+        name = '_%s' % n
+        self.builtins[name] = value
+        self._locals.setdefault(name, value)
+
+    @property
+    def event_loop(self):
+        """
+        The asyncio event loop used for top-level await
+
+        The same loop is used for every command, so that things like async
+        clients and connection pools that are tied to a loop keep working
+        across prompts.
+        """
+        if self._event_loop is None or self._event_loop.is_closed():
+            self._event_loop = asyncio.new_event_loop()
+        return self._event_loop
+
+    def get_out_prompt(self):
+        if DOCTEST_MODE or NO_PROMPT_MODE:
+            return MyPygmentsTokens([])
+        return MyPygmentsTokens([
+            (Token.Emoji, self.OUT),
+            (Token.OutBracket, '['),
+            (Token.OutNumber, str(self.prompt_number)),
+            (Token.OutBracket, ']'),
+            (Token.OutColon, ':'),
+            (Token.Space, ' '),
+        ])
+
+class Session(BaseSession, PromptSession):
     def __init__(self, *args, _globals, _locals, message=None,
         key_bindings=None, history_file=None, IN_OUT=None, builtins=None,
         quiet=False, ai_auto_suggest=None, **kwargs):
@@ -723,7 +1233,8 @@ class Session(PromptSession):
 
         os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
 
-        kwargs.setdefault('history', FileHistory(self.history_file))
+        kwargs.setdefault('history', IndexedFileHistory(self.history_file))
+        self.history_index = HistoryIndex(os.path.dirname(self.history_file))
         kwargs.setdefault('key_bindings', key_bindings or get_key_bindings())
         kwargs.setdefault('message', message or self.get_in_prompt)
         kwargs.setdefault('lexer', PygmentsLexer(MyPython3Lexer))
@@ -779,58 +1290,22 @@ class Session(PromptSession):
         self.ai_auto_suggest = ai_auto_suggest or OllamaSuggester()
         super().__init__(*args, **kwargs)
 
-    def startup(self, builtins=None):
-        exec("""
-import sys
-sys.path.insert(0, '.')
-del sys
-    """, self._globals, self._locals)
-
-        builtins = builtins or {}
-
-        self.In = builtins['In'] = {}
-        self.Out = builtins['Out'] = {}
-        self.timings = builtins['TIMINGS'] = {}
-        self.prompt_number = builtins['PROMPT_NUMBER'] = 1
-        builtins['_PROMPT'] = self
-
-        self._locals.update(builtins)
-
-        if not self.quiet:
-            if sys.version_info[3] == 'final':
-                python_version = '.'.join(map(str, sys.version_info[:3]))
-            else:
-                python_version = '.'.join(map(str, sys.version_info))
-            print_formatted_text(MyPygmentsTokens([
-                (Token.Welcome, "Welcome to mypython.\n"),
-                (Token.WelcomeInfo, "%s (Python %s, prompt_toolkit %s) History file: %s\n" %
-                 (sys.executable, python_version, prompt_toolkit_version, self.history_file)),
-            ]))
-
-        sys.displayhook = mypython_displayhook
-        sys.excepthook = mypython_excepthook
-
-        # This doesn't work, and the postimport stuff leaks through on things
-        # like import errors.
-
-        # from .postimport import when_imported
-
-        # @when_imported('matplotlib')
-        # def matplotlib_interactive(matplotlib):
-        #     print("Calling matplotlib.interactive(True)")
-        #     matplotlib.interactive(True)
-
-        self.builtins = builtins
-
-        try:
-            from setproctitle import setproctitle
+        # Only run for the first prompt
+        self.app.pre_run_callables.append(self._schedule_warm_up)
 
-            setproctitle('mypython')
-        except ImportError:
-            print("Warning: Could not set the terminal title. setproctitle not installed.",
-                  file=sys.stderr)
+    def _schedule_warm_up(self):
+        # This is called before the prompt is drawn. call_soon() runs
+        # start_warm_up() once the event loop is idle, after the first render.
+        asyncio.get_running_loop().call_soon(self.start_warm_up)
 
-        setup_keyboard_interrupt_handler()
+    def start_warm_up(self):
+        """
+        Start importing and warming up Jedi in a background thread
+        """
+        thread = threading.Thread(target=warm_up_jedi, args=(self._locals,),
+                                  name='mypython-jedi-warm-up', daemon=True)
+        thread.start()
+        return thread
 
     def get_in_prompt(self):
         if iterm2_tools:
@@ -878,18 +1353,6 @@ del sys
             (Token.Space, ' '),
         ])
 
-    def get_out_prompt(self):
-        if DOCTEST_MODE or NO_PROMPT_MODE:
-            return MyPygmentsTokens([])
-        return MyPygmentsTokens([
-            (Token.Emoji, self.OUT),
-            (Token.OutBracket, '['),
-            (Token.OutNumber, str(self.prompt_number)),
-            (Token.OutBracket, ']'),
-            (Token.OutColon, ':'),
-            (Token.Space, ' '),
-        ])
-
     def _create_default_buffer(self):
         def accept(buffer):
             """ Accept the content of the default buffer. This is called when
@@ -905,20 +1368,29 @@ del sys
             return document_is_multiline_python(buffer.document)
 
         multiline = Condition(is_buffer_multiline)
+
+        def get_completer():
+            if buffer.fuzzy_history_search:
+                return ThreadedCompleter(buffer.fuzzy_completer)
+            if AUTOCOMPLETE_MODE and as_you_type_completer:
+                return as_you_type_completer
+            if self.complete_in_thread and self.completer:
+                return ThreadedCompleter(self.completer)
+            return self.completer
+
         buffer = MyBuffer(
             name=DEFAULT_BUFFER,
             enable_history_search=False,
             multiline=multiline,
             validator=PythonSyntaxValidator(),
             history=self.history,
-            completer=DynamicCompleter(lambda:
-                ThreadedCompleter(self.completer)
-                if self.complete_in_thread and self.completer
-                else self.completer),
-            # Needs to be False until
+            completer=DynamicCompleter(get_completer),
+            # Off by default until
             # https://github.com/jonathanslenders/python-prompt-toolkit/issues/472
-            # is fixed.
-            complete_while_typing=False,
+            # is fixed. The fuzzy history search always updates as you type,
+            # and %autocomplete turns it on for Python completions.
+            complete_while_typing=Condition(lambda: buffer.fuzzy_history_search
+                                            or AUTOCOMPLETE_MODE),
             on_text_changed=on_text_changed,
             on_cursor_position_changed=on_text_changed,
             tempfile_suffix='.py',
@@ -926,6 +1398,8 @@ del sys
             session=self,
             ai_auto_suggest=self.ai_auto_suggest,
         )
+        as_you_type_completer = (AsYouTypeCompleter(self.completer, buffer)
+                                 if self.completer else None)
         return buffer
 
     def _create_layout(self):
@@ -973,6 +1447,28 @@ del sys
         new_layout = HSplit(layout.container.children + [bottom_toolbar])
         return Layout(new_layout)
 
+class BatchSession(BaseSession):
+    """
+    Session for running commands without a prompt (mypython --batch)
+
+    This has the same builtin names, displayhook, and excepthook as Session,
+    but doesn't create a prompt_toolkit Application, so nothing is rendered.
+    The history is kept in memory only.
+    """
+    def __init__(self, *, _globals, _locals, IN_OUT=None, builtins=None,
+        quiet=False):
+        self.history_file = None
+        self.history = InMemoryHistory()
+
+        self._globals = _globals
+        self._locals = _locals
+        self.quiet = quiet
+
+        self.startup(builtins=builtins)
+        if not IN_OUT:
+            IN_OUT = random.choice(emoji)
+        self.IN, self.OUT = IN_OUT
+
 def add_ansi_at_columns(ansi_line, start_col, end_col, start_code, end_code):
     """Insert ANSI escape codes at visible-column positions in an ANSI-formatted line.
 
@@ -1081,11 +1577,16 @@ class MyTracebackException(traceback.TracebackException):
 
         new_stack = MyStackSummary()
         mypython_error = None
+        seen_input = False
         for frame in self.stack[:]:
-            if frame.filename.startswith(mypython_dir):
+            # asyncio frames before the input come from running top-level
+            # await in smart_eval().
+            if (frame.filename.startswith(mypython_dir) or
+                not seen_input and frame.filename.startswith(asyncio_dir)):
                 if mypython_error is False:
                     mypython_error = True
             elif frame.filename.startswith('<mypython'):
+                seen_input = True
                 if DOCTEST_MODE:
                     filename, lineno, name, line = frame
                     new_stack.append(traceback.FrameSummary("<stdin>", lineno, name))
@@ -1286,11 +1787,14 @@ def execute_command(command, prompt, *, _globals=None, _locals=None):
                     print()
                 return status
 
-            res = smart_eval(command, _globals, _locals, filename=mypython_file(prompt.prompt_number))
+            res = smart_eval(command, _globals, _locals,
+                filename=mypython_file(prompt.prompt_number),
+                loop=prompt.event_loop)
         except SystemExit:
             raise
-        except BaseException:
+        except BaseException as e:
             status = False
+            prompt.Out.annotate_exception(e)
             sys.excepthook(*sys.exc_info())
             o.set_command_status(1)
             res = NoResult
@@ -1311,16 +1815,35 @@ CMD_QUEUE = deque()
 
 def run_shell(_globals=_default_globals, _locals=_default_locals, *,
     quiet=False, cmd=None, history_file=None, _exit=False,
-    IN_OUT=None):
+    IN_OUT=None, kernel=False):
 
-    prompt = Session(_globals=_globals, _locals=_locals, quiet=quiet,
-        history_file=history_file, IN_OUT=IN_OUT)
+    if kernel:
+        from .kernel import Kernel
+
+        # The front namespace only has the names from the kernel, for
+        # completion and pyflakes
+        _globals = _locals = {}
+        kernel = Kernel(names=_locals)
 
     if cmd:
         if isinstance(cmd, str):
             cmd = [cmd]
         CMD_QUEUE.extend(cmd)
 
+    # Start importing SymPy as early as possible if it is going to be used.
+    # This is pointless in kernel mode, since SymPy is used in the kernel.
+    if not kernel and (any(c.strip() in ('%sympy', '%isympy') for c in CMD_QUEUE)
+        or history_uses_sympy(history_file or default_history_filename())):
+        preload_sympy()
+
+    prompt = Session(_globals=_globals, _locals=_locals, quiet=quiet,
+        history_file=history_file, IN_OUT=IN_OUT)
+
+    if kernel:
+        kernel.IN_OUT = (prompt.IN, prompt.OUT)
+        kernel.start(prompt_number=prompt.prompt_number)
+        atexit.register(kernel.stop)
+
     exitcode = 0
     while True:
         try:
@@ -1333,11 +1856,16 @@ def run_shell(_globals=_default_globals, _locals=_default_locals, *,
             elif _exit:
                 return exitcode
 
+            # In kernel mode, the names from the previous command may have
+            # arrived before the prompt started
+            pre_run = kernel.apply_pending if kernel else None
             if is_cmd_command:
                 with prompt.default_buffer.disable_history():
-                    command = prompt.prompt(default=default, accept_default=default)
+                    command = prompt.prompt(default=default,
+                        accept_default=default, pre_run=pre_run)
             else:
-                command = prompt.prompt(default=default, accept_default=default)
+                command = prompt.prompt(default=default, accept_default=default,
+                    pre_run=pre_run)
         except KeyboardInterrupt:
             # TODO: Keep it in the history
             print("KeyboardInterrupt\n", file=sys.stderr)
@@ -1349,6 +1877,101 @@ def run_shell(_globals=_default_globals, _locals=_default_locals, *,
         except:
             sys.excepthook(*sys.exc_info())
 
-        res = execute_command(command, prompt, _globals=_globals, _locals=_locals)
+        if kernel:
+            from .kernel import execute_in_kernel
+            try:
+                res = execute_in_kernel(command, prompt, kernel)
+            except SystemExit as e:
+                return e.code
+        else:
+            res = execute_command(command, prompt, _globals=_globals, _locals=_locals)
         if cmd:
             exitcode |= res
+
+CONTINUATION_KEYWORDS = re.compile(r'(else|elif|except|finally)\b')
+
+def split_statements(text):
+    """
+    Split text into top-level statements
+
+    A new statement starts at each unindented line, unless the text so far
+    is not yet valid (like a decorator or an unclosed parenthesis), or the
+    line continues a compound statement (like else:).
+
+    >>> split_statements('''
+    ... a = 1
+    ... def f():
+    ...     return a
+    ...
+    ... if a:
+    ...     pass
+    ... else:
+    ...     pass
+    ... %time f()
+    ... ''')
+    ['a = 1', 'def f():\\n    return a', 'if a:\\n    pass\\nelse:\\n    pass', '%time f()']
+
+    """
+    def is_valid(lines):
+        try:
+            validate_text(dedent('\n'.join(lines)))
+        except SyntaxError:
+            return False
+        return True
+
+    statements = []
+    lines = []
+    for line in text.splitlines():
+        if (lines and line and not line[0].isspace()
+            and not CONTINUATION_KEYWORDS.match(line) and is_valid(lines)):
+            statements.append('\n'.join(lines))
+            lines = []
+        lines.append(line)
+    statements.append('\n'.join(lines))
+
+    return [i.strip() for i in statements if i.strip()]
+
+def split_batch_input(text):
+    """
+    Split the input for --batch into commands
+
+    Text copied from a mypython, Python, or IPython session is split using
+    the prompts (see keys.split_prompts()). Otherwise, it is split into
+    top-level statements.
+    """
+    if any(PS1_PROMPTS_RE.match(line) for line in text.splitlines()):
+        return [i for i in split_prompts(text) if i.strip()]
+    return split_statements(text)
+
+def run_batch(file, _globals=_default_globals, _locals=_default_locals, *,
+    quiet=True, cmd=None, IN_OUT=None):
+    """
+    Run the commands in file without a prompt
+
+    file can be a filename, '-' for stdin, or a file object. The commands are
+    executed exactly as if they were typed at the prompt, so the In, Out and
+    _N names, and the printed output, are the same. Any cmd commands are run
+    first.
+
+    Returns the exit code, which is 1 if any command failed and 0 otherwise.
+    """
+    prompt = BatchSession(_globals=_globals, _locals=_locals, quiet=quiet,
+        IN_OUT=IN_OUT)
+
+    if file == '-':
+        text = sys.stdin.read()
+    elif isinstance(file, str):
+        with open(file) as f:
+            text = f.read()
+    else:
+        text = file.read()
+
+    if isinstance(cmd, str):
+        cmd = [cmd]
+    commands = list(cmd or []) + split_batch_input(text)
+
+    exitcode = 0
+    for command in commands:
+        if not execute_command(command, prompt, _globals=_globals, _locals=_locals):
+            exitcode = 1
+    return exitcode
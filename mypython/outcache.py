@@ -0,0 +1,380 @@
+"""
+Memory-bounded storage for Out
+
+Every result is saved to Out[n] and _n. To keep old outputs from using an
+unbounded amount of memory, Out has a memory budget. When the (approximate)
+total size of the outputs goes over the budget, the least recently used
+outputs are evicted. Evicted outputs are removed from Out and _n is deleted.
+
+If the session has a spill directory, evicted outputs are saved to disk
+instead (see spill.py), and loaded again the next time they are used, either
+with Out[n] or by a command that uses _n. Only outputs that cannot be
+pickled are lost.
+
+Use the %outcache magic to see the memory usage, change the budget, or pin
+outputs so that they are never evicted.
+"""
+
+import os
+import re
+import sys
+from collections import OrderedDict
+
+from . import spill
+
+# 1 GiB
+DEFAULT_BUDGET = 2**30
+
+# Containers with more items than this are estimated from a sample
+SAMPLE_SIZE = 100
+
+# How deep to recurse into nested containers when estimating their size
+MAX_DEPTH = 3
+
+OUTPUT_NAME = re.compile(r'\b(?:_(\d+)\b|Out\[(\d+)\])')
+
+def output_numbers(source):
+    """
+    Return the numbers n of the outputs that source uses as _n or Out[n]
+
+    >>> output_numbers('_1 + Out[2] + _a + x_3')
+    [1, 2]
+    """
+    return [int(m.group(1) or m.group(2)) for m in OUTPUT_NAME.finditer(source)]
+
+class EvictedError(KeyError):
+    """
+    Raised when accessing an output that was evicted from the Out cache
+    """
+    def __init__(self, n):
+        super().__init__(n)
+        self.n = n
+
+    def __str__(self):
+        return evicted_message(self.n)
+
+def evicted_message(n):
+    return ("Out[%s] was evicted from the output cache. Use %%outcache to "
+            "see the memory usage, or %%outcache pin to keep outputs." % n)
+
+def estimate_size(obj, _depth=0, _seen=None):
+    """
+    Estimate the memory used by obj, in bytes.
+
+    This is sys.getsizeof(obj), except objects with a buffer (such as NumPy
+    arrays, bytes, and memoryviews) are counted by the size of their buffer,
+    and the items of builtin containers are included. Large containers are
+    estimated from a sample of their items.
+
+    >>> estimate_size(bytes(10000)) >= 10000
+    True
+    >>> estimate_size([bytes(10000)]*10) >= 10000
+    True
+    >>> estimate_size([bytes(10000) for i in range(10)]) >= 100000
+    True
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    try:
+        size = sys.getsizeof(obj)
+    except Exception:
+        size = 0
+
+    nbytes = getattr(obj, 'nbytes', None)
+    if isinstance(nbytes, int):
+        size = max(size, nbytes)
+    elif not isinstance(obj, (str, int, float)):
+        try:
+            with memoryview(obj) as m:
+                size = max(size, m.nbytes)
+        except Exception:
+            pass
+
+    if _depth >= MAX_DEPTH:
+        return size
+
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        items = obj
+    else:
+        return size
+
+    n = len(items)
+    if not n:
+        return size
+    items_size = 0
+    for i, item in enumerate(items):
+        if i >= SAMPLE_SIZE:
+            break
+        if isinstance(obj, dict):
+            key, value = item
+            items_size += (estimate_size(key, _depth + 1, _seen)
+                           + estimate_size(value, _depth + 1, _seen))
+        else:
+            items_size += estimate_size(item, _depth + 1, _seen)
+    if n > SAMPLE_SIZE:
+        items_size = items_size*n//SAMPLE_SIZE
+    return size + items_size
+
+def format_size(nbytes):
+    """
+    Format a number of bytes
+
+    >>> format_size(100)
+    '100 B'
+    >>> format_size(2**30*1.5)
+    '1.5 GiB'
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(nbytes) < 1024:
+            break
+        nbytes /= 1024
+    else:
+        unit = 'TiB'
+    if unit == 'B':
+        return '%d B' % nbytes
+    return '%.3g %s' % (nbytes, unit)
+
+def parse_size(s):
+    """
+    Parse a size like '500MB' or '2 GiB' into a number of bytes
+
+    >>> parse_size('2GB')
+    2147483648
+    >>> parse_size('100')
+    100
+    """
+    m = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*([kmgt]?)i?b?\s*', s, re.IGNORECASE)
+    if not m:
+        raise ValueError("invalid size: %r" % s)
+    number, unit = m.groups()
+    return int(float(number)*1024**' kmgt'.index(unit.lower() or ' '))
+
+class OutCache(dict):
+    """
+    dict of the outputs of each prompt, with a memory budget
+
+    The entries are kept in least recently used order. An entry is used when
+    it is set, when it is looked up with Out[n], and when a command refers to
+    it by name (see touch_source()). When the total estimated size goes over
+    budget, the least recently used entries are evicted, except for pinned
+    entries and the most recently set or loaded output.
+
+    If spill_dir is a spill.SpillDirectory, evicted entries are saved to it,
+    and loaded again when they are used. Note that spilled entries are not
+    in the dict itself (e.g., when iterating over it) until they are loaded.
+
+    on_evict(n) is called for each evicted or spilled entry, and
+    on_load(n, value) is called for each entry that is loaded from disk.
+    """
+    def __init__(self, budget=DEFAULT_BUDGET, on_evict=None, on_load=None,
+                 spill_dir=None):
+        super().__init__()
+        self.budget = budget
+        self.on_evict = on_evict
+        self.on_load = on_load
+        self.spill_dir = spill_dir
+        self.sizes = OrderedDict()
+        self.total = 0
+        self.pinned = set()
+        self.last = None
+        # n -> (type name, size)
+        self.evicted = {}
+        # n -> (type name, size, filename)
+        self.spilled = {}
+
+    def __setitem__(self, n, value):
+        if n in self or n in self.spilled:
+            del self[n]
+        self.evicted.pop(n, None)
+        self._add(n, value, estimate_size(value))
+        self.last = n
+        self.evict()
+
+    def _add(self, n, value, size):
+        super().__setitem__(n, value)
+        self.sizes[n] = size
+        self.total += size
+
+    def __getitem__(self, n):
+        if n in self.evicted:
+            raise EvictedError(n)
+        if n in self.spilled:
+            return self.load(n)
+        value = super().__getitem__(n)
+        self.sizes.move_to_end(n)
+        return value
+
+    def __delitem__(self, n):
+        if n in self.spilled:
+            self._remove_spilled(n)
+            return
+        super().__delitem__(n)
+        self.total -= self.sizes.pop(n)
+        self.pinned.discard(n)
+
+    def get(self, n, default=None):
+        if n in self.spilled or n in self:
+            return self[n]
+        return default
+
+    def pop(self, n, *args):
+        if n in self.spilled:
+            # Don't add it to the cache (and evict other entries) just to
+            # remove it
+            value = spill.load(self.spilled[n][2])
+            self._remove_spilled(n)
+            return value
+        if n not in self:
+            return super().pop(n, *args)
+        value = super().__getitem__(n)
+        del self[n]
+        return value
+
+    def clear(self):
+        super().clear()
+        for n in list(self.spilled):
+            self._remove_spilled(n)
+        self.sizes.clear()
+        self.pinned.clear()
+        self.total = 0
+
+    def _remove_spilled(self, n):
+        type_name, size, filename = self.spilled.pop(n)
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def load(self, n):
+        """
+        Load Out[n] from the spill directory, and return it
+        """
+        type_name, size, filename = self.spilled[n]
+        value = spill.load(filename)
+        # The loaded buffers are private memory maps, so the file is not
+        # needed any more. If Out[n] is evicted again, it is saved again.
+        self._remove_spilled(n)
+        self._add(n, value, size)
+        if self.on_load:
+            self.on_load(n, value)
+        self.last = n
+        self.evict()
+        return value
+
+    def touch(self, n):
+        """
+        Mark Out[n] as recently used, loading it if it was spilled to disk
+        """
+        if n in self.spilled:
+            self.load(n)
+        elif n in self.sizes:
+            self.sizes.move_to_end(n)
+
+    def touch_source(self, source):
+        """
+        Mark the outputs that source refers to (as _n or Out[n]) as recently
+        used
+        """
+        for n in output_numbers(source):
+            self.touch(n)
+
+    def pin(self, n):
+        if n in self.evicted:
+            raise EvictedError(n)
+        if n in self.spilled:
+            self.load(n)
+        if n not in self:
+            raise KeyError(n)
+        self.pinned.add(n)
+
+    def unpin(self, n):
+        self.pinned.discard(n)
+        self.evict()
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.evict()
+
+    def evict(self):
+        """
+        Evict least recently used entries until the total size is under
+        budget
+
+        Pinned entries and the most recently set or loaded entry are never
+        evicted. Entries are saved to the spill directory if there is one.
+        """
+        if self.total <= self.budget:
+            return
+        for n in list(self.sizes):
+            if self.total <= self.budget:
+                break
+            if n in self.pinned or n == self.last:
+                continue
+            value = super().__getitem__(n)
+            size = self.sizes[n]
+            filename = self._spill(n, value)
+            del self[n]
+            if filename:
+                self.spilled[n] = (type(value).__name__, size, filename)
+            else:
+                self.evicted[n] = (type(value).__name__, size)
+            del value
+            if self.on_evict:
+                self.on_evict(n)
+
+    def _spill(self, n, value):
+        """
+        Save value to the spill directory. Returns the filename, or None if it
+        could not be saved.
+        """
+        if self.spill_dir is None:
+            return None
+        try:
+            filename = self.spill_dir.filename('Out-%s' % n)
+            spill.dump(value, filename)
+        except Exception:
+            return None
+        return filename
+
+    def annotate_exception(self, exc):
+        """
+        If exc is a NameError for an evicted _n, change its message to say
+        that the output was evicted.
+        """
+        if not isinstance(exc, NameError):
+            return
+        name = getattr(exc, 'name', None)
+        if name is None:
+            # NameError.name is new in Python 3.10
+            m = re.fullmatch(r"name '(\w+)' is not defined", str(exc))
+            if not m:
+                return
+            name = m.group(1)
+        m = re.fullmatch(r'_(\d+)', name)
+        # Spilled outputs are loaded before the command runs, so only evicted
+        # outputs can be missing.
+        if m and int(m.group(1)) in self.evicted:
+            exc.args = (evicted_message(int(m.group(1))),)
+            # Don't suggest other names
+            exc.name = None
+
+    def print_usage(self, file=None):
+        file = file or sys.stdout
+        print("Output cache: %s of %s (%d outputs, %d pinned, %d evicted)" % (
+            format_size(self.total), format_size(self.budget), len(self),
+            len(self.pinned), len(self.evicted)), file=file)
+        if self.spilled:
+            print("Spilled to disk: %d outputs (%s) in %s" % (len(self.spilled),
+                format_size(sum(os.path.getsize(f) for _, _, f in self.spilled.values())),
+                self.spill_dir.path), file=file)
+        largest = sorted(self.sizes.items(), key=lambda i: i[1], reverse=True)
+        for n, size in largest[:10]:
+            print("  Out[%s] %10s  %s%s" % (n, format_size(size),
+                type(super().__getitem__(n)).__name__,
+                " (pinned)" if n in self.pinned else ""), file=file)
@@ -42,22 +42,39 @@ except ImportError:
         raise
     display_image_bytes = lambda x: ''
 
-from . import mypython
+# The types that SymPy can pretty print, and the modules they are defined in
+SYMPY_TYPES = [
+    ('sympy.core.basic', 'Basic'),
+    ('sympy.matrices', 'MatrixBase'),
+    ('sympy.physics.vector', 'Vector'),
+    ('sympy.physics.vector', 'Dyadic'),
+    ('sympy.tensor.array', 'NDimArray'),
+]
+
+def sympy_types():
+    """
+    Return the types in SYMPY_TYPES from the modules that have been imported
 
-def can_print_sympy(o):
+    Modules are not imported, so this doesn't import sympy.physics.vector
+    (which is slow) just to print something. If it isn't imported, there
+    can't be any Vectors to print. This also doesn't fail if sympy is being
+    imported in the background (see magic.preload_sympy()).
+    """
+    types = []
+    for module, name in SYMPY_TYPES:
+        t = getattr(sys.modules.get(module), name, None)
+        if isinstance(t, type):
+            types.append(t)
+    return tuple(types)
+
+def can_print_sympy(o, _types=None):
     """Return True if type o can be printed with sympy.pretty.
 
     If o is a container type, this is True if and only if every element of
     o can be printed with SymPy.
     """
-    from sympy import Basic
-    from sympy.matrices import MatrixBase
-    from sympy.physics.vector import Vector, Dyadic
-    try:
-        from sympy.tensor.array import NDimArray
-    except ImportError:
-        # Support older versions of SymPy
-        NDimArray = Basic
+    if _types is None:
+        _types = sympy_types()
 
     try:
         builtin_types = (list, tuple, set, frozenset)
@@ -67,12 +84,13 @@ def can_print_sympy(o):
             if (type(o).__str__ not in (i.__str__ for i in builtin_types) or
                 type(o).__repr__ not in (i.__repr__ for i in builtin_types)):
                 return False
-            return all(can_print_sympy(i) for i in o)
+            return all(can_print_sympy(i, _types) for i in o)
         elif isinstance(o, dict):
-            return all(can_print_sympy(i) and can_print_sympy(o[i]) for i in o)
+            return all(can_print_sympy(i, _types) and can_print_sympy(o[i], _types)
+                       for i in o)
         elif isinstance(o, bool):
             return False
-        elif isinstance(o, (Basic, MatrixBase, Vector, Dyadic, NDimArray)):
+        elif isinstance(o, _types):
             return True
         elif isinstance(o, (int, float)):
             return False
@@ -91,6 +109,9 @@ def mypython_displayhook(value):
     - uses sympy.pretty() for SymPy objects.
 
     """
+    # Imported here because mypython imports this module
+    from . import mypython
+
     if value is mypython.NoResult:
         return
 
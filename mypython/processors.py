@@ -36,10 +36,6 @@ from prompt_toolkit.layout.utils import explode_text_fragments
 from prompt_toolkit.application import get_app
 from prompt_toolkit.formatted_text import fragment_list_width, to_formatted_text
 
-from pyflakes.checker import Checker
-from pyflakes.messages import (UnusedImport, UnusedVariable, UndefinedName,
-                               Message, ImportStarUsed, ImportStarUsage)
-
 from .tokenize import matching_parens, indentation, dedent
 from .magic import MAGICS, NON_PYTHON_MAGICS
 
@@ -133,18 +129,50 @@ class MyHighlightMatchingBracketProcessor(HighlightMatchingBracketProcessor):
 
 loc = namedtuple("loc", ["lineno", "col_offset"])
 
-class SyntaxErrorMessage(Message):
+class SyntaxErrorMessage:
+    """
+    A syntax error, in the same form as a pyflakes Message
+
+    This doesn't subclass pyflakes.messages.Message so that pyflakes isn't
+    imported until the first time the input is checked.
+    """
     message = "SyntaxError: %s"
 
     def __init__(self, filename, loc, msg, text):
-        Message.__init__(self, filename, loc)
+        self.filename = filename
+        self.lineno = loc.lineno
+        self.col = loc.col_offset
         self.message_args = (msg,)
         self.text = text
 
+    def __str__(self):
+        return '%s:%s:%s: %s' % (self.filename, self.lineno, self.col + 1,
+                                 self.message % self.message_args)
+
+def top_level_awaits(tree):
+    """
+    Return the set of (lineno, col_offset) of the await expressions in tree
+    that are not inside of a function or class.
+
+    These are allowed because mypython compiles with
+    PyCF_ALLOW_TOP_LEVEL_AWAIT, but pyflakes reports them as
+    YieldOutsideFunction.
+    """
+    awaits = set()
+    def _visit(node):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                             ast.Lambda, ast.ClassDef)):
+            return
+        if isinstance(node, ast.Await):
+            awaits.add((node.lineno, node.col_offset))
+        for child in ast.iter_child_nodes(node):
+            _visit(child)
+    _visit(tree)
+    return awaits
+
 # TODO: Cache this as a generator
 @lru_cache()
-def get_pyflakes_warnings(code, defined_names=frozenset(),
-                          skip=(UnusedImport, ImportStarUsed, ImportStarUsage)):
+def get_pyflakes_warnings(code, defined_names=frozenset(), skip=None):
     """
     Get pyflakes warnings for code
 
@@ -158,9 +186,20 @@ def get_pyflakes_warnings(code, defined_names=frozenset(),
     defined_names should be a frozenset of names which should be considered
     already defined in the global namespace for the code.
 
-    skip should be a tuple of pyflakes message classes to skip.
+    skip should be a tuple of pyflakes message classes to skip. The default
+    is (UnusedImport, ImportStarUsed, ImportStarUsage).
     """
     code = code.rstrip()
+    if not code:
+        # Don't import pyflakes just to render the empty prompt
+        return []
+
+    from pyflakes.checker import Checker
+    from pyflakes.messages import (UnusedImport, UnusedVariable, UndefinedName,
+                                   ImportStarUsed, ImportStarUsage,
+                                   YieldOutsideFunction)
+    if skip is None:
+        skip = (UnusedImport, ImportStarUsed, ImportStarUsage)
 
     prefix = ''
 
@@ -235,9 +274,12 @@ def get_pyflakes_warnings(code, defined_names=frozenset(),
         except RecursionError:
             return
         messages = checker.messages
+        awaits = top_level_awaits(tree)
         for m in messages:
             if isinstance(m, skip):
                 continue
+            if isinstance(m, YieldOutsideFunction) and (m.lineno, m.col) in awaits:
+                continue
             row = m.lineno - 1
             col = m.col
             msg = m.message % m.message_args
@@ -268,11 +310,9 @@ class HighlightPyflakesErrorsProcessor(Processor):
 
         text = document.text
 
+        # UnusedImport warnings are skipped by get_pyflakes_warnings()
         for row, col, msg, m in get_pyflakes_warnings(text, frozenset(buffer_control.buffer.session._locals)):
             # col = source_to_display(col)
-            if isinstance(m, UnusedImport):
-                continue
-
             if row == lineno:
                 # TODO: handle warnings without a column
                 fragments = explode_text_fragments(fragments)
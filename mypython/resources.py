@@ -0,0 +1,225 @@
+"""
+Resource usage of each command
+
+Besides the wall time (TIMINGS), each command records
+
+- cpu: the CPU time of the process (time.process_time())
+- rss: how much the peak resident set size of the process went up
+- alloc: the peak memory allocated by Python, as traced by tracemalloc. This
+  is only recorded when tracemalloc is enabled (%timings --tracemalloc on),
+  as tracing slows down allocations.
+- gc, gc time: the number of garbage collections, and the time spent in them
+- stdout: the number of bytes written to sys.stdout (in its encoding)
+
+These are saved in _PROMPT.resources, and shown by %timings.
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+from .outcache import format_size
+from .timeit import format_time
+
+Resources = namedtuple('Resources', ['wall', 'cpu', 'rss', 'alloc', 'gc',
+                                     'gc_time', 'stdout'])
+
+# How to format each field in the %timings table
+FORMATTERS = {
+    'wall': format_time,
+    'cpu': format_time,
+    'rss': format_size,
+    'alloc': format_size,
+    'gc': str,
+    'gc_time': format_time,
+    'stdout': format_size,
+}
+
+_gc_collections = 0
+_gc_time = 0.
+_gc_start = None
+
+def _gc_callback(phase, info):
+    global _gc_collections, _gc_time, _gc_start
+    if phase == 'start':
+        _gc_start = time.perf_counter()
+    elif _gc_start is not None:
+        _gc_collections += 1
+        _gc_time += time.perf_counter() - _gc_start
+        _gc_start = None
+
+def max_rss():
+    """
+    Return the peak resident set size of the process in bytes, or nan if it
+    is not available.
+    """
+    if resource is None:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+class CountingStream:
+    """
+    Wrapper around a stream (sys.stdout) that counts the bytes written to it
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, data):
+        if data.isascii():
+            self.count += len(data)
+        else:
+            encoding = getattr(self.stream, 'encoding', None) or 'utf-8'
+            self.count += len(data.encode(encoding, 'replace'))
+        return self.stream.write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+class ResourceMonitor:
+    """
+    Measure the resources used between start() and stop()
+    """
+    def __init__(self):
+        if _gc_callback not in gc.callbacks:
+            gc.callbacks.append(_gc_callback)
+        self._start = None
+        self._stdout = None
+
+    @property
+    def trace_allocations(self):
+        """
+        Whether tracemalloc is enabled, to record the alloc field
+        """
+        return tracemalloc.is_tracing()
+
+    @trace_allocations.setter
+    def trace_allocations(self, value):
+        if value and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not value and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _remove_stdout(self):
+        """
+        Remove the CountingStream from sys.stdout
+
+        If something else wrapped sys.stdout after start() (like the
+        JobStream of %bg), the CountingStream is taken out from under it.
+        """
+        stream = sys.stdout
+        if stream is self._stdout:
+            sys.stdout = stream.stream
+            return
+        while True:
+            # Don't use getattr(), which the wrappers forward to the stream
+            inner = getattr(stream, '__dict__', {}).get('stream')
+            if inner is None:
+                return
+            if inner is self._stdout:
+                stream.stream = inner.stream
+                return
+            stream = inner
+
+    def start(self):
+        if self._stdout is not None:
+            # stop() was not called for the previous command
+            self._remove_stdout()
+
+        alloc = peak = float('nan')
+        if tracemalloc.is_tracing():
+            if hasattr(tracemalloc, 'reset_peak'): # Python 3.9+
+                tracemalloc.reset_peak()
+            alloc, peak = tracemalloc.get_traced_memory()
+
+        self._stdout = sys.stdout = CountingStream(sys.stdout)
+        self._start = (time.perf_counter(), time.process_time(), max_rss(),
+                       alloc, peak, _gc_collections, _gc_time)
+
+    def stop(self):
+        """
+        Return the Resources used since start()
+
+        If start() was not called, all the fields are nan.
+        """
+        if self._start is None:
+            return Resources(*[float('nan')]*len(Resources._fields))
+
+        wall, cpu, rss, alloc, peak, collections, gc_time = self._start
+        if tracemalloc.is_tracing() and alloc == alloc:
+            new_peak = tracemalloc.get_traced_memory()[1]
+            if hasattr(tracemalloc, 'reset_peak') or new_peak > peak:
+                alloc = new_peak - alloc
+            else:
+                # Without reset_peak(), the peak of the command isn't known
+                # if it is lower than an earlier peak
+                alloc = float('nan')
+        else:
+            alloc = float('nan')
+
+        stdout = self._stdout.count
+        self._remove_stdout()
+        self._start = self._stdout = None
+
+        return Resources(
+            wall=time.perf_counter() - wall,
+            cpu=time.process_time() - cpu,
+            rss=max_rss() - rss,
+            alloc=alloc,
+            gc=_gc_collections - collections,
+            gc_time=_gc_time - gc_time,
+            stdout=stdout,
+        )
+
+def format_field(field, value):
+    if value != value:
+        return '-'
+    return FORMATTERS[field](value)
+
+def _sort_key(value):
+    # nan sorts last
+    if value != value:
+        return float('-inf')
+    return value
+
+def print_timings(prompt, n=None, sort=None, file=None):
+    """
+    Print the resources used by the command at prompt n, or a table of all
+    the commands, sorted by the column sort (largest first).
+    """
+    file = file or sys.stdout
+    resources = prompt.resources
+    if n is not None:
+        r = resources[n]
+        for field, value in zip(Resources._fields, r):
+            print("%-8s %s" % (field + ':', format_field(field, value)), file=file)
+        return
+
+    rows = sorted(resources)
+    if sort:
+        rows.sort(key=lambda i: _sort_key(getattr(resources[i], sort)), reverse=True)
+
+    header = ['#'] + list(Resources._fields) + ['command']
+    table = [header]
+    for i in rows:
+        command = prompt.In.get(i, '').strip().split('\n')[0]
+        if len(command) > 40:
+            command = command[:37] + '...'
+        table.append([str(i)] + [format_field(field, value) for field, value in
+                                 zip(Resources._fields, resources[i])] + [command])
+
+    widths = [max(len(row[col]) for row in table) for col in range(len(header) - 1)]
+    for row in table:
+        print(' '.join(cell.rjust(width) for cell, width in zip(row, widths))
+              + '  ' + row[-1], file=file)
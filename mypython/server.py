@@ -0,0 +1,443 @@
+"""
+Pre-forked server for fast startup (mypython --server)
+
+mypython --server imports the modules that take the most time to import
+(PRELOAD), warms up Jedi, and listens on a Unix socket (SERVER_SOCKET). When
+bin/mypython finds the socket, it sends its arguments, working directory, and
+environment, together with its stdin, stdout, and stderr file descriptors,
+to the server, which forks a child that runs mypython on them. The client
+forwards signals to the child, and exits with the child's exit code.
+
+When the client is run in a terminal, it can't give its terminal to the
+child, because the terminal is the controlling terminal of the client's
+session (the shell's). So instead, the client opens a pseudo-terminal, which
+becomes the controlling terminal of the child, and copies the input and
+output between it and its own terminal (see _relay()). That way, Ctrl-C,
+Ctrl-Z, and window size changes go to the child like they would if it were
+started normally.
+
+The server only knows the mypython sources it was started with. The client
+sends a stamp of its sources (see source_stamp()), and if they don't match,
+the server tells the client to start normally, and exits, so that the next
+server that is started uses the new sources.
+
+This module is imported by bin/mypython before anything else, so it should
+only import modules that are fast to import.
+"""
+
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+import struct
+import hashlib
+from array import array
+
+SERVER_SOCKET = "~/.mypython/server.sock"
+
+# Modules that are imported by the server, if they are installed
+PRELOAD = ['prompt_toolkit', 'pygments', 'pyflakes', 'jedi', 'numpy', 'sympy']
+
+# Signals that the client forwards to the session
+FORWARD_SIGNALS = ['SIGINT', 'SIGTERM', 'SIGHUP', 'SIGQUIT', 'SIGWINCH']
+
+def source_stamp():
+    """
+    Return a string that changes when the mypython sources or the Python
+    executable change
+    """
+    h = hashlib.sha1()
+    h.update(sys.executable.encode('utf-8'))
+    h.update(sys.version.encode('utf-8'))
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for dirpath, dirnames, filenames in os.walk(package_dir):
+        dirnames[:] = sorted(d for d in dirnames if d not in ('__pycache__', 'tests'))
+        for filename in sorted(filenames):
+            if not filename.endswith('.py'):
+                continue
+            path = os.path.join(dirpath, filename)
+            st = os.stat(path)
+            h.update(('%s %s %s\n' % (path, st.st_mtime_ns, st.st_size)).encode('utf-8'))
+    return h.hexdigest()
+
+def _read_message(f):
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+def _send_message(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+# socket.send_fds() and socket.recv_fds() are new in Python 3.9
+
+def _send_fds(sock, data, fds):
+    return sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                  array('i', fds))])
+
+def _recv_fds(sock, bufsize, maxfds):
+    fds = array('i')
+    data, ancdata, flags, addr = sock.recvmsg(bufsize,
+        socket.CMSG_LEN(maxfds*fds.itemsize))
+    for level, type, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+    return data, list(fds)
+
+def _copy_window_size(src, dest):
+    import fcntl
+    import termios
+
+    size = fcntl.ioctl(src, termios.TIOCGWINSZ, b'\0'*8)
+    fcntl.ioctl(dest, termios.TIOCSWINSZ, size)
+
+def _open_pty():
+    """
+    Open a pseudo-terminal with the same settings and size as stdin
+
+    Returns (master, slave).
+    """
+    import termios
+
+    master, slave = os.openpty()
+    termios.tcsetattr(slave, termios.TCSANOW, termios.tcgetattr(0))
+    _copy_window_size(0, slave)
+    return master, slave
+
+def _relay(master, sock):
+    """
+    Copy stdin to the pty master and the pty master to stdout, until the
+    session sends a message on sock
+    """
+    import select
+    import termios
+    import tty
+
+    attrs = termios.tcgetattr(0)
+    # The pty does the line editing and turns Ctrl-C into SIGINT for the
+    # session, so the client terminal passes everything through.
+    tty.setraw(0)
+    try:
+        readers = [0, master, sock]
+        while True:
+            ready, _, _ = select.select(readers, [], [])
+            if master in ready:
+                try:
+                    data = os.read(master, 2**16)
+                except OSError:
+                    # EIO: every process using the pty closed it
+                    data = b''
+                if data:
+                    os.write(1, data)
+                    continue
+                readers.remove(master)
+            if 0 in ready:
+                data = os.read(0, 2**16)
+                if data:
+                    os.write(master, data)
+                else:
+                    readers.remove(0)
+            if sock in ready:
+                # The session exited. Copy what it printed last.
+                while master in readers and select.select([master], [], [], 0)[0]:
+                    try:
+                        data = os.read(master, 2**16)
+                    except OSError:
+                        break
+                    if not data:
+                        break
+                    os.write(1, data)
+                return
+    finally:
+        termios.tcsetattr(0, termios.TCSADRAIN, attrs)
+
+def _set_controlling_terminal(fd):
+    """
+    Make the terminal fd the controlling terminal of this process, and put it
+    in the foreground
+
+    This process should be a session leader (see os.setsid()). Returns False
+    if fd is not a terminal, or it is already used by another session.
+    """
+    import fcntl
+    import termios
+
+    if not os.isatty(fd):
+        return False
+    try:
+        fcntl.ioctl(fd, termios.TIOCSCTTY, 0)
+    except OSError:
+        return False
+    os.tcsetpgrp(fd, os.getpgrp())
+    return True
+
+def connect(argv, path=SERVER_SOCKET, stamp=None):
+    """
+    Run mypython with the arguments argv in a session forked from the server
+
+    Returns the exit code of the session, or None if there is no server or it
+    is out of date, in which case mypython should be started normally.
+    """
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock, sock.makefile('r', encoding='utf-8') as f:
+        request = {
+            'stamp': stamp or source_stamp(),
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        }
+        data = json.dumps(request).encode('utf-8') + b'\n'
+        master = None
+        fds = [0, 1, 2]
+        if os.isatty(0) and os.isatty(1):
+            master, slave = _open_pty()
+            fds = [slave, slave, slave if os.isatty(2) else 2]
+        try:
+            try:
+                _send_fds(sock, data, fds)
+            finally:
+                if master is not None:
+                    os.close(slave)
+            message = _read_message(f)
+        except OSError:
+            if master is not None:
+                os.close(master)
+            return None
+        if not message or 'pid' not in message:
+            if master is not None:
+                os.close(master)
+            if message and message.get('stale'):
+                print("mypython: the server is out of date, starting normally",
+                      file=sys.stderr)
+            return None
+
+        pid = message['pid']
+        def forward(signum, frame):
+            if signum == signal.SIGWINCH and master is not None:
+                # The kernel sends SIGWINCH to the session when the pty size
+                # changes
+                _copy_window_size(0, master)
+                return
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+        for name in FORWARD_SIGNALS:
+            signal.signal(getattr(signal, name), forward)
+
+        if master is not None:
+            try:
+                _relay(master, sock)
+            finally:
+                os.close(master)
+        message = _read_message(f)
+        if message is None:
+            # The session died without sending its exit code
+            return 1
+        return message['exit']
+
+def preload(modules=PRELOAD):
+    """
+    Import modules, and everything mypython uses to show the first prompt
+    """
+    import importlib
+
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+    from . import __main__, processors, keys
+    from .completion import warm_up_jedi
+    # Everything that mypython imports at startup
+    __main__
+
+    # Parse and compile what the first keystrokes will need
+    processors.get_pyflakes_warnings('a')
+    keys.get_key_bindings()
+    if 'jedi' in modules:
+        # This doesn't start any threads, so it is safe to fork afterwards.
+        warm_up_jedi({})
+
+def _reap(signum, frame):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+def _run_session(conn, fds, request):
+    """
+    Run mypython in a forked child of the server. Never returns.
+    """
+    code = 1
+    try:
+        os.setsid()
+        for sig in [signal.SIGCHLD, signal.SIGINT, signal.SIGTERM]:
+            signal.signal(sig, signal.SIG_DFL)
+
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        _set_controlling_terminal(0)
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', buffering=1, closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = ['mypython'] + request['argv']
+
+        # Don't give every session the same random numbers (and prompt emoji)
+        import random
+        random.seed()
+        if 'numpy' in sys.modules:
+            sys.modules['numpy'].random.seed()
+
+        _send_message(conn, {'pid': os.getpid()})
+
+        from .__main__ import main
+        try:
+            code = _exit_code(main())
+        except SystemExit as e:
+            code = _exit_code(e.code)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            import atexit
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            _send_message(conn, {'exit': code})
+        finally:
+            os._exit(code)
+
+def _allowed_peer(conn):
+    """
+    Return True if the process connected to conn is run by the same user as
+    the server
+
+    Where the peer can't be checked (SO_PEERCRED is Linux only), this relies
+    on the permissions of the socket file.
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid == os.getuid()
+
+def _recv_request(conn):
+    data, fds = _recv_fds(conn, 2**16, 3)
+    while not data.endswith(b'\n'):
+        more = conn.recv(2**16)
+        if not more:
+            break
+        data += more
+    return json.loads(data), fds
+
+def serve(path=SERVER_SOCKET, modules=PRELOAD):
+    """
+    Run the server until it is interrupted, or a client with different
+    sources connects
+    """
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if os.path.exists(path):
+        test = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            test.connect(path)
+        except OSError:
+            # Left behind by a server that was killed
+            os.remove(path)
+        else:
+            test.close()
+            print("mypython: a server is already running on %s" % path,
+                  file=sys.stderr)
+            return 1
+
+    stamp = source_stamp()
+    preload(modules)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Anyone who can connect can run code as this user, so only this user
+    # should be able to. The umask makes the socket private from the start.
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    os.chmod(path, 0o600)
+    server.listen()
+    signal.signal(signal.SIGCHLD, _reap)
+    print("mypython server listening on %s" % path, file=sys.stderr)
+
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except InterruptedError: # pragma: no cover
+                continue
+            except OSError as e:
+                if e.errno == errno.EINTR: # pragma: no cover
+                    continue
+                raise
+
+            with conn:
+                if not _allowed_peer(conn):
+                    print("mypython: refusing a connection from another user",
+                          file=sys.stderr)
+                    continue
+                try:
+                    request, fds = _recv_request(conn)
+                except (OSError, ValueError):
+                    continue
+
+                if request.get('stamp') != stamp or source_stamp() != stamp:
+                    for fd in fds:
+                        os.close(fd)
+                    _send_message(conn, {'stale': True})
+                    print("mypython: the sources have changed, exiting",
+                          file=sys.stderr)
+                    return 0
+
+                pid = os.fork()
+                if pid == 0:
+                    server.close()
+                    _run_session(conn, fds, request)
+                for fd in fds:
+                    os.close(fd)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,207 @@
+"""
+Save and restore the session namespace (%save_session and %load_session)
+
+A snapshot holds the user namespace, In, Out, and TIMINGS. It is written with
+spill.dump(), so large arrays are written without copying them into the
+pickle, and are memory mapped when the snapshot is loaded.
+
+Modules are saved by name and imported again when the snapshot is loaded.
+Objects that cannot be pickled (for instance, open files, or functions whose
+module cannot be imported) are skipped, and listed in the report, both when
+the snapshot is saved and when it is loaded. Modules that cannot be imported
+again are listed separately when it is loaded.
+"""
+
+import os
+import sys
+import time
+import types
+import pickle
+import importlib
+
+from . import spill
+from .outcache import format_size
+from .timeit import format_time
+
+SNAPSHOT_VERSION = 1
+
+SESSIONS_DIR = "~/.mypython/sessions"
+
+class ModuleRef:
+    """
+    Placeholder for a module in a snapshot
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "ModuleRef(%r)" % self.name
+
+def snapshot_filename(name=None):
+    """
+    Return the filename for the snapshot name
+
+    name may be a path, or the name of a snapshot in SESSIONS_DIR. The
+    default is 'default'.
+    """
+    name = name or 'default'
+    if os.sep in name or name.startswith('~') or name.startswith('.'):
+        return os.path.abspath(os.path.expanduser(name))
+    return os.path.join(os.path.expanduser(SESSIONS_DIR), name)
+
+def _is_saved_name(name, value, prompt):
+    if name.startswith('__') and name.endswith('__'):
+        return False
+    if getattr(value, '__module__', None) == __name__:
+        # Imported by the %save_session magic
+        return False
+    if name in prompt.builtins or name in ['_', '__', '___']:
+        return False
+    if name[0] == '_' and name[1:].isdigit():
+        # Saved in Out
+        return False
+    return True
+
+def _check_pickle(value):
+    """
+    Return None if value can be pickled, or the exception if it can't.
+    """
+    try:
+        # Buffers are not copied
+        pickle.dumps(value, protocol=5, buffer_callback=lambda b: None)
+    except Exception as e:
+        return e
+    return None
+
+def save_session(prompt, _locals, filename):
+    """
+    Save the namespace _locals and the In, Out, and TIMINGS of prompt to
+    filename.
+
+    Returns the snapshot dict. snapshot['skipped'] maps the names that could
+    not be saved to the reason why.
+    """
+    namespace = {}
+    for name, value in _locals.items():
+        if not _is_saved_name(name, value, prompt):
+            continue
+        if isinstance(value, types.ModuleType):
+            value = ModuleRef(value.__name__)
+        namespace[name] = value
+
+    Out = dict(prompt.Out.items())
+    for n, (type_name, size, spill_filename) in prompt.Out.spilled.items():
+        # Don't load it into the output cache
+        Out[n] = spill.load(spill_filename)
+
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'python': sys.version_info[:2],
+        'namespace': namespace,
+        'In': dict(prompt.In),
+        'Out': Out,
+        'TIMINGS': dict(prompt.timings),
+        'skipped': {},
+    }
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = filename + '.tmp'
+    try:
+        # Usually everything can be pickled, so try that first, so that
+        # objects shared between names are only saved once.
+        spill.dump(snapshot, tmp)
+    except Exception:
+        skipped = snapshot['skipped']
+        for name, value in list(namespace.items()):
+            e = _check_pickle(value)
+            if e:
+                skipped[name] = e
+                del namespace[name]
+        for n, value in list(Out.items()):
+            e = _check_pickle(value)
+            if e:
+                skipped['Out[%s]' % n] = e
+                del Out[n]
+        skipped = {name: '%s: %s' % (type(e).__name__, e) for name, e in skipped.items()}
+        snapshot['skipped'] = skipped
+        spill.dump(snapshot, tmp)
+
+    # Replace the file atomically, so that a session that has the old
+    # snapshot memory mapped is not affected.
+    os.replace(tmp, filename)
+    return snapshot
+
+def load_session(prompt, _locals, filename):
+    """
+    Load a snapshot saved with save_session() from filename into the
+    namespace _locals and the In, Out, and TIMINGS of prompt.
+
+    Entries in In, Out, and TIMINGS with the same prompt numbers as the
+    snapshot are replaced, and the prompt number continues after the last
+    one in the snapshot. Returns the snapshot dict. snapshot['failed'] maps
+    the names that could not be loaded to the reason why.
+    """
+    snapshot = spill.load(filename)
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError("%s is not a version %s mypython session snapshot" %
+                         (filename, SNAPSHOT_VERSION))
+
+    namespace = snapshot['namespace']
+    snapshot['failed'] = {}
+    for name, value in list(namespace.items()):
+        if isinstance(value, ModuleRef):
+            try:
+                namespace[name] = importlib.import_module(value.name)
+            except Exception as e:
+                snapshot['failed'][name] = '%s: %s' % (type(e).__name__, e)
+                del namespace[name]
+    _locals.update(namespace)
+
+    prompt.In.update(snapshot['In'])
+    prompt.timings.update(snapshot['TIMINGS'])
+    for n, value in sorted(snapshot['Out'].items()):
+        prompt.Out[n] = value
+        prompt.builtins['_%s' % n] = value
+        _locals['_%s' % n] = value
+
+    last = max(snapshot['In'], default=0)
+    if last >= prompt.prompt_number:
+        prompt.prompt_number = prompt.builtins['PROMPT_NUMBER'] = last + 1
+        _locals['PROMPT_NUMBER'] = prompt.prompt_number
+    return snapshot
+
+def print_report(action, filename, snapshot, elapsed, file=None):
+    file = file or sys.stdout
+    print("%s %d names, %d inputs, and %d outputs %s %s (%s) in %s" % (action,
+        len(snapshot['namespace']), len(snapshot['In']), len(snapshot['Out']),
+        'to' if action == 'Saved' else 'from', filename,
+        format_size(os.path.getsize(filename)), format_time(elapsed)), file=file)
+    skipped = snapshot['skipped']
+    if skipped:
+        if action == 'Saved':
+            print("Skipped %d objects that could not be saved:" % len(skipped),
+                  file=file)
+        else:
+            print("%d objects were not saved (unpicklable):" % len(skipped),
+                  file=file)
+        for name, reason in skipped.items():
+            print("  %s: %s" % (name, reason), file=file)
+    failed = snapshot.get('failed')
+    if failed:
+        print("%d objects could not be loaded:" % len(failed), file=file)
+        for name, reason in failed.items():
+            print("  %s: %s" % (name, reason), file=file)
+
+def save_session_command(prompt, _locals, name=None):
+    filename = snapshot_filename(name)
+    t = time.perf_counter()
+    snapshot = save_session(prompt, _locals, filename)
+    elapsed = time.perf_counter() - t
+    print_report('Saved', filename, snapshot, elapsed)
+
+def load_session_command(prompt, _locals, name=None):
+    filename = snapshot_filename(name)
+    t = time.perf_counter()
+    snapshot = load_session(prompt, _locals, filename)
+    elapsed = time.perf_counter() - t
+    print_report('Loaded', filename, snapshot, elapsed)
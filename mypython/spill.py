@@ -0,0 +1,143 @@
+"""
+Saving objects to disk
+
+dump() and load() save objects with pickle protocol 5. Out-of-band buffers
+(like the data of NumPy arrays) are written directly to the file without
+being copied into the pickle, and load() maps them back in with mmap, so
+they are only read from disk when they are used.
+
+The file format is
+
+    MAGIC
+    number of buffers (8 bytes)
+    (offset, length) for each buffer (8 bytes each)
+    length of the pickle (8 bytes)
+    pickle
+    buffers, each aligned to ALIGNMENT bytes
+"""
+
+import os
+import re
+import mmap
+import shutil
+import atexit
+import pickle
+import struct
+import tempfile
+
+MAGIC = b'mypython-spill-1\n'
+ALIGNMENT = 64
+
+SPILL_BASE = "~/.mypython/spill"
+
+def _align(n):
+    return -n % ALIGNMENT
+
+def dump(obj, filename):
+    """
+    Save obj to filename.
+
+    Raises an exception (usually pickle.PicklingError, TypeError, or
+    AttributeError) if obj cannot be pickled. In that case the file is not
+    created.
+    """
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+
+    raw = []
+    for buf in buffers:
+        try:
+            raw.append(buf.raw())
+        except BufferError:
+            # Non-contiguous buffer
+            raw.append(memoryview(bytes(memoryview(buf))))
+
+    header_size = len(MAGIC) + 8 + 16*len(raw) + 8
+    offset = header_size + len(data)
+    offset += _align(offset)
+    table = []
+    for r in raw:
+        table.append((offset, r.nbytes))
+        offset += r.nbytes + _align(r.nbytes)
+
+    try:
+        with open(filename, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(raw)))
+            for off, length in table:
+                f.write(struct.pack('<QQ', off, length))
+            f.write(struct.pack('<Q', len(data)))
+            f.write(data)
+            for (off, length), r in zip(table, raw):
+                f.write(b'\0'*(off - f.tell()))
+                f.write(r)
+    except BaseException:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        raise
+
+def load(filename):
+    """
+    Load an object that was saved with dump().
+
+    The out-of-band buffers are copy-on-write memory maps of the file, so
+    the file can be removed after loading, and modifying the loaded object
+    does not modify the file.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a mypython spill file" % filename)
+        nbuffers, = struct.unpack('<Q', f.read(8))
+        table = [struct.unpack('<QQ', f.read(16)) for i in range(nbuffers)]
+        length, = struct.unpack('<Q', f.read(8))
+        data = f.read(length)
+
+        buffers = []
+        if table:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            view = memoryview(m)
+            buffers = [view[off:off+length] for off, length in table]
+
+    return pickle.loads(data, buffers=buffers)
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class SpillDirectory:
+    """
+    A directory for the files of one session
+
+    The directory is created in base the first time it is used, and removed
+    when the process exits. Directories left behind by sessions that are no
+    longer running are removed as well.
+    """
+    def __init__(self, base=SPILL_BASE):
+        self.base = os.path.expanduser(base)
+        self.path = None
+
+    def filename(self, name):
+        if self.path is None:
+            os.makedirs(self.base, exist_ok=True)
+            self.remove_stale()
+            self.path = tempfile.mkdtemp(prefix='%d-' % os.getpid(), dir=self.base)
+            atexit.register(self.cleanup)
+        return os.path.join(self.path, name)
+
+    def remove_stale(self):
+        for d in os.listdir(self.base):
+            m = re.match(r'(\d+)-', d)
+            if m and not _pid_exists(int(m.group(1))):
+                shutil.rmtree(os.path.join(self.base, d), ignore_errors=True)
+
+    def cleanup(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
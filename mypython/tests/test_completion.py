@@ -6,7 +6,8 @@ from prompt_toolkit.input.defaults import create_pipe_input
 
 from ..dircompletion import DirCompleter
 
-from .test_mypython import _run_session_with_text, _build_test_session
+from .test_mypython import (_run_session_with_text, _build_test_session,
+    _get_check_output)
 
 import flaky
 retry = flaky.flaky(max_runs=5)
@@ -118,3 +119,259 @@ def test_DirCompletion():
     completer = DirCompleter({'t': Test()})
 
     assert completer.complete('t.t', 0) == 't.test'
+
+def test_warm_up_jedi(tmp_path, monkeypatch):
+    import os
+    import jedi
+    from .. import completion
+
+    cache_dir = str(tmp_path/'jedi')
+    monkeypatch.setattr(completion, 'JEDI_CACHE_DIR', cache_dir)
+    monkeypatch.setattr(jedi.settings, 'cache_directory', jedi.settings.cache_directory)
+    monkeypatch.setattr(completion, '_warmed_up', set())
+
+    completion.warm_up_jedi({'os': os, 'a': 1})
+    assert jedi.settings.cache_directory == cache_dir
+    assert completion._warmed_up == {'str.', 'os.'}
+
+def test_warm_up_after_first_prompt(monkeypatch):
+    from ..mypython import Session
+
+    calls = []
+    monkeypatch.setattr(Session, 'start_warm_up', lambda self: calls.append(self))
+
+    with create_pipe_input() as _input:
+        session = _build_test_session(_input=_input)
+        assert _run_session_with_text(session, '1\n') == '1'
+        assert calls == [session]
+        assert _run_session_with_text(session, '2\n') == '2'
+        assert calls == [session]
+
+def test_session_document(monkeypatch):
+    from .. import completion
+    from ..completion import SessionDocument
+
+    monkeypatch.setattr(completion, 'JEDI_HISTORY_LINES', 6)
+
+    document = SessionDocument()
+    document.add(1, 'a = 1')
+    document.add(2, 'def f():\n    return a')
+    assert document.text == 'a = 1\ndef f():\n    return a\n'
+    assert document.lines == 3
+    # An empty command replaces In[n]
+    document.add(3, '')
+    document.add(3, 'b = 2')
+    assert document.text == 'a = 1\ndef f():\n    return a\nb = 2\n'
+    assert document.count == 3
+
+    # When it gets longer than JEDI_HISTORY_LINES, it is cut to half that
+    document.add(4, 'c = 3\nd = 4\ne = 5')
+    assert document.text == 'c = 3\nd = 4\ne = 5\n'
+    assert document.lines == 3
+
+    # It is rebuilt if In was changed by something else
+    In = {1: 'a = 1', 2: 'b = 2', 3: 'c = 3', 4: 'c = 3\nd = 4\ne = 5'}
+    assert document.sync(In).text == 'c = 3\nd = 4\ne = 5\n'
+    In = {1: 'x = 0', 2: 'a = 1', 3: 'b = 2'}
+    assert document.sync(In).text == 'x = 0\na = 1\nb = 2\n'
+    assert document.count == 3
+
+def test_jedi_session_history():
+    from prompt_toolkit.document import Document
+    from ..completion import get_jedi_script_from_document, JEDI_LOCK
+
+    with create_pipe_input() as _input:
+        session = _build_test_session(_input=_input)
+        check_output = _get_check_output(session)
+        assert check_output('def f(): return [1]\n') == ('\n', '')
+        assert session.jedi_document.text.startswith('def f(): return [1]\n')
+        assert session.jedi_document.count == 1
+
+        # The Jedi warm up may be running
+        with JEDI_LOCK:
+            script, line, column = get_jedi_script_from_document(Document('f().ap'),
+                session._locals, session._globals, session)
+            completions = script.complete(line=line, column=column)
+        assert [c.name for c in completions] == ['append']
+
+def test_completion_cache():
+    from types import SimpleNamespace
+    from prompt_toolkit.document import Document
+    from prompt_toolkit.completion import CompleteEvent
+    from ..completion import PythonCompleter
+
+    class Test:
+        abc = abd = xyz = _private = 1
+
+    namespace = {'t': Test(), 'tea': 1}
+    session = SimpleNamespace(builtins={'In': {}}, namespace_version=0)
+    completer = PythonCompleter(lambda: namespace, lambda: namespace, session)
+    computed = []
+    _python_completions = completer._python_completions
+    def python_completions(document, text_before_cursor, should_stop=None):
+        computed.append(text_before_cursor)
+        return _python_completions(document, text_before_cursor, should_stop)
+    completer._python_completions = python_completions
+
+    def complete(text):
+        completions = completer.get_completions(Document(text),
+            CompleteEvent(completion_requested=True))
+        return sorted({(c.text, c.start_position) for c in completions})
+
+    assert complete('t.a') == [('abc', -1), ('abd', -1), ('t.abc', -3), ('t.abd', -3)]
+    assert complete('t.a') == [('abc', -1), ('abd', -1), ('t.abc', -3), ('t.abd', -3)]
+    # Typing more of the name filters the cached completions
+    assert complete('t.ab') == [('abc', -2), ('abd', -2), ('t.abc', -4), ('t.abd', -4)]
+    assert complete('t.abC') == [('abc', -3), ('t.abc', -5)]
+    assert computed == ['t.a']
+
+    # The cache isn't narrowed from an empty name, because _ names are only
+    # completed after a _
+    complete('t.')
+    complete('t._')
+    assert computed == ['t.a', 't.', 't._']
+
+    # Running a command invalidates the cache
+    complete('te')
+    assert ('tea', -2) in complete('te')
+    del namespace['tea']
+    session.namespace_version += 1
+    assert ('tea', -2) not in complete('te')
+    assert computed == ['t.a', 't.', 't._', 'te', 'te']
+
+def test_as_you_type_completer(monkeypatch):
+    import asyncio
+    from types import SimpleNamespace
+    from prompt_toolkit.document import Document
+    from prompt_toolkit.completion import CompleteEvent, Completion
+    from .. import completion
+
+    monkeypatch.setattr(completion, 'AUTOCOMPLETE_DELAY', 0)
+    monkeypatch.setattr(completion, 'AUTOCOMPLETE_BUDGET', 0.2)
+
+    stop_checks = []
+    class SlowCompleter:
+        def get_completions(self, document, complete_event, should_stop=None):
+            yield Completion('fast')
+            stop_checks.append(should_stop)
+            time.sleep(0.5)
+            yield Completion('slow')
+
+    document = Document('x')
+    buffer = SimpleNamespace(document=document)
+    completer = completion.AsYouTypeCompleter(SlowCompleter(), buffer)
+
+    def complete(document, completion_requested=False):
+        async def get():
+            return [c.text async for c in completer.get_completions_async(document,
+                CompleteEvent(text_inserted=not completion_requested,
+                              completion_requested=completion_requested))]
+        return asyncio.run(get())
+
+    # The slow completions are left out when typing (without waiting for
+    # them), but not with TAB
+    t = time.perf_counter()
+    assert complete(document) == ['fast']
+    assert time.perf_counter() - t < 0.4
+    assert complete(document, completion_requested=True) == ['fast', 'slow']
+
+    # The completions of the previous keystrokes are stopped
+    first, second = stop_checks
+    assert first() and not second()
+    complete(document, completion_requested=True)
+    assert second() and not stop_checks[2]()
+
+    # Nothing is completed if the text changed during the delay
+    buffer.document = Document('xy')
+    assert complete(document) == []
+
+    # Completions that come after the budget are still cached
+    namespace = {'xyz': 1}
+    session = SimpleNamespace(builtins={'In': {}}, namespace_version=0)
+    python_completer = completion.PythonCompleter(lambda: namespace,
+        lambda: namespace, session)
+    def python_completions(document, text_before_cursor, should_stop=None):
+        yield Completion('xyz', -2)
+        time.sleep(0.5)
+        if not should_stop():
+            yield Completion('xyw', -2)
+    python_completer._python_completions = python_completions
+    completer = completion.AsYouTypeCompleter(python_completer, buffer)
+    assert complete(buffer.document) == ['xyz']
+    assert python_completer._cache is None
+    for i in range(40):
+        if python_completer._cache:
+            break
+        time.sleep(0.05)
+    assert [c.text for c in python_completer._cache[2]] == ['xyz', 'xyw']
+
+def test_attribute_index():
+    import gc
+    import types
+    import weakref
+    from .. import dircompletion
+
+    class Test:
+        def method(self):
+            pass
+
+    t = Test()
+    t.Mine = 1
+    completer = DirCompleter({'t': t, 'Test': Test})
+    assert completer.attr_matches('t.m') == ['t.Mine', 't.method']
+    assert Test in dircompletion._type_indexes
+
+    # Changes to the class are seen
+    Test.mask = 2
+    assert completer.attr_matches('t.m') == ['t.Mine', 't.mask', 't.method']
+    t.more = 3
+    assert completer.attr_matches('t.mo') == ['t.more']
+    assert completer.attr_matches('Test.m') == ['Test.mask', 'Test.method', 'Test.mro']
+
+    # Large __dict__s (like modules) are indexed
+    module = types.ModuleType('module')
+    for i in range(dircompletion.DICT_INDEX_MIN):
+        setattr(module, 'name%d' % i, i)
+    completer = DirCompleter({'module': module})
+    assert completer.attr_matches('module.name1') == ['module.name1'] + [
+        'module.name1%d' % i for i in range(10)]
+    assert id(module) in dircompletion._dict_indexes
+    module.name1extra = 1
+    assert 'module.name1extra' in completer.attr_matches('module.name1')
+    # Same number of names
+    del module.name10
+    module.name1other = 1
+    matches = completer.attr_matches('module.name1')
+    assert 'module.name1other' in matches
+    assert 'module.name10' not in matches
+
+    # The objects aren't kept alive by the cache
+    ref = weakref.ref(module)
+    del module, completer
+    gc.collect()
+    assert ref() is None
+
+def test_name_index():
+    from ..dircompletion import NameIndex
+
+    namespace = {'abcd': 0, 'ABCD': 0, 'x': 1}
+    index = NameIndex(namespace)
+    completer = DirCompleter(namespace, name_index=index)
+    assert completer.global_matches('abc') == ['ABCD', 'abcd']
+    assert completer.global_matches('as') == ['as ', 'assert ', 'async ', 'ascii',
+        'AssertionError']
+
+    # Names that were added or removed are seen
+    namespace['abce'] = 1
+    assert completer.global_matches('abc') == ['ABCD', 'abcd', 'abce']
+    del namespace['abcd']
+    assert completer.global_matches('abc') == ['ABCD', 'abce']
+    assert index.words == ['ABCD', 'abce', 'x']
+
+    with create_pipe_input() as _input:
+        session = _build_test_session(_input=_input)
+        check_output = _get_check_output(session)
+        check_output('zzz_name = 1\n')
+        assert 'zzz_name' in session.name_index.matches('zzz')
+        check_output('del zzz_name\n')
+        assert session.name_index.matches('zzz') == []
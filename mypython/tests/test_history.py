@@ -0,0 +1,439 @@
+import os
+import sys
+import asyncio
+import signal
+import subprocess
+
+import pytest
+from types import SimpleNamespace
+
+from prompt_toolkit.history import FileHistory
+from prompt_toolkit.input.defaults import create_pipe_input
+from prompt_toolkit.completion import CompleteEvent
+
+from ..history import (IndexedFileHistory, HistoryIndex, HighlightCache,
+    history_chunks, highlight, page_history, HEADER, OFFSET)
+from ..fuzzy import FuzzyHistoryIndex, Cancelled
+from .. import history
+from ..mypython import blue, underline
+from ..mypython import Session, _default_globals
+from .test_mypython import (_TestOutput, _run_session_with_text,
+    _build_test_session, _get_check_output)
+
+ENTRIES = ['a = 1', 'def f():\n    return 1', 'b = 2', 'a = 1', 'f()']
+
+def _file_history(path, entries=ENTRIES):
+    history = FileHistory(path)
+    for entry in entries:
+        history.store_string(entry)
+    return history
+
+def _load(history):
+    return list(history.load_history_strings())
+
+def test_indexed_file_history(tmp_path):
+    path = str(tmp_path/'history')
+    _file_history(path)
+
+    history = IndexedFileHistory(path)
+    assert _load(history) == ENTRIES[::-1]
+    assert history.num_entries() == 5
+    assert os.path.getsize(path + '.idx') == HEADER.size + 5*OFFSET.size
+    assert history.get_entries() == ENTRIES
+    assert history.get_entries(1, 3) == ENTRIES[1:3]
+
+    # The format is the same as FileHistory
+    history.store_string('c = 3\nd = 4')
+    history.flush()
+    assert history.num_entries() == 6
+    assert _load(FileHistory(path)) == ['c = 3\nd = 4'] + ENTRIES[::-1]
+
+    # Things appended by something else are indexed
+    FileHistory(path).store_string('e')
+    assert _load(IndexedFileHistory(path)) == ['e', 'c = 3\nd = 4'] + ENTRIES[::-1]
+
+    # The index is rebuilt if the history file is replaced
+    os.remove(path)
+    _file_history(path, ['x'])
+    assert _load(IndexedFileHistory(path)) == ['x']
+
+def test_indexed_file_history_window(tmp_path):
+    path = str(tmp_path/'history')
+    _file_history(path)
+
+    history = IndexedFileHistory(path, window=2)
+    assert _load(history) == ['f()', 'a = 1']
+    history._loaded_strings = _load(history)
+    assert history.has_older()
+
+    assert history.load_older(2) == ['b = 2', 'def f():\n    return 1']
+    assert history.load_older(2) == ['a = 1']
+    assert not history.has_older()
+    assert history.load_older(2) == []
+    assert history._loaded_strings == ENTRIES[::-1]
+
+def test_indexed_file_history_compact(tmp_path):
+    path = str(tmp_path/'history')
+    _file_history(path, ['a', 'b', 'a', 'c', 'b', 'b', 'd', 'a', 'e'])
+
+    history = IndexedFileHistory(path, window=2)
+    history._loaded_strings = _load(history)
+    assert history._loaded_strings == ['e', 'a']
+    # Only the entries that aren't loaded are compacted, and the latest
+    # occurrence of each is kept
+    assert history.compact() == 4
+    assert history.get_entries() == ['c', 'b', 'd', 'a', 'e']
+    assert _load(FileHistory(path)) == ['e', 'a', 'd', 'b', 'c']
+    assert history.compact() == 0
+
+    history.load_older(10)
+    assert history._loaded_strings == ['e', 'a', 'd', 'b', 'c']
+
+    # The history isn't compacted while another session has loaded it
+    _file_history(path, ['a', 'b', 'f'])
+    other = IndexedFileHistory(path, window=2)
+    _load(other)
+    assert history.compact() == 0
+    assert len(history.get_entries()) == 8
+    assert other.compact() == 0
+
+def test_history_backward_loads_older(tmp_path):
+    path = str(tmp_path/'history')
+    _file_history(path, ['a1', 'a2', 'a3', 'a4', 'a5'])
+
+    with create_pipe_input() as _input:
+        session = Session(_globals=_default_globals.copy(),
+            _locals=_default_globals.copy(),
+            history=IndexedFileHistory(path, window=2), input=_input,
+            output=_TestOutput(), quiet=True)
+
+        # Up arrow
+        assert _run_session_with_text(session, '\x1b[A'*4 + '\n') == 'a2'
+        assert _run_session_with_text(session, '\x1b[A'*6 + '\n') == 'a1'
+
+def test_history_writer(tmp_path):
+    path = str(tmp_path/'history')
+    history = IndexedFileHistory(path, fsync_interval=None)
+    writes = []
+    write = history.writer.write
+    def _write(entries, fsync=False):
+        writes.append((len(entries), fsync))
+        write(entries, fsync)
+    history.writer.write = _write
+
+    # Entries that are queued together are written together
+    with history.writer._cond:
+        for entry in ENTRIES:
+            history.store_string(entry)
+    called = []
+    history.after_write(lambda: called.append(history.num_entries()))
+    assert history.flush()
+    assert writes == [(5, False)]
+    assert called == [5]
+    assert _load(FileHistory(path)) == ENTRIES[::-1]
+
+    history.writer.fsync_interval = 0
+    history.store_string('x')
+    history.flush()
+    assert writes[1:] == [(1, True)]
+    assert history.get_entries() == ENTRIES + ['x']
+
+    # Processes that share the file don't interleave entries
+    other = IndexedFileHistory(path)
+    for i in range(20):
+        history.store_string('a%d\na' % i)
+        other.store_string('b%d\nb' % i)
+    history.flush()
+    other.flush()
+    strings = IndexedFileHistory(path).get_entries()
+    assert len(strings) == 46
+    assert sorted(strings[6:]) == sorted(['a%d\na' % i for i in range(20)] +
+                                         ['b%d\nb' % i for i in range(20)])
+
+@pytest.mark.parametrize('exit', ['sys.exit(0)', 'os.kill(os.getpid(), signal.SIGTERM)'])
+def test_history_writer_exit(tmp_path, exit):
+    path = str(tmp_path/'history')
+    script = f"""
+import os, sys, time, signal
+from mypython.history import IndexedFileHistory
+
+history = IndexedFileHistory({path!r})
+write = history.writer.write
+def slow_write(entries, fsync=False):
+    time.sleep(0.5)
+    write(entries, fsync)
+history.writer.write = slow_write
+history.store_string('a')
+history.store_string('b')
+{exit}
+time.sleep(10)
+"""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    p = subprocess.run([sys.executable, '-c', script], cwd=root, timeout=20)
+    if 'SIGTERM' in exit:
+        assert p.returncode == -signal.SIGTERM
+    else:
+        assert p.returncode == 0
+    assert _load(FileHistory(path)) == ['b', 'a']
+
+def test_history_index(tmp_path):
+    _file_history(str(tmp_path/'ttys001_history'))
+    _file_history(str(tmp_path/'ttys002_history'), ['import os', 'os.getcwd()'])
+    _file_history(str(tmp_path/'other'), ['os.other'])
+
+    index = HistoryIndex(tmp_path)
+    assert index.update() == 7
+    assert index.update() == 0
+    assert os.path.exists(tmp_path/'index.sqlite')
+
+    assert [i[2] for i in index.search('OS.')] == ['os.getcwd()']
+    assert [i[2] for i in index.search('a =')] == ['a = 1']
+    assert [i[2] for i in index.search('1')] == ['a = 1', 'def f():\n    return 1']
+    assert index.search('%') == []
+    file, time, text = index.search('import')[0]
+    assert file == str(tmp_path/'ttys002_history')
+    assert text == 'import os'
+
+    history = IndexedFileHistory(str(tmp_path/'ttys001_history'))
+    history.store_string('os.listdir()')
+    history.flush()
+    assert index.update() == 1
+    assert [i[2] for i in index.search('os.')] == ['os.listdir()', 'os.getcwd()']
+
+    # Replaced files are indexed again
+    os.remove(tmp_path/'ttys002_history')
+    _file_history(str(tmp_path/'ttys002_history'), ['import sys'])
+    assert index.update() == 1
+    assert [i[2] for i in index.search('import')] == ['import sys']
+
+def test_hgrep(tmp_path):
+    _file_history(str(tmp_path/'ttys001_history'), ['x = 1', 'y = 2', 'x + y'])
+
+    with create_pipe_input() as _input:
+        session = _build_test_session(_input)
+        session.history_index = HistoryIndex(tmp_path)
+        check_output = _get_check_output(session)
+
+        out, err = check_output('%hgrep x\n')
+        lines = out.splitlines()
+        assert lines[0].startswith('# ttys001 ')
+        assert lines[1] == 'x = 1'
+        assert lines[2].startswith('# ttys001 ')
+        assert lines[3] == 'x + y'
+        assert not err
+
+        out, err = check_output('%hgrep z\n')
+        assert out == '\n'
+        assert err == "No history entries contain 'z'\n"
+
+        out, err = check_output('%hgrep\n')
+        assert err == "nothing to search for\n"
+
+        # M-r
+        assert _run_session_with_text(session, 'x\x1br\n') == 'x + y'
+        assert _run_session_with_text(session, 'x\x1br\x1br\n') == 'x = 1'
+
+def test_history_search(tmp_path):
+    path = str(tmp_path/'history')
+    _file_history(path, ['x = 1', 'if x:\n    pass', 'x = 2', 'y = 1', 'x = 2', 'z'])
+
+    with create_pipe_input() as _input:
+        session = Session(_globals=_default_globals.copy(),
+            _locals=_default_globals.copy(),
+            history=IndexedFileHistory(path, window=3), input=_input,
+            output=_TestOutput(), quiet=True)
+
+        # M-Up
+        up = '\x1b[1;9A'
+        down = '\x1b[1;9B'
+        assert _run_session_with_text(session, 'x' + up + '\n') == 'x = 2'
+        # The second x = 2 is skipped because it is the same as the text
+        assert _run_session_with_text(session, 'x' + up*2 + '\n') == 'x = 1'
+        assert _run_session_with_text(session, 'x =' + up*3 + down + '\n') == 'x = 2'
+        assert _run_session_with_text(session, 'q' + up + '\n') == 'q'
+
+        buffer = session.default_buffer
+        # The match is indented to the current line
+        buffer.text = 'if 1:\n    i'
+        buffer.cursor_position = len(buffer.text)
+        buffer.history_backward(history_search=True)
+        assert buffer.text == 'if 1:\n    if x:\n        pass'
+        # The older entries were loaded, and the accepted inputs were added
+        assert buffer._prefix_index.oldest == -3
+        assert len(buffer._prefix_index) == 10
+
+def test_history_chunks(tmp_path):
+    path = str(tmp_path/'history')
+    _file_history(path)
+
+    total, chunks = history_chunks(IndexedFileHistory(path), chunk_size=2)
+    assert total == 5
+    assert list(chunks) == [ENTRIES[:2], ENTRIES[2:4], ENTRIES[4:]]
+
+    total, chunks = history_chunks(FileHistory(path), chunk_size=2)
+    assert total == 5
+    assert list(chunks) == [ENTRIES[:2], ENTRIES[2:4], ENTRIES[4:]]
+
+    # A history that has been loaded
+    history = FileHistory(path)
+    async def load():
+        return [string async for string in history.load()]
+    asyncio.run(load())
+    history.append_string('x')
+    total, chunks = history_chunks(history, chunk_size=10)
+    assert total == 6
+    assert list(chunks) == [ENTRIES + ['x']]
+
+def test_highlight_cache(tmp_path, monkeypatch):
+    highlighted = []
+    def _highlight(string):
+        highlighted.append(string)
+        return highlight(string)
+    monkeypatch.setattr(history, 'highlight', _highlight)
+
+    cache = HighlightCache(tmp_path)
+    assert cache.highlight(['a = 1', 'f()', 'a = 1']) == [highlight('a = 1'),
+        highlight('f()'), highlight('a = 1')]
+    assert highlighted == ['a = 1', 'f()']
+    assert '\x1b[' in highlight('def f(): pass')
+
+    assert HighlightCache(tmp_path).highlight(['f()', 'b']) == [highlight('f()'),
+        highlight('b')]
+    assert highlighted == ['a = 1', 'f()', 'b']
+
+def test_page_history(tmp_path):
+    path = str(tmp_path/'ttys001_history')
+    _file_history(path)
+    session = SimpleNamespace(history=IndexedFileHistory(path), history_file=path)
+    out = tmp_path/'out'
+
+    page_history(session, pager='cat > %s' % out, colors=False)
+    assert out.read_text().split(underline(blue(' '*80)) + '\n') == [
+        entry + '\n' for entry in ENTRIES] + ['']
+
+    page_history(session, pager='cat > %s' % out)
+    assert out.read_text().split(underline(blue(' '*80)) + '\n') == [
+        highlight(entry) for entry in ENTRIES] + ['']
+    assert os.path.exists(tmp_path/'highlight.sqlite')
+
+    # The pager exiting early isn't an error
+    page_history(session, pager='true')
+
+def test_page_history_uncached(tmp_path, monkeypatch):
+    path = str(tmp_path/'ttys001_history')
+    entries = ['def %s(): pass' % name for name in 'abcde']
+    _file_history(path, entries)
+    session = SimpleNamespace(history=IndexedFileHistory(path), history_file=path)
+    out = tmp_path/'out'
+
+    monkeypatch.setattr(history, 'HISTORY_PAGER_CHUNK', 2)
+    monkeypatch.setattr(history, 'HISTORY_PAGER_HIGHLIGHT', 2)
+    threads = []
+    fill_async = HighlightCache.fill_async
+    monkeypatch.setattr(HighlightCache, 'fill_async',
+        lambda self, strings: threads.append(fill_async(self, strings)))
+
+    # Only the chunks with the last two entries are highlighted
+    page_history(session, pager='cat > %s' % out)
+    assert out.read_text().split(underline(blue(' '*80)) + '\n') == [
+        entry + '\n' for entry in entries[:2]] + [
+        highlight(entry) for entry in entries[2:]] + ['']
+
+    # The rest are highlighted in the background
+    threads[0].join()
+    page_history(session, pager='cat > %s' % out)
+    assert out.read_text().split(underline(blue(' '*80)) + '\n') == [
+        highlight(entry) for entry in entries] + ['']
+
+def test_fuzzy_history_index():
+    index = FuzzyHistoryIndex()
+    for entry in ['import numpy', 'from sympy import *', 'import numpy',
+                  'x = 1', 'print(x)']:
+        index.add(entry)
+    assert len(index) == 4
+    # import numpy was used twice
+    assert index.search('') == ['import numpy', 'print(x)', 'x = 1',
+                                'from sympy import *']
+    # Contiguous matches at the start of a word rank highest
+    assert index.search('imp') == ['import numpy', 'from sympy import *']
+    assert index.search('IMPnp') == ['import numpy']
+    assert index.search('x1') == ['x = 1']
+    assert index.search('q') == []
+
+    # Narrowing a previous search finds the same thing
+    index._last_matches = None
+    assert index.search('im') == ['import numpy', 'from sympy import *']
+    assert index._last_matches == ('im', [0, 1])
+    assert index.search('imn') == ['import numpy']
+
+def test_fuzzy_history_index_add_during_search(monkeypatch):
+    import threading
+    from .. import fuzzy
+
+    index = FuzzyHistoryIndex()
+    index.add('import numpy')
+    searching = threading.Event()
+    resume = threading.Event()
+    fuzzy_pattern = fuzzy.fuzzy_pattern
+    def slow_pattern(query):
+        searching.set()
+        resume.wait()
+        return fuzzy_pattern(query)
+    monkeypatch.setattr(fuzzy, 'fuzzy_pattern', slow_pattern)
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(index.search('imp')))
+    thread.start()
+    searching.wait()
+    # add() doesn't wait for the search
+    index.add('import sympy')
+    resume.set()
+    thread.join()
+    assert results == [['import numpy']]
+    # The search didn't see the new entry, so it isn't used to narrow the
+    # next one
+    assert index._last_matches is None
+    assert index.search('imp') == ['import sympy', 'import numpy']
+
+    generation = index.generation
+    index.cancel()
+    with pytest.raises(Cancelled):
+        index.search('i', generation=generation)
+
+def test_hfind(tmp_path):
+    path = str(tmp_path/'history')
+    _file_history(path, ['x = 1', 'def f():\n    return x', 'y = 2', 'x + y'])
+
+    with create_pipe_input() as _input:
+        session = Session(_globals=_default_globals.copy(),
+            _locals=_default_globals.copy(),
+            history=IndexedFileHistory(path, window=2), input=_input,
+            output=_TestOutput(), quiet=True)
+        check_output = _get_check_output(session)
+
+        out, err = check_output('%hfind rx\n')
+        assert out == '# 1\ndef f():\n    return x\n\n'
+        assert not err
+
+        out, err = check_output('%hfind qqq\n')
+        assert out == '\n'
+        assert err == "No history entries match 'qqq'\n"
+
+        # C-x C-r
+        buffer = session.default_buffer
+        buffer.text = 'if 1:\n    dfr'
+        buffer.cursor_position = len(buffer.text)
+        completions = list(buffer.fuzzy_completer.get_completions(
+            buffer.document, CompleteEvent()))
+        assert [c.display_text for c in completions] == ['def f():']
+        assert completions[0].display_meta_text == '(1 more lines)'
+        buffer.apply_completion(completions[0])
+        assert buffer.text == 'if 1:\n    def f():\n        return x'
+        assert not buffer.fuzzy_history_search
+
+        # C-x C-r and Enter uses the best match
+        assert _run_session_with_text(session, 'y2\x18\x12\r\n') == 'y = 2'
+
+        # Entries added at the prompt are searched
+        assert _run_session_with_text(session, 'abc = 1\n') == 'abc = 1'
+        assert buffer.fuzzy_index().search('abc') == ['abc = 1']
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+
+# Budget for the cumulative time to import mypython.__main__, i.e., what
+# mypython imports before the first prompt is shown, in seconds.
+STARTUP_BUDGET = 1.0
+
+# Modules that should not be imported until they are used
+LAZY_MODULES = ['jedi', 'pyflakes', 'pydoc', 'sympy', 'numpy', 'ollama']
+
+TOP = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _run(*args):
+    env = dict(os.environ, PYTHONPATH=TOP)
+    return subprocess.run([sys.executable, *args], env=env, capture_output=True,
+                          text=True, check=True)
+
+def import_times(module):
+    """
+    Return a dict mapping each module imported by 'import module' to its
+    cumulative import time in seconds, as reported by python -X importtime
+    """
+    p = _run('-X', 'importtime', '-c', 'import %s' % module)
+    times = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)/1e6
+    return times
+
+def test_startup_budget():
+    # Take the best of a few runs, so that a busy machine doesn't fail the
+    # test
+    elapsed = min(import_times('mypython.__main__')['mypython.__main__']
+                  for i in range(3))
+    assert elapsed < STARTUP_BUDGET
+
+def test_lazy_imports():
+    p = _run('-c', 'import sys, mypython.__main__; print(*sys.modules)')
+    modules = p.stdout.split()
+    for module in LAZY_MODULES:
+        assert module not in modules
+
+    # Importing the package itself doesn't import anything
+    p = _run('-c', 'import sys, mypython; print(*sys.modules)')
+    assert 'mypython.mypython' not in p.stdout.split()
+    assert 'prompt_toolkit' not in p.stdout.split()
+
+def test_lazy_names():
+    import mypython
+    from mypython import PythonCompleter, get_pyflakes_warnings
+
+    assert PythonCompleter is mypython.completion.PythonCompleter
+    assert get_pyflakes_warnings is mypython.processors.get_pyflakes_warnings
+    assert 'format_time' in dir(mypython)
+    assert set(mypython.__all__) <= set(dir(mypython))
@@ -0,0 +1,67 @@
+import sys
+
+import pytest
+
+from ..kernel import (Kernel, KernelDied, KERNEL_NAME, SHARED_MEMORY_THRESHOLD,
+                      encode_text, decode_text)
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32',
+                                reason="kernel mode is not supported on Windows")
+
+@pytest.fixture
+def kernel():
+    kernel = Kernel(IN_OUT=('In', 'Out'))
+    kernel.start()
+    yield kernel
+    kernel.stop()
+
+def test_encode_text():
+    assert encode_text('abc') == ('text', 'abc')
+    assert decode_text(encode_text('abc')) == 'abc'
+
+    text = 'ä'*SHARED_MEMORY_THRESHOLD
+    message = encode_text(text)
+    assert message[0] == 'shm'
+    assert decode_text(message) == text
+
+def test_kernel_execute(kernel):
+    assert kernel.execute('a = 1') == (True, 2, '')
+    assert kernel.execute('a + 1') == (True, 3, '2\n\n')
+    status, prompt_number, text = kernel.execute('1/0')
+    assert status is False
+    assert prompt_number == 4
+
+    # Large results are passed through shared memory
+    status, prompt_number, text = kernel.execute("'a'*%d" % SHARED_MEMORY_THRESHOLD)
+    assert text == repr('a'*SHARED_MEMORY_THRESHOLD) + '\n\n'
+
+    with pytest.raises(SystemExit) as e:
+        kernel.execute('exit(3)')
+    assert e.value.code == 3
+
+def test_kernel_names(kernel):
+    kernel.names['x'] = 'front'
+    kernel.execute('a = 1')
+    kernel.refresh_names()
+    assert kernel.names['a'] is KERNEL_NAME
+    assert 'In' in kernel.names
+    assert kernel.names['x'] == 'front'
+
+    # The names are only updated by apply_pending()
+    kernel.execute('del a')
+    kernel.refresh_names_async().join()
+    assert 'a' in kernel.names
+    kernel.apply_pending()
+    assert 'a' not in kernel.names
+
+def test_kernel_died(kernel):
+    kernel.execute('a = 1')
+    with pytest.raises(KernelDied) as e:
+        kernel.execute('import os, signal; os.kill(os.getpid(), signal.SIGKILL)')
+    assert str(e.value) == "Kernel died (SIGKILL)"
+
+    kernel.restart(prompt_number=10)
+    status, prompt_number, text = kernel.execute('a')
+    assert status is False
+    assert prompt_number == 11
+    assert kernel.execute('1') == (True, 12, '1\n\n')
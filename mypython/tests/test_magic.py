@@ -3,7 +3,9 @@ import textwrap
 import time
 import ast
 
-from ..magic import sympy_start, ast_expr_for_pudb
+from ..magic import (sympy_start, ast_expr_for_pudb, history_uses_sympy,
+    preload_sympy)
+from .. import magic
 
 def test_echo(check_output):
     # Test basic magic and magic syntax checking
@@ -185,9 +187,153 @@ def test_timings(check_output):
     out, err = check_output('%error\n')
 
     out, err = check_output('%timings\n')
-    assert re.match(r""" 1 \d+(\.\d+)? [µu]s
- 2 1(\.\d+)? s
- 3 nan s
+    assert re.match(r"""# +wall +cpu +rss +alloc gc gc_time stdout  command
+1 +\d+(\.\d+)? [µu]s .* 0 B  1
+2 +1(\.\d+)? s +\d+(\.\d+)? [mµu]?s .* 0 B  import time;time.sleep\(1\)
+3 +- +- +- +- +- +- +-  %error
 
-""", out)
+""", out), out
     assert err == ''
+
+    out, err = check_output('%timings 2\n')
+    assert re.match(r"""wall: +1(\.\d+)? s
+cpu: .*
+rss: .*
+alloc: +-
+gc: +\d+
+gc_time: .*
+stdout: +0 B
+""", out), out
+
+    assert check_output("for i in range(10): print('a'*9)\n") == ('aaaaaaaaa\n'*10 + '\n', '')
+    out, err = check_output('%timings --sort stdout\n')
+    rows = [line.split()[0] for line in out.splitlines()[1:-1]]
+    # Commands 4 and 5 are %timings
+    assert rows[3:] == ['1', '2', '3'], out
+    assert re.search(r'^6 .* 100 B ', out, re.MULTILINE), out
+
+    out, err = check_output('%timings --sort foo\n')
+    assert err.startswith("invalid column 'foo'")
+
+    assert check_output('%timings --tracemalloc on\n') == ('\n', '')
+    try:
+        assert check_output('x = [0]*1000000\n') == ('\n', '')
+    finally:
+        check_output('%timings --tracemalloc off\n')
+    out, err = check_output('%timings 10\n')
+    assert re.search(r'alloc: +7\.6\d MiB', out), out
+
+def test_bg(check_output):
+    out, err = check_output('%bg import time; time.sleep(0.5); print("hi"); 1 + 1\n')
+    assert out == 'Started job 1\n\n'
+    assert err == ''
+
+    out, err = check_output('%jobs\n')
+    assert re.match(r'  1  running .*import time', out), out
+
+    out, err = check_output('%wait 1\n')
+    assert out.startswith('hi\n'), out
+    assert err == ''
+
+    assert check_output('_1\n') == ('2\n\n', '')
+    assert check_output('Out[1]\n') == ('2\n\n', '')
+
+    out, err = check_output('%bg while True: pass\n')
+    assert out == 'Started job 6\n\n'
+    out, err = check_output('%kill 6\n')
+    out, err = check_output('%wait 6\n')
+    assert 'Job 6 was killed' in err
+
+    out, err = check_output('%wait 10\n')
+    assert err == 'No job 10\n'
+
+def test_kill_pending_job(capsys):
+    from collections import deque
+    from types import SimpleNamespace
+    from ..jobs import JobManager
+
+    jobs = JobManager(max_jobs=1)
+    namespace = {}
+    prompt = SimpleNamespace(prompt_number=1, Out={}, builtins={},
+        job_results=deque())
+    jobs.submit('import time; time.sleep(0.5)', namespace, namespace, prompt)
+    prompt.prompt_number = 2
+    jobs.submit('1 + 1', namespace, namespace, prompt)
+    jobs.kill(2)
+
+    jobs.wait(2)
+    assert 'Job 2 was killed' in capsys.readouterr().err
+    jobs.wait()
+    out, err = capsys.readouterr()
+    assert '[1] Done' in out
+    assert 'Job 2 was killed' in err
+    assert [n for n, res, _locals in prompt.job_results] == [1]
+
+def test_outcache(check_output):
+    out, err = check_output('%outcache budget 100\n')
+    assert re.match(r'Output cache: [\d\.]+ B of 100 B \(0 outputs, 0 pinned, 0 evicted\)\n\n', out), out
+    assert check_output("'a'*1000\n") == ("'" + 'a'*1000 + "'\n\n", '')
+    assert check_output('%outcache pin 2\n') == ('\n', '')
+    out, err = check_output("lambda: 1\n")
+    assert out.startswith('<function <lambda>')
+    assert check_output("'c'*1000\n") == ("'" + 'c'*1000 + "'\n\n", '')
+    assert check_output("'d'*1000\n") == ("'" + 'd'*1000 + "'\n\n", '')
+
+    # Functions can't be pickled, so they can't be spilled to disk
+    out, err = check_output('_4\n')
+    assert out == '\n'
+    assert 'NameError: Out[4] was evicted' in err, err
+
+    # Out[5] was spilled to disk and is loaded again
+    assert check_output('_2 == _5\n') == ('False\n\n', '')
+    assert check_output('_5[0]\n') == ("'c'\n\n", '')
+    assert check_output('Out[6][0]\n') == ("'d'\n\n", '')
+
+    out, err = check_output('%outcache\n')
+    assert re.match(r'Output cache: .* \(\d outputs, 1 pinned, 1 evicted\)\nSpilled to disk: \d outputs', out), out
+
+def test_save_session(check_output, tmp_path):
+    filename = str(tmp_path/'session')
+    assert check_output('x = 1\n') == ('\n', '')
+    out, err = check_output('%%save_session %s\n' % filename)
+    assert re.match(r'Saved 1 names, 1 inputs, and 0 outputs to %s \(.*\) in .*\n\n' % re.escape(filename), out), out
+    assert err == ''
+    assert check_output('del x\n') == ('\n', '')
+    out, err = check_output('%%load_session %s\n' % filename)
+    assert out.startswith('Loaded 1 names'), out
+    assert check_output('x\n') == ('1\n\n', '')
+
+def test_history_uses_sympy(tmp_path):
+    history_file = tmp_path/'history'
+    assert not history_uses_sympy(history_file)
+
+    history_file.write_text(
+        '\n# 2024-01-01 00:00:00\n+%sympy\n'
+        '\n# 2024-01-01 00:00:01\n+x + 1\n'
+        '\n# 2024-01-01 00:00:02\n+%isympy\n')
+    assert history_uses_sympy(history_file, uses=2)
+    assert not history_uses_sympy(history_file, uses=3)
+
+    # Only the end of the file is read
+    with open(history_file, 'a') as f:
+        f.write('\n# 2024-01-01 00:00:03\n+%s\n' % ('a'*magic.SYMPY_PRELOAD_HISTORY_BYTES))
+    assert not history_uses_sympy(history_file, uses=1)
+
+def test_preload_sympy(monkeypatch):
+    import sys
+    import sympy
+    sympy
+
+    monkeypatch.setattr(magic, '_sympy_preload_thread', None)
+    # Already imported
+    assert preload_sympy() is None
+
+    calls = []
+    monkeypatch.setattr(magic, '_import_sympy', lambda: calls.append(1))
+    monkeypatch.delitem(sys.modules, 'sympy')
+    thread = preload_sympy()
+    assert thread.name == 'mypython-sympy-preload'
+    thread.join()
+    assert calls == [1]
+    assert preload_sympy() is thread
+    assert calls == [1]
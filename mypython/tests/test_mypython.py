@@ -1,5 +1,6 @@
 import sys
 import re
+import threading
 from io import StringIO
 import linecache
 import ast
@@ -13,7 +14,9 @@ from prompt_toolkit.validation import ValidationError
 from ..mypython import (_default_globals, Session, normalize, magic,
     PythonSyntaxValidator, execute_command, getsource, smart_eval, NoResult,
     add_ansi_at_columns, MyStackSummary, MyTracebackException,
-    _apply_inline_highlights)
+    _apply_inline_highlights, CodeCache, split_batch_input, run_batch,
+    BatchSession, pre_command, post_command)
+from ..magic import ast_expr_for_pudb
 from .. import mypython
 from ..theme import TRACEBACK_HIGHLIGHT_STYLES
 
@@ -852,6 +855,213 @@ def test_smart_eval():
     assert d['a'] == 2
     assert res == 4
 
+def test_smart_eval_await():
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        d = {'asyncio': asyncio}
+        res = smart_eval("await asyncio.sleep(0, 1)", d, d, loop=loop)
+        assert res == 1
+
+        res = smart_eval("l = asyncio.get_running_loop()\nawait asyncio.sleep(0)", d, d, loop=loop)
+        assert res is None
+        assert d['l'] is loop
+
+        res = smart_eval("async with asyncio.Lock():\n    a = 1", d, d, loop=loop)
+        assert res == NoResult
+        assert d['a'] == 1
+    finally:
+        loop.close()
+
+    # Without a loop, a new one is used
+    d = {'asyncio': asyncio}
+    res = smart_eval("await asyncio.sleep(0, 2)", d, d)
+    assert res == 2
+
+def test_top_level_await(check_output):
+    assert check_output('import asyncio\n') == ('\n', '')
+    assert check_output('loop = asyncio.get_running_loop(); await asyncio.sleep(0, 1)\n') == ('1\n\n', '')
+    # The same loop is used for every prompt
+    assert check_output('loop is asyncio.get_running_loop() if False else (await asyncio.sleep(0, loop is asyncio.get_running_loop()))\n') == ('True\n\n', '')
+
+    out, err = check_output('await asyncio.sleep(0, 1/0)\n')
+    assert out == '\n'
+    assert 'ZeroDivisionError' in err
+    assert 'base_events.py' not in err
+
+class _CountingDict(dict):
+    """
+    dict that counts the keys that are set or iterated over
+    """
+    ops = 0
+
+    def __setitem__(self, key, value):
+        self.ops += 1
+        super().__setitem__(key, value)
+
+    def setdefault(self, key, default=None):
+        self.ops += 1
+        return super().setdefault(key, default)
+
+    def __iter__(self):
+        for key in super().__iter__():
+            self.ops += 1
+            yield key
+
+    def __reversed__(self):
+        for key in super().__reversed__():
+            self.ops += 1
+            yield key
+
+def test_post_command_overhead(monkeypatch):
+    # The work done by pre_command and post_command on the namespace should
+    # not grow with the number of prompts.
+    monkeypatch.setattr(mypython, 'print_formatted_text', lambda *args, **kwargs: None)
+    _globals = _CountingDict(_test_globals)
+    try:
+        session = BatchSession(_globals=_globals, _locals=_globals, quiet=True)
+        sys.displayhook = lambda res: None
+
+        N = 10000
+        ops = []
+        for i in range(N):
+            before = _globals.ops
+            pre_command(command='x', _globals=_globals, _locals=_globals,
+                        prompt=session)
+            post_command(command='x', res=i, _globals=_globals,
+                         _locals=_globals, prompt=session)
+            ops.append(_globals.ops - before)
+    finally:
+        sys.displayhook = sys.__displayhook__
+        sys.excepthook = sys.__excepthook__
+
+    assert session.prompt_number == N + 1
+    assert _globals['_%s' % N] == N - 1
+    assert _globals['_'] == N - 1
+
+    # The first prompt sets every builtin name
+    assert set(ops[1:]) == {ops[-1]}
+    assert ops[-1] < 20
+
+def test_deleted_output_names(check_output):
+    assert check_output('1 + 1\n') == ('2\n\n', '')
+    assert check_output('del _1\n') == ('\n', '')
+    assert check_output('_1\n') == ('2\n\n', '')
+    assert check_output('_1 = 3\n') == ('\n', '')
+    assert check_output('_1\n') == ('3\n\n', '')
+
+def test_code_cache():
+    cache = CodeCache(maxsize=2)
+
+    d = {}
+    res = smart_eval('def f():\n    return 1\nf()', d, d, filename='<code-cache-1>')
+    assert res == 1
+    assert mypython.CODE_CACHE.cache_info().currsize >= 1
+
+    code, expr_code = cache.compile('a = 1\na + 1', '<test-1>', 0)
+    assert cache.cache_info() == (0, 1, 2, 1)
+    code2, expr_code2 = cache.compile('a = 1\na + 1', '<test-2>', 0)
+    assert cache.cache_info() == (1, 1, 2, 1)
+    assert code.co_filename == expr_code.co_filename == '<test-1>'
+    assert code2.co_filename == expr_code2.co_filename == '<test-2>'
+
+    # Nested code objects get the new filename too
+    code, _ = cache.compile('def f():\n    return [i for i in ()]', '<test-1>', 0)
+    code, _ = cache.compile('def f():\n    return [i for i in ()]', '<test-2>', 0)
+    d = {}
+    exec(code, d)
+    assert d['f'].__code__.co_filename == '<test-2>'
+    assert cache.cache_info().hits == 2
+
+    # Different flags and transformers are different entries
+    cache.compile('1', '<test-1>', 0)
+    cache.compile('1', '<test-1>', 0, ast_transformer=ast_expr_for_pudb)
+    assert cache.cache_info() == (2, 4, 2, 2)
+
+    # Syntax errors are not cached
+    raises(SyntaxError, lambda: cache.compile('1 +', '<test-1>', 0))
+    raises(SyntaxError, lambda: cache.compile('1 +', '<test-1>', 0))
+    assert cache.cache_info().currsize == 2
+
+    cache.cache_clear()
+    assert cache.cache_info() == (0, 0, 2, 0)
+
+    # The counts are kept by every thread that compiles
+    def compile_many():
+        for i in range(200):
+            cache.compile('x%d' % (i % 4), '<test>', 0)
+    threads = [threading.Thread(target=compile_many) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    info = cache.cache_info()
+    assert info.hits + info.misses == 800
+
+def test_split_batch_input():
+    assert split_batch_input('') == []
+    assert split_batch_input("""\
+import os
+@staticmethod
+def f(
+    a):
+    return a
+
+x = [
+1]
+try:
+    pass
+except:
+    pass
+finally:
+    pass
+%time f(1)
+""") == ['import os', '@staticmethod\ndef f(\n    a):\n    return a',
+         'x = [\n1]', 'try:\n    pass\nexcept:\n    pass\nfinally:\n    pass',
+         '%time f(1)']
+
+    assert split_batch_input("""\
+>>> a = 1
+>>> a
+1
+""") == ['a = 1', 'a']
+
+def test_run_batch(capsys, monkeypatch):
+    monkeypatch.setattr(mypython, 'print_formatted_text', lambda *args, **kwargs: None)
+    _globals = _test_globals.copy()
+    try:
+        exitcode = run_batch(StringIO("""\
+a = 1
+def f():
+    return a + 1
+
+f()
+_3 + 1
+"""), _globals, _globals)
+    finally:
+        sys.displayhook = sys.__displayhook__
+        sys.excepthook = sys.__excepthook__
+    out, err = capsys.readouterr()
+    assert exitcode == 0
+    assert out == '\n\n2\n\n3\n\n'
+    assert err == ''
+    assert _globals['In'] == {1: 'a = 1\n', 2: 'def f():\n    return a + 1\n',
+                              3: 'f()\n', 4: '_3 + 1\n'}
+    assert _globals['Out'] == {3: 2, 4: 3}
+    assert _globals['_'] == 3
+
+    _globals = _test_globals.copy()
+    try:
+        exitcode = run_batch(StringIO("1/0\n"), _globals, _globals, cmd=['b = 1'])
+    finally:
+        sys.displayhook = sys.__displayhook__
+        sys.excepthook = sys.__excepthook__
+    out, err = capsys.readouterr()
+    assert exitcode == 1
+    assert _globals['b'] == 1
+    assert 'ZeroDivisionError' in err
+
 def test_timings(check_output):
     out, err = check_output('1\n')
     out, err = check_output('import time;time.sleep(1)\n')
@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+from ..outcache import OutCache, EvictedError, estimate_size
+from ..spill import SpillDirectory
+
+def test_estimate_size():
+    np = pytest.importorskip('numpy')
+
+    a = np.zeros(1000000)
+    assert estimate_size(a) >= 8000000
+    # Views don't own their data, but they still keep it alive
+    assert estimate_size(a[::2]) >= 4000000
+    assert estimate_size(memoryview(bytes(1000))) >= 1000
+
+    assert estimate_size([a, a]) < 2*8000000
+    assert estimate_size({i: bytes(1000) for i in range(1000)}) >= 1000000
+
+def test_outcache():
+    evicted = []
+    Out = OutCache(budget=10000, on_evict=evicted.append)
+    Out[1] = bytes(4000)
+    Out[2] = bytes(4000)
+    assert evicted == []
+    assert Out == {1: bytes(4000), 2: bytes(4000)}
+
+    # Using 1 makes 2 the least recently used
+    Out[1]
+    Out[3] = bytes(4000)
+    assert evicted == [2]
+    assert set(Out) == {1, 3}
+    with pytest.raises(EvictedError, match="Out.2. was evicted"):
+        Out[2]
+    with pytest.raises(KeyError):
+        Out[4]
+
+    Out.pin(1)
+    Out.touch_source('_3 + 1')
+    Out[4] = bytes(4000)
+    assert evicted == [2, 3]
+    assert set(Out) == {1, 4}
+
+    # The most recent output is never evicted
+    Out[5] = bytes(20000)
+    assert evicted == [2, 3, 4]
+    assert set(Out) == {1, 5}
+
+    Out.unpin(1)
+    assert evicted == [2, 3, 4, 1]
+    assert set(Out) == {5}
+
+    Out.set_budget(100000)
+    Out[6] = 1
+    assert set(Out) == {5, 6}
+    assert Out.total == estimate_size(bytes(20000)) + estimate_size(1)
+
+def test_annotate_exception():
+    Out = OutCache(budget=0)
+    Out[1] = 1
+    Out[2] = 2
+
+    try:
+        _1 # noqa
+    except NameError as e:
+        Out.annotate_exception(e)
+        assert str(e).startswith("Out[1] was evicted")
+        assert e.name is None
+
+    try:
+        _2 # noqa
+    except NameError as e:
+        Out.annotate_exception(e)
+        assert str(e) == "name '_2' is not defined"
+
+    # Without NameError.name (Python 3.8 and 3.9), the name is taken from the
+    # message
+    e = NameError("name '_1' is not defined")
+    Out.annotate_exception(e)
+    assert str(e).startswith("Out[1] was evicted")
+
+def test_outcache_spill(tmp_path):
+    loaded = []
+    spill_dir = SpillDirectory(tmp_path)
+    Out = OutCache(budget=10000, spill_dir=spill_dir,
+                   on_load=lambda n, value: loaded.append(n))
+    Out[1] = bytes(8000)
+    Out[2] = bytes(8000)
+    assert set(Out) == {2}
+    assert set(Out.spilled) == {1}
+    assert os.listdir(spill_dir.path) == ['Out-1']
+
+    assert Out[1] == bytes(8000)
+    assert loaded == [1]
+    assert set(Out) == {1}
+    assert set(Out.spilled) == {2}
+    assert os.listdir(spill_dir.path) == ['Out-2']
+
+    Out.touch_source('_2 + 1')
+    assert loaded == [1, 2]
+    assert set(Out.spilled) == {1}
+
+    # get() and pop() see spilled entries
+    assert Out.get(1) == bytes(8000)
+    assert loaded == [1, 2, 1]
+    assert set(Out.spilled) == {2}
+    assert Out.get(10, 'default') == 'default'
+    assert Out.pop(2) == bytes(8000)
+    assert set(Out) == {1}
+    assert Out.spilled == {}
+    assert os.listdir(spill_dir.path) == []
+    Out[2] = bytes(8000)
+    assert set(Out.spilled) == {1}
+
+    # Unpicklable objects are evicted
+    Out[3] = lambda: 1
+    Out[4] = 1
+    Out.set_budget(0)
+    assert set(Out) == {4}
+    assert set(Out.spilled) == {1, 2}
+    assert set(Out.evicted) == {3}
+
+    Out.clear()
+    assert os.listdir(spill_dir.path) == []
+    spill_dir.cleanup()
+    assert os.listdir(tmp_path) == []
@@ -35,3 +35,23 @@ def test_displayhook(check_output):
     out, err = check_output('a\n')
     assert out == '[[...]]\n\n'
     assert err == ''
+
+def test_can_print_sympy_imports():
+    # can_print_sympy() shouldn't import SymPy submodules (like
+    # sympy.physics.vector, which is slow to import)
+    import os
+    import subprocess
+    import sys
+
+    top = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    code = """
+import sys
+from mypython.printing import can_print_sympy
+assert not can_print_sympy([1, 2])
+assert 'sympy' not in sys.modules
+import sympy
+assert can_print_sympy([sympy.Symbol('x'), sympy.Matrix([1])])
+assert 'sympy.physics.vector' not in sys.modules
+"""
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   env=dict(os.environ, PYTHONPATH=top))
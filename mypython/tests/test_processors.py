@@ -441,3 +441,11 @@ def test_replace_newlines_with_spaces():
     )
     result = replace_newlines_with_spaces(text, column_width)
     assert result == expected
+
+def test_get_pyflakes_warnings_top_level_await():
+    assert get_pyflakes_warnings("await f()", frozenset(['f'])) == []
+    assert get_pyflakes_warnings("async with f():\n    [await i for i in f()]", frozenset(['f'])) == []
+
+    warnings = get_pyflakes_warnings("yield 1")
+    assert warnings
+    assert warnings[0][2] == "'yield' outside function"
@@ -0,0 +1,57 @@
+import gc
+import sys
+from io import StringIO
+
+from ..jobs import JobStream
+from ..resources import ResourceMonitor, Resources
+
+def test_resource_monitor():
+    monitor = ResourceMonitor()
+    r = monitor.stop()
+    assert all(i != i for i in r)
+
+    old_stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        monitor.start()
+        print('a'*99)
+        sum(range(1000000))
+        gc.collect()
+        gc.collect()
+        r = monitor.stop()
+        assert sys.stdout.getvalue() == 'a'*99 + '\n'
+        assert isinstance(sys.stdout, StringIO)
+    finally:
+        sys.stdout = old_stdout
+
+    assert isinstance(r, Resources)
+    assert r.stdout == 100
+    assert r.gc >= 2
+    assert r.gc_time > 0
+    assert 0 < r.cpu < 10
+    assert r.rss >= 0
+    assert r.alloc != r.alloc
+
+    # The CountingStream is removed even if sys.stdout was wrapped again
+    # (like by %bg)
+    sys.stdout = StringIO()
+    try:
+        monitor.start()
+        sys.stdout = JobStream(sys.stdout, 'stdout')
+        print('é')
+        r = monitor.stop()
+        assert isinstance(sys.stdout.stream, StringIO)
+        assert sys.stdout.stream.getvalue() == 'é\n'
+    finally:
+        sys.stdout = old_stdout
+    assert r.stdout == 3
+
+    monitor.trace_allocations = True
+    try:
+        monitor.start()
+        x = bytes(10**7)
+        del x
+        r = monitor.stop()
+    finally:
+        monitor.trace_allocations = False
+    assert r.alloc >= 10**7
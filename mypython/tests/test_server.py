@@ -0,0 +1,121 @@
+import os
+import pty
+import socket
+import stat
+import subprocess
+import sys
+import time
+
+import pytest
+
+from ..server import connect, source_stamp, _allowed_peer
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32',
+                                reason="the server is not supported on Windows")
+
+TOP = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def _python(code, **kwargs):
+    env = dict(os.environ, PYTHONPATH=TOP)
+    return subprocess.Popen([sys.executable, '-c', code], env=env, text=True,
+                            **kwargs)
+
+@pytest.fixture
+def server(tmp_path):
+    path = str(tmp_path/'server.sock')
+    p = _python("import sys; from mypython.server import serve; "
+                "sys.exit(serve(%r, modules=[]))" % path, stderr=subprocess.PIPE)
+    for i in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.1)
+    else:
+        p.kill()
+        pytest.fail("The server did not start: %s" % p.communicate()[1])
+    yield p, path
+    p.kill()
+    p.wait()
+
+def _client(path, text, stamp=None):
+    p = _python("import sys; from mypython.server import connect; "
+                "print(connect(['--batch', '-'], %r, stamp=%r), file=sys.stderr)"
+                % (path, stamp), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(text, timeout=30)
+    return stdout, stderr.splitlines()[-1]
+
+def test_source_stamp():
+    assert source_stamp() == source_stamp()
+
+def test_connect_no_server(tmp_path):
+    assert connect([], str(tmp_path/'server.sock')) is None
+
+def test_server(server, tmp_path):
+    p, path = server
+
+    stdout, exitcode = _client(path, 'a = 1 + 1\na\nimport os\nos.getpid()\n')
+    assert '2' in stdout
+    assert exitcode == '0'
+    # The session is forked from the server
+    assert str(p.pid) not in stdout
+
+    stdout, exitcode = _client(path, 'exit(3)\n')
+    assert exitcode == '3'
+
+    # The server is still running
+    assert p.poll() is None
+
+def test_server_permissions(server):
+    p, path = server
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_PEERCRED'),
+                    reason="SO_PEERCRED is Linux only")
+def test_allowed_peer(monkeypatch):
+    a, b = socket.socketpair()
+    with a, b:
+        assert _allowed_peer(a)
+        uid = os.getuid()
+        monkeypatch.setattr(os, 'getuid', lambda: uid + 1)
+        assert not _allowed_peer(a)
+
+def test_server_stale(server):
+    p, path = server
+
+    stdout, exitcode = _client(path, '1\n', stamp='old')
+    assert exitcode == 'None'
+    assert p.wait(timeout=10) == 0
+    assert not os.path.exists(path)
+
+def test_server_terminal(server, tmp_path):
+    p, path = server
+    script = tmp_path/'script.py'
+    script.write_text("import os\n"
+                      "print('pgrp', os.tcgetpgrp(0) == os.getpgrp())\n"
+                      "print('sid', os.getsid(0) == os.getpid())\n")
+
+    master, slave = pty.openpty()
+    try:
+        client = _python("import sys; from mypython.server import connect; "
+                         "print(connect(['--batch', %r], %r), file=sys.stderr)"
+                         % (str(script), path), stdin=slave, stdout=slave,
+                         stderr=subprocess.PIPE)
+        os.close(slave)
+        stderr = client.communicate(timeout=30)[1]
+        output = b''
+        while True:
+            try:
+                data = os.read(master, 2**16)
+            except OSError:
+                break
+            if not data:
+                break
+            output += data
+    finally:
+        os.close(master)
+
+    assert stderr.splitlines()[-1] == '0'
+    # The session has its own controlling terminal, and is in the foreground
+    # of it
+    assert b'pgrp True' in output
+    assert b'sid True' in output
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from ..mypython import BatchSession, execute_command
+from ..snapshot import (save_session, load_session, snapshot_filename,
+                        print_report, ModuleRef)
+from .. import mypython
+from .test_mypython import _test_globals
+
+@pytest.fixture
+def batch_session(monkeypatch):
+    monkeypatch.setattr(mypython, 'print_formatted_text', lambda *args, **kwargs: None)
+    def _session():
+        _globals = _test_globals.copy()
+        return BatchSession(_globals=_globals, _locals=_globals, quiet=True)
+    try:
+        yield _session
+    finally:
+        import sys
+        sys.displayhook = sys.__displayhook__
+        sys.excepthook = sys.__excepthook__
+
+def test_save_load_session(tmp_path, batch_session, capsys):
+    np = pytest.importorskip('numpy')
+
+    session = batch_session()
+    for command in [
+            'import numpy as np',
+            'a = np.arange(1000000.)',
+            'b = [a, a]',
+            'f = open(%r, "w")' % str(tmp_path/'file'),
+            'a.sum()',
+            'c = 1',
+    ]:
+        assert execute_command(command, session, _globals=session._globals,
+                               _locals=session._locals)
+
+    filename = str(tmp_path/'session')
+    snapshot = save_session(session, session._locals, filename)
+    assert list(snapshot['skipped']) == ['f']
+    assert 'TextIOWrapper' in snapshot['skipped']['f'] or 'pickle' in snapshot['skipped']['f']
+    # The array is only written once
+    assert os.path.getsize(filename) < 2*8000000
+    session._locals['f'].close()
+
+    new = batch_session()
+    capsys.readouterr()
+    assert execute_command('1', new, _globals=new._globals, _locals=new._locals)
+    load_session(new, new._locals, filename)
+
+    ns = new._locals
+    assert ns['np'] is np
+    np.testing.assert_array_equal(ns['a'], np.arange(1000000.))
+    assert ns['b'][0] is ns['a']
+    # Memory mapped
+    assert not ns['a'].flags.owndata
+    assert 'f' not in ns
+    assert ns['c'] == 1
+    assert ns['_5'] == ns['Out'][5] == 499999500000.0
+    assert ns['In'][2] == 'a = np.arange(1000000.)\n'
+    assert set(new.timings) == {1, 2, 3, 4, 5, 6}
+    assert new.prompt_number == ns['PROMPT_NUMBER'] == 7
+
+def test_load_session_version(tmp_path, batch_session):
+    from ..spill import dump
+
+    filename = str(tmp_path/'session')
+    dump({'version': 0}, filename)
+    with pytest.raises(ValueError, match='not a version 1'):
+        load_session(batch_session(), {}, filename)
+
+def test_print_report(tmp_path, batch_session, capsys):
+    from ..spill import dump
+
+    filename = str(tmp_path/'session')
+    dump({'version': 1, 'python': (3, 8), 'In': {}, 'Out': {}, 'TIMINGS': {},
+          'namespace': {'m': ModuleRef('nonexistent_module')},
+          'skipped': {'f': 'TypeError: cannot pickle'}}, filename)
+    session = batch_session()
+    snapshot = load_session(session, session._locals, filename)
+    capsys.readouterr()
+    print_report('Loaded', filename, snapshot, 0.1)
+    out = capsys.readouterr().out
+    assert out.splitlines()[1:] == [
+        "1 objects were not saved (unpicklable):",
+        "  f: TypeError: cannot pickle",
+        "1 objects could not be loaded:",
+        "  m: ModuleNotFoundError: No module named 'nonexistent_module'",
+    ]
+
+def test_snapshot_filename():
+    assert snapshot_filename() == os.path.expanduser('~/.mypython/sessions/default')
+    assert snapshot_filename('work') == os.path.expanduser('~/.mypython/sessions/work')
+    assert snapshot_filename('./work') == os.path.abspath('work')
@@ -0,0 +1,52 @@
+import os
+import pickle
+
+import pytest
+
+from ..spill import dump, load, SpillDirectory
+
+def test_dump_load(tmp_path):
+    filename = tmp_path/'a'
+    obj = {'a': [1, 2.5, 'b'], 'c': bytearray(b'abc')}
+    dump(obj, filename)
+    assert load(filename) == obj
+
+    with pytest.raises((pickle.PicklingError, AttributeError, TypeError)):
+        dump(lambda: 1, tmp_path/'b')
+    assert not os.path.exists(tmp_path/'b')
+
+def test_dump_load_numpy(tmp_path):
+    np = pytest.importorskip('numpy')
+
+    filename = tmp_path/'a'
+    a = np.arange(100000.)
+    b = np.arange(10)[::2]
+    dump([a, b, a], filename)
+    # The data is written out-of-band, not copied into the pickle
+    assert os.path.getsize(filename) < a.nbytes + 1000
+
+    a2, b2, a3 = load(filename)
+    assert a2 is a3
+    np.testing.assert_array_equal(a, a2)
+    np.testing.assert_array_equal(b, b2)
+    # The data is memory mapped
+    assert not a2.flags.owndata
+
+    # Copy-on-write
+    os.remove(filename)
+    a2[0] = 1
+    assert a2[0] == 1
+
+def test_spill_directory(tmp_path):
+    stale = tmp_path/'999999999-abc'
+    stale.mkdir()
+
+    spill_dir = SpillDirectory(tmp_path)
+    assert spill_dir.path is None
+    filename = spill_dir.filename('x')
+    assert os.path.dirname(filename) == spill_dir.path
+    assert os.path.basename(spill_dir.path).startswith('%d-' % os.getpid())
+    assert not stale.exists()
+
+    spill_dir.cleanup()
+    assert os.listdir(tmp_path) == []